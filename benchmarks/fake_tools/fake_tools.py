@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+# Copyright: (c) 2019, Tanner Dowhy <tanner.dowhy@usask.ca>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""Stand-ins for cutadapt, flash2, pear and Rscript, for benchmarking the
+modules on a box without the real tools. Put this directory first on PATH
+or pass its links as the modules' executables; the tool is taken from the
+name it was called by.
+
+Each one reads its input and writes output of the shape the next step
+expects, with a report the modules can parse, so timings follow the size
+of the input. They do much less work than the real tools: cutadapt cuts
+the primer length off reads that start with the primer, flash2 and pear
+merge on the first exact match of the start of R2 in R1, and Rscript
+stands in for sample_inference.R (dereplication) and taxonomy.R (merging
+the tables) only, writing JSON where the real scripts write RDS.
+"""
+
+import gzip
+import io
+import json
+import os
+import re
+import sys
+
+IUPAC = {'A': 'A', 'C': 'C', 'G': 'G', 'T': 'T', 'U': 'T', 'R': '[AG]', 'Y': '[CT]',
+    'S': '[CG]', 'W': '[AT]', 'K': '[GT]', 'M': '[AC]', 'B': '[CGT]', 'D': '[AGT]',
+    'H': '[ACT]', 'V': '[ACG]', 'N': '[ACGTN]'}
+
+COMPLEMENT = str.maketrans('ACGTN', 'TGCAN')
+
+
+def revcomp(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def open_in(path):
+    # Peek rather than reopen, as the input may be a <(zcat ...) pipe.
+    f = open(path, 'rb')
+    if f.peek(2)[:2] == b'\x1f\x8b':
+        return io.TextIOWrapper(gzip.GzipFile(fileobj=f))
+    return io.TextIOWrapper(f)
+
+
+def open_out(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'wt', compresslevel=1)
+    return open(path, 'w')
+
+
+def records(path):
+    with open_in(path) as f:
+        while True:
+            head = f.readline()
+            if not head:
+                return
+            seq = f.readline().rstrip('\n')
+            f.readline()
+            qual = f.readline().rstrip('\n')
+            yield head, seq, qual
+
+
+def split_args(argv, with_value):
+    """Return (options, positional) for an argument list where the
+    options in with_value take the next argument."""
+    opts = {}
+    rest = []
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg in with_value and i + 1 < len(argv):
+            opts.setdefault(arg, []).append(argv[i + 1])
+            i += 2
+            continue
+        if arg.startswith('-') and len(arg) > 1:
+            key, _, value = arg.partition(' ')
+            opts.setdefault(key, []).append(value)
+        else:
+            rest.append(arg)
+        i += 1
+    return opts, rest
+
+
+def adapter(spec):
+    # name=SEQ or the linked 'name=SEQ;required...SEQ;optional'
+    name, _, seq = spec.strip("'").partition('=')
+    seq = seq.split(';')[0].split('...')[0]
+    return name, re.compile(''.join(IUPAC.get(c, c) for c in seq.upper())), len(seq)
+
+
+def cutadapt(argv):
+    opts, rest = split_args(argv, ('-g', '-G', '-a', '-A', '-o', '-p', '-n', '-m', '-M', '-j', '-O', '-e', '-y', '-q', '-u', '-l'))
+    fwd = [adapter(a) for a in opts.get('-g', [])]
+    rev = [adapter(a) for a in opts.get('-G', [])]
+    # Linked panel adapters are given with -a/-A and carry the 5' primer.
+    fwd += [adapter(a) for a in opts.get('-a', []) if ';required' in a]
+    rev += [adapter(a) for a in opts.get('-A', []) if ';required' in a]
+    min_len = int(opts.get('-m', ['0'])[0])
+    out1, out2 = opts['-o'][0], opts['-p'][0]
+    files = {}
+    total = written = 0
+    for r1, r2 in zip(records(rest[0]), records(rest[1])):
+        total += 1
+        name = 'unknown'
+        seq1, qual1, seq2, qual2 = r1[1], r1[2], r2[1], r2[2]
+        for n, pattern, length in fwd:
+            if pattern.match(seq1):
+                name, seq1, qual1 = n, seq1[length:], qual1[length:]
+                break
+        for n, pattern, length in rev:
+            if pattern.match(seq2):
+                seq2, qual2 = seq2[length:], qual2[length:]
+                break
+        if len(seq1) < min_len or len(seq2) < min_len:
+            continue
+        key = out1.replace('{name}', name)
+        if key not in files:
+            files[key] = (open_out(key), open_out(out2.replace('{name}', name)))
+        files[key][0].write('%s%s\n+\n%s\n' % (r1[0], seq1, qual1))
+        files[key][1].write('%s%s\n+\n%s\n' % (r2[0], seq2, qual2))
+        written += 1
+    for f1, f2 in files.values():
+        f1.close()
+        f2.close()
+    print('This is cutadapt (fake_tools)')
+    print('=== Summary ===')
+    print('Total read pairs processed: %12s' % '{:,}'.format(total))
+    print('Pairs written (passing filters): %7s' % '{:,}'.format(written))
+    return 0
+
+
+def merge_pairs(r1_path, r2_path, out_path, min_overlap):
+    """Merge each pair on the first exact match of the start of the
+    reverse-complemented R2 in R1 and return (pairs, merged)."""
+    pairs = merged = 0
+    with open_out(out_path) as out:
+        for r1, r2 in zip(records(r1_path), records(r2_path)):
+            pairs += 1
+            seq2 = revcomp(r2[1])
+            qual2 = r2[2][::-1]
+            at = r1[1].find(seq2[:min_overlap])
+            if at < 0 or len(r1[1]) - at < min_overlap:
+                continue
+            out.write('%s%s\n+\n%s\n' % (r1[0], r1[1][:at] + seq2, r1[2][:at] + qual2))
+            merged += 1
+    return pairs, merged
+
+
+def flash2(argv):
+    opts, rest = split_args(argv, ('-o', '-m', '-M', '-Q', '-C', '-e', '-X', '-r', '-f', '-s', '-t', '-p'))
+    prefix = opts['-o'][0]
+    suffix = '.extendedFrags.fastq.gz' if '-z' in opts else '.extendedFrags.fastq'
+    pairs, merged = merge_pairs(rest[0], rest[1], prefix + suffix, int(opts.get('-m', ['10'])[0]))
+    print('[FLASH] Read combination statistics:')
+    print('[FLASH]     Total pairs:      %d' % pairs)
+    print('[FLASH]     Combined pairs:   %d' % merged)
+    print('[FLASH]     Uncombined pairs: %d' % (pairs - merged))
+    return 0
+
+
+def pear(argv):
+    opts, rest = split_args(argv, ('-f', '-r', '-o', '-v', '-m', '-n', '-t', '-q', '-u', '-p', '-g', '-s', '-b', '-y', '-j'))
+    prefix = opts['-o'][0]
+    pairs, merged = merge_pairs(opts['-f'][0], opts['-r'][0], '%s.assembled.fastq' % prefix,
+        int(opts.get('-v', ['10'])[0]))
+    print('PEAR (fake_tools)')
+    print('Assembled reads ...................: {:,} / {:,} ({:.3f}%)'.format(merged, pairs,
+        100.0 * merged / pairs if pairs else 0))
+    return 0
+
+
+def write_table(path, table):
+    """Write a samples x sequences CSV, as the R scripts do."""
+    seqs = sorted(set(s for counts in table.values() for s in counts))
+    with open(path, 'w') as f:
+        f.write(',%s\n' % ','.join(seqs))
+        for sample in sorted(table):
+            f.write('%s,%s\n' % (sample, ','.join(str(table[sample].get(s, 0)) for s in seqs)))
+    return seqs
+
+
+def sample_inference(args):
+    # args as in sample_inference.R: 2 reads dir, 3 pattern, 9 csv, 10 rds
+    table = {}
+    for name in sorted(os.listdir(args[2])):
+        path = os.path.join(args[2], name)
+        if args[3] not in name or not os.path.isfile(path):
+            continue
+        counts = {}
+        for head, seq, qual in records(path):
+            counts[seq] = counts.get(seq, 0) + 1
+        # Singletons stand in for what denoising would remove.
+        table[name.split(args[3])[0]] = dict((s, n) for s, n in counts.items() if n > 1)
+    write_table(args[9], table)
+    with open(args[10], 'w') as f:
+        json.dump(table, f)
+    return 0
+
+
+def taxonomy(args):
+    # args as in taxonomy.R: 2 comma-joined RDS, 5/6 CSV and 7/8 RDS outputs
+    table = {}
+    for path in args[2].split(','):
+        if path and path != '""':
+            with open(path) as f:
+                table.update(json.load(f))
+    seqs = write_table(args[5], table)
+    with open(args[6], 'w') as f:
+        f.write(',Kingdom,Phylum,Class,Order,Family,Genus\n')
+        for s in seqs:
+            f.write('%s,Bacteria,NA,NA,NA,NA,NA\n' % s)
+    for path in (args[7], args[8]):
+        with open(path, 'w') as f:
+            json.dump(table, f)
+    return 0
+
+
+def rscript(argv):
+    # R's args[i] is argv[i] here, argv[0] being the script.
+    scripts = dict(sample_inference=sample_inference, taxonomy=taxonomy)
+    name = os.path.splitext(os.path.basename(argv[0]))[0]
+    if name not in scripts:
+        return 0
+    return scripts[name](argv)
+
+
+if __name__ == '__main__':
+    command = os.path.basename(sys.argv[0])
+    commands = dict(cutadapt=cutadapt, flash2=flash2, pear=pear, Rscript=rscript)
+    if command not in commands:
+        sys.exit('Call as one of %s' % ', '.join(sorted(commands)))
+    sys.exit(commands[command](sys.argv[1:]))
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+# Copyright: (c) 2019, Tanner Dowhy <tanner.dowhy@usask.ca>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""Run every read merger on the same subset of samples and report
+reads/sec, merge rate and peak RSS for each.
+
+    python benchmarks/merge_benchmark.py --input reads/ --samples 8 --reads 50000
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import gzip
+import json
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+import merger
+import samples
+
+
+def subset(sample, n_reads, out_dir):
+    """Write the first n_reads pairs of a sample to out_dir so every
+    merger reads exactly the same input."""
+    paths = []
+    for mate, files in (('R1', sample['r1']), ('R2', sample['r2'])):
+        path = os.path.join(out_dir, '%s.fastq' % sample['stem'].replace('_R1', '_%s' % mate))
+        written = 0
+        with open(path, 'w') as out:
+            for fi in files:
+                opener = gzip.open if fi.endswith('.gz') else open
+                with opener(fi, 'rt') as f:
+                    for i, line in enumerate(f):
+                        if n_reads and written >= n_reads * 4:
+                            break
+                        out.write(line)
+                        written += 1
+        paths.append(path)
+    return dict(sample, r1=[paths[0]], r2=[paths[1]], r1_in=paths[0], r2_in=paths[1], amplicon=None)
+
+
+def run(cmd, cwd):
+    """Run a shell command and return (rc, seconds, peak RSS in KB)."""
+    start = time.time()
+    proc = subprocess.Popen(['bash', '-c', ' '.join(cmd)], cwd=cwd)
+    pid, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = status
+    return status, time.time() - start, usage.ru_maxrss
+
+
+def benchmark(name, executable, inputs, work_dir, threads):
+    m = merger.MERGERS[name]
+    params = dict((k, v.get('default')) for k, v in m['arg_spec']().items())
+    params['threads'] = threads
+    out_dir = os.path.join(work_dir, name)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    pairs = merged = 0
+    seconds = 0.0
+    peak = 0
+    failed = []
+    for sample in inputs:
+        prefix = os.path.join(out_dir, sample['stem'])
+        report = '%s.report' % prefix
+        rc, secs, rss = run(m['build_cmd'](params, sample, executable, prefix, report), out_dir)
+        seconds += secs
+        peak = max(peak, rss)
+        p = n = None
+        if os.path.isfile(report):
+            with open(report) as f:
+                p, n = m['parse_report'](f.read())
+        if rc != 0 or p is None:
+            failed.append(sample['name'])
+            continue
+        pairs += p
+        merged += n
+    return dict(merger=name, samples=len(inputs), pairs=pairs, merged=merged,
+        seconds=round(seconds, 3),
+        reads_per_sec=round(pairs / seconds, 1) if seconds else None,
+        merge_rate=round(merged / pairs, 4) if pairs else None,
+        peak_rss_mb=round(peak / 1024.0, 1), failed=failed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--input', required=True, help='directory of paired FASTQ files')
+    parser.add_argument('--work-dir', default='merge_benchmark', help='scratch directory')
+    parser.add_argument('--samples', type=int, default=4, help='number of samples to use')
+    parser.add_argument('--reads', type=int, default=100000, help='read pairs per sample, 0 for all')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--flash2', default='flash2', help='flash2 executable, empty to skip')
+    parser.add_argument('--pear', default='pear', help='PEAR executable, empty to skip')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    input_dir = os.path.join(os.path.abspath(args.work_dir), 'input')
+    if not os.path.isdir(input_dir):
+        os.makedirs(input_dir)
+    found = samples.discover_samples(args.input)[:args.samples]
+    inputs = [subset(s, args.reads, input_dir) for s in found]
+
+    results = []
+    for name in sorted(merger.MERGERS):
+        executable = getattr(args, name)
+        if executable:
+            results.append(benchmark(name, executable, inputs, os.path.abspath(args.work_dir), args.threads))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print('%-8s %8s %10s %12s %10s %12s' % ('merger', 'samples', 'pairs', 'reads/sec', 'merge rate', 'peak RSS MB'))
+    for r in results:
+        print('%-8s %8d %10d %12s %10s %12s' % (r['merger'], r['samples'], r['pairs'], r['reads_per_sec'],
+            r['merge_rate'], r['peak_rss_mb']))
+        if r['failed']:
+            print('    failed: %s' % ', '.join(r['failed']))
+
+
+if __name__ == '__main__':
+    main()
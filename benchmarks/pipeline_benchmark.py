@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+
+# Copyright: (c) 2019, Tanner Dowhy <tanner.dowhy@usask.ca>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""Run the amplicon modules, one after the other as a playbook would, on
+synthetic datasets of several sizes, and report the wall time, read pairs
+per second and peak RSS of each module and of the whole chain.
+
+    python benchmarks/pipeline_benchmark.py --scales 10x10k,100x10k,1000x1k
+    python benchmarks/pipeline_benchmark.py --compare old/report.json
+
+A scale is SAMPLESxREAD_PAIRS (k and M allowed). Each dataset is written
+once by synthetic.py and reused while its seed and options are unchanged.
+The modules run the way Ansible runs them, as python MODULE.py ARGS.json,
+with the utils copied to /tmp/biol, so Ansible itself must be importable.
+By default the tools are the stand-ins in fake_tools/; pass --tools with
+a directory holding cutadapt, flash2, pear and Rscript, or --tools '' to
+take them from PATH, to time the real ones (the DADA2 steps then need
+--training-set).
+
+The report (report.json in the work directory) holds the host, commit
+and tools next to the results, so runs can be compared with --compare.
+With the input bytes of each step in it, it also serves the modules as
+cost_model for check-mode plans.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import datetime
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import time
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+import synthetic
+
+# The order a playbook runs them in. Both mergers write to
+# .biolighthouse/merge, and flash2 runs last so DADA2 reads its output.
+STEPS = ['cutadapt_paired_end', 'pear_merge', 'flash2_merge', 'dada2_sample_inference', 'dada2_taxonomy']
+TOOLS = dict(cutadapt_paired_end='cutadapt', pear_merge='pear', flash2_merge='flash2',
+    dada2_sample_inference='Rscript', dada2_taxonomy='Rscript')
+UTILS_DIR = '/tmp/biol'
+
+
+def parse_count(text):
+    units = {'k': 1000, 'K': 1000, 'm': 1000000, 'M': 1000000}
+    if text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def parse_scales(text):
+    scales = []
+    for part in text.split(','):
+        n_samples, n_reads = part.strip().split('x')
+        scales.append((parse_count(n_samples), parse_count(n_reads)))
+    return scales
+
+
+def dataset(work_dir, n_samples, n_reads, args):
+    """Return the manifest of the dataset for one scale, generating it
+    unless an identical one is already there."""
+    out = os.path.join(work_dir, 'data', '%dx%d' % (n_samples, n_reads))
+    gen_args = synthetic.parser().parse_args(['--out', out, '--samples', str(n_samples), '--reads', str(n_reads),
+        '--seed', str(args.seed), '--read-length', str(args.read_length), '--overlap', str(args.overlap)])
+    path = os.path.join(out, 'manifest.json')
+    if os.path.isfile(path):
+        with open(path) as f:
+            manifest = json.load(f)
+        if all(manifest.get(k) == v for k, v in vars(gen_args).items() if k != 'out'):
+            return manifest
+        shutil.rmtree(out)
+    start = time.time()
+    manifest = synthetic.generate(gen_args)
+    print('generated %s in %.1fs' % (out, time.time() - start), file=sys.stderr)
+    return manifest
+
+
+def install_utils():
+    """Copy the utils where the modules load them from, as the
+    blConfigSetup role does."""
+    if not os.path.isdir(UTILS_DIR):
+        os.makedirs(UTILS_DIR)
+    for path in glob.glob(os.path.join(REPO, 'utils', '*.py')):
+        shutil.copy(path, UTILS_DIR)
+
+
+def layout(base_dir):
+    """Create a fresh .biolighthouse work area with the R scripts in place."""
+    if os.path.isdir(base_dir):
+        shutil.rmtree(base_dir)
+    bl = os.path.join(base_dir, '.biolighthouse')
+    for d in ('primer_removal/output', 'primer_removal/reports', 'merge/output', 'merge/reports', 'DADA2'):
+        os.makedirs(os.path.join(bl, d))
+    for path in glob.glob(os.path.join(REPO, 'utils', 'r_script_templates', '*.R')):
+        shutil.copy(path, os.path.join(bl, 'DADA2'))
+    return bl
+
+
+def module_args(step, base_dir, manifest, executable, done, args):
+    bl = os.path.join(base_dir, '.biolighthouse')
+    params = dict(base_dir=base_dir, executable=executable, ledger=args.ledger)
+    trimmed = 'cutadapt_paired_end' in done
+    if step == 'cutadapt_paired_end':
+        params.update(input_files=manifest['out'], primer=manifest['primer_f'], primer_r=manifest['primer_r'],
+            cores=args.threads)
+    elif step in ('pear_merge', 'flash2_merge'):
+        params.update(input_files=os.path.join(bl, 'primer_removal', 'output') if trimmed else manifest['out'],
+            threads=args.threads)
+        if step == 'flash2_merge':
+            params.update(read_len=manifest['read_length'], max_overlap=manifest['read_length'],
+                fragment_len=manifest['amplicon_length'] if trimmed else manifest['template_length'])
+    elif step == 'dada2_sample_inference':
+        params.update(reads=os.path.join(bl, 'merge', 'output'), output='benchmark', threads=args.threads)
+    elif step == 'dada2_taxonomy':
+        training_set = args.training_set or os.path.join(args.work_dir, 'training_set.fa')
+        if not args.training_set and not os.path.isfile(training_set):
+            shutil.copy(os.path.join(manifest['out'], 'asvs.fasta'), training_set)
+        params.update(input_rds=[os.path.join(bl, 'DADA2', 'benchmark.rds')], training_set=training_set,
+            random_seed=args.seed)
+    return params
+
+
+def input_bytes(step, bl, manifest, done):
+    """The bytes the step reads, so reports can be used as cost models
+    for check-mode plans."""
+    if step == 'cutadapt_paired_end' or (step.endswith('_merge') and 'cutadapt_paired_end' not in done):
+        pattern = os.path.join(manifest['out'], '*.fastq.gz')
+    elif step.endswith('_merge'):
+        pattern = os.path.join(bl, 'primer_removal', 'output', '*.fastq.gz')
+    elif step == 'dada2_sample_inference':
+        pattern = os.path.join(bl, 'merge', 'output', '*.extended*')
+    else:
+        pattern = os.path.join(bl, 'DADA2', 'benchmark.rds')
+    return sum(os.path.getsize(f) for f in glob.glob(pattern))
+
+
+def run_module(step, params, log_dir, python):
+    """Run one module as Ansible would and return (result, seconds, peak
+    RSS in KB). The RSS is the largest of the module and the tools it ran."""
+    args_path = os.path.join(log_dir, '%s.json' % step)
+    with open(args_path, 'w') as f:
+        json.dump(dict(ANSIBLE_MODULE_ARGS=params), f, indent=2)
+    out_path = os.path.join(log_dir, '%s.out' % step)
+    start = time.time()
+    with open(out_path, 'w') as out:
+        proc = subprocess.Popen([python, os.path.join(REPO, 'modules', '%s.py' % step), args_path],
+            stdout=out, stderr=subprocess.STDOUT)
+        pid, status, usage = os.wait4(proc.pid, 0)
+    seconds = time.time() - start
+    with open(out_path) as f:
+        text = f.read()
+    result = None
+    for line in reversed(text.splitlines()):
+        if line.startswith('{'):
+            try:
+                result = json.loads(line)
+                break
+            except ValueError:
+                continue
+    if result is None:
+        result = dict(failed=True, msg=text[-2000:])
+    if status != 0 or str(result.get('rc', '0')) not in ('0', ''):
+        result['failed'] = True
+    return result, seconds, usage.ru_maxrss
+
+
+def benchmark_scale(n_samples, n_reads, args, executables):
+    manifest = dataset(args.work_dir, n_samples, n_reads, args)
+    base_dir = os.path.join(args.work_dir, 'run', '%dx%d' % (n_samples, n_reads))
+    bl = layout(base_dir)
+    pairs = n_samples * n_reads
+    rows = []
+    done = []
+    for step in args.steps:
+        if not executables.get(TOOLS[step]):
+            print('skipping %s: no %s' % (step, TOOLS[step]), file=sys.stderr)
+            continue
+        params = module_args(step, base_dir, manifest, executables[TOOLS[step]], done, args)
+        size = input_bytes(step, bl, manifest, done)
+        result, seconds, rss = run_module(step, params, bl, args.python)
+        rows.append(dict(scale='%dx%d' % (n_samples, n_reads), samples=n_samples, reads=n_reads, step=step, bytes=size,
+            seconds=round(seconds, 3), reads_per_sec=round(pairs / seconds, 1) if seconds else None,
+            peak_rss_mb=round(rss / 1024.0, 1), failed=bool(result.get('failed')),
+            msg=result.get('msg') if result.get('failed') else None))
+        if result.get('failed'):
+            msg = (result.get('msg') or result.get('err') or '').strip().splitlines()
+            print('%s failed at %dx%d: %s (see %s/%s.out)' % (step, n_samples, n_reads, msg[-1] if msg else '',
+                bl, step), file=sys.stderr)
+            break
+        done.append(step)
+    if rows:
+        seconds = sum(r['seconds'] for r in rows)
+        rows.append(dict(scale=rows[0]['scale'], samples=n_samples, reads=n_reads, step='chain', bytes=rows[0]['bytes'],
+            seconds=round(seconds, 3), reads_per_sec=round(pairs / seconds, 1) if seconds else None,
+            peak_rss_mb=max(r['peak_rss_mb'] for r in rows), failed=any(r['failed'] for r in rows), msg=None,
+            steps=[r['step'] for r in rows]))
+    return rows
+
+
+def host_info(args, executables):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO,
+            stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(date=datetime.datetime.now().isoformat(), host=socket.gethostname(), platform=platform.platform(),
+        cpus=multiprocessing.cpu_count(), python=platform.python_version(), commit=commit,
+        tools=executables, seed=args.seed, threads=args.threads, ledger=args.ledger,
+        read_length=args.read_length, overlap=args.overlap)
+
+
+def print_table(rows, baseline=None):
+    old = {}
+    for r in (baseline or {}).get('results', []):
+        old[(r['scale'], r['step'])] = r
+    print('%-12s %-24s %10s %12s %12s%s' % ('scale', 'step', 'seconds', 'reads/sec', 'peak RSS MB',
+        '  vs baseline' if baseline else ''))
+    for r in rows:
+        change = ''
+        o = old.get((r['scale'], r['step']))
+        # A chain is only comparable to one of the same steps.
+        if o and o['seconds'] and not r['failed'] and o.get('steps') == r.get('steps'):
+            change = '  %+.1f%% time, %+.1f%% RSS' % (100.0 * (r['seconds'] / o['seconds'] - 1),
+                100.0 * (r['peak_rss_mb'] / o['peak_rss_mb'] - 1) if o['peak_rss_mb'] else 0)
+        print('%-12s %-24s %10.2f %12s %12s%s%s' % (r['scale'], r['step'], r['seconds'], r['reads_per_sec'],
+            r['peak_rss_mb'], '  FAILED' if r['failed'] else '', change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--work-dir', default='pipeline_benchmark', help='scratch directory')
+    parser.add_argument('--scales', default='10x10k,100x10k,1000x1k', help='SAMPLESxREAD_PAIRS, comma-separated')
+    parser.add_argument('--steps', default=','.join(STEPS), help='modules to run, in chain order')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--read-length', type=int, default=150)
+    parser.add_argument('--overlap', type=int, default=60)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--ledger', action='store_true', help='run the commands through the run ledger')
+    parser.add_argument('--tools', default=os.path.join(HERE, 'fake_tools'),
+        help="directory of the tool binaries, '' for PATH")
+    parser.add_argument('--training-set', default=None, help='DADA2 training set for real tools')
+    parser.add_argument('--python', default=sys.executable, help='interpreter to run the modules with')
+    parser.add_argument('--report', default=None, help='where to write the report (default WORK_DIR/report.json)')
+    parser.add_argument('--compare', default=None, help='an earlier report to compare against')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    args.work_dir = os.path.abspath(args.work_dir)
+    if not os.path.isdir(args.work_dir):
+        os.makedirs(args.work_dir)
+    args.steps = [s for s in STEPS if s in args.steps.split(',')]
+    executables = {}
+    for name in set(TOOLS.values()):
+        path = os.path.join(args.tools, name) if args.tools else which(name)
+        executables[name] = os.path.abspath(path) if path and os.path.exists(path) else None
+    install_utils()
+
+    rows = []
+    for n_samples, n_reads in parse_scales(args.scales):
+        rows.extend(benchmark_scale(n_samples, n_reads, args, executables))
+    report = dict(meta=host_info(args, executables), results=rows)
+    path = args.report or os.path.join(args.work_dir, 'report.json')
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+        return
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_table(rows, baseline)
+    print('report: %s' % path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+# Copyright: (c) 2019, Tanner Dowhy <tanner.dowhy@usask.ca>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+"""Write a seeded synthetic paired-end amplicon dataset: a community of
+related ASVs, per-sample abundances, primers (with their degenerate bases
+resolved per read) at the start of both mates, a chosen R1/R2 overlap,
+substitution errors drawn from a falling quality profile and a fraction of
+chimeric reads. The same seed always gives the same files.
+
+    python benchmarks/synthetic.py --out reads/ --samples 10 --reads 10000
+
+Next to the FASTQ files go manifest.json (the parameters), asvs.fasta (the
+true ASVs) and truth.tsv (reads per sample and ASV, chimeras as 'chimera').
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import gzip
+import json
+import os
+
+import numpy as np
+
+# 515F/806R, the EMP V4 primers.
+PRIMER_F = 'GTGYCAGCMGCCGCGGTAA'
+PRIMER_R = 'GGACTACNVGGGTWTCTAAT'
+
+BASES = np.array(list(b'ACGT'), dtype=np.uint8)
+IUPAC = {'A': 'A', 'C': 'C', 'G': 'G', 'T': 'T', 'R': 'AG', 'Y': 'CT', 'S': 'CG', 'W': 'AT',
+    'K': 'GT', 'M': 'AC', 'B': 'CGT', 'D': 'AGT', 'H': 'ACT', 'V': 'ACG', 'N': 'ACGT'}
+
+
+def codes(seq):
+    """Return a sequence as base codes 0-3 (A, C, G, T)."""
+    return np.array(['ACGT'.index(c) for c in seq], dtype=np.uint8)
+
+
+def revcomp(a):
+    # With A, C, G, T as 0-3 the complement of x is 3 - x.
+    return 3 - a[..., ::-1]
+
+
+def community(rng, n_asvs, length, divergence):
+    """Return n_asvs sequences that differ from a common root at about
+    divergence of their positions, so chimeras between them are
+    plausible."""
+    root = rng.randint(4, size=length).astype(np.uint8)
+    asvs = np.tile(root, (n_asvs, 1))
+    mutate = rng.random_sample(asvs.shape) < divergence
+    asvs[mutate] = (asvs[mutate] + rng.randint(1, 4, size=mutate.sum())) % 4
+    return asvs
+
+
+def primer_reads(rng, primer, n):
+    """Return n copies of a primer with each degenerate base resolved at
+    random, as cutadapt would see them in real reads."""
+    out = np.empty((n, len(primer)), dtype=np.uint8)
+    for j, c in enumerate(primer):
+        options = codes(IUPAC[c])
+        out[:, j] = options[rng.randint(len(options), size=n)]
+    return out
+
+
+def qualities(rng, n, length, q_start, q_end):
+    """Phred scores that fall from q_start to q_end along the read, with
+    per-base noise."""
+    pos = np.arange(length) / max(length - 1, 1)
+    curve = q_start - (q_start - q_end) * pos ** 2
+    q = curve + rng.normal(0, 2, size=(n, length))
+    return np.clip(np.rint(q), 2, 41).astype(np.uint8)
+
+
+def add_errors(rng, reads, quals, error_scale):
+    """Substitute bases with the probability their quality implies."""
+    p = np.power(10.0, -quals.astype(float) / 10.0) * error_scale
+    err = rng.random_sample(reads.shape) < p
+    reads[err] = (reads[err] + rng.randint(1, 4, size=err.sum())) % 4
+    return int(err.sum())
+
+
+def write_fastq(path, name, reads, quals, mate):
+    seqs = BASES[reads]
+    phred = (quals + 33).astype(np.uint8)
+    n, length = reads.shape
+    # Every record but the header has the same length, so the sequence,
+    # separator and quality lines are laid out as rows of one array.
+    body = np.empty((n, 2 * length + 4), dtype=np.uint8)
+    body[:, :length] = seqs
+    body[:, length:length + 3] = np.frombuffer(b'\n+\n', dtype=np.uint8)
+    body[:, length + 3:-1] = phred
+    body[:, -1] = ord('\n')
+    rows = body.tobytes()
+    width = body.shape[1]
+    prefix = name.encode()
+    # mtime=0 keeps the files byte-identical between runs of one seed.
+    with gzip.GzipFile(path, 'wb', compresslevel=1, mtime=0) as f:
+        f.write(b''.join(b'@%s:%d %d:N:0:1\n%s' % (prefix, i, mate, rows[i * width:(i + 1) * width])
+            for i in range(n)))
+
+
+def sample_reads(rng, asvs, n_reads, args):
+    """Draw the templates of one sample and return (templates, counts),
+    counts being reads per ASV index, with chimeras under 'chimera'."""
+    n_asvs, length = asvs.shape
+    present = rng.choice(n_asvs, size=min(args.asvs_per_sample, n_asvs), replace=False)
+    weights = rng.lognormal(0, 1.5, size=len(present))
+    picks = present[rng.choice(len(present), size=n_reads, p=weights / weights.sum())]
+    templates = asvs[picks]
+    chimeric = rng.random_sample(n_reads) < args.chimera_fraction
+    n_chim = int(chimeric.sum())
+    if n_chim and len(present) > 1:
+        # Each chimera joins the start of one parent to the end of another.
+        b = present[rng.randint(len(present), size=n_chim)]
+        breaks = rng.randint(length // 4, 3 * length // 4, size=n_chim)
+        tail = np.arange(length) >= breaks[:, None]
+        templates[chimeric] = np.where(tail, asvs[b], templates[chimeric])
+    else:
+        chimeric[:] = False
+    counts = {}
+    for i in picks[~chimeric]:
+        counts[int(i)] = counts.get(int(i), 0) + 1
+    counts['chimera'] = int(chimeric.sum())
+    return templates, counts
+
+
+def generate(args):
+    """Write the dataset described by args and return its manifest."""
+    if not os.path.isdir(args.out):
+        os.makedirs(args.out)
+    amplicon_len = 2 * args.read_length - args.overlap - len(args.primer_f) - len(args.primer_r)
+    if amplicon_len < 20:
+        raise SystemExit('--overlap %d leaves no amplicon between the primers' % args.overlap)
+    rng = np.random.RandomState(args.seed)
+    asvs = community(rng, args.asvs, amplicon_len, args.divergence)
+    with open(os.path.join(args.out, 'asvs.fasta'), 'w') as f:
+        for i, a in enumerate(asvs):
+            f.write('>asv%d\n%s\n' % (i, BASES[a].tobytes().decode()))
+    errors = 0
+    truth = open(os.path.join(args.out, 'truth.tsv'), 'w')
+    truth.write('sample\tasv\treads\n')
+    for s in range(args.samples):
+        # One stream per sample, so any sample can be regenerated alone.
+        srng = np.random.RandomState([args.seed, s])
+        name = 'S%04d' % (s + 1)
+        templates, counts = sample_reads(srng, asvs, args.reads, args)
+        fwd = primer_reads(srng, args.primer_f, args.reads)
+        rev = revcomp(primer_reads(srng, args.primer_r, args.reads))
+        full = np.hstack([fwd, templates, rev])
+        for mate, reads in ((1, full[:, :args.read_length]), (2, revcomp(full)[:, :args.read_length])):
+            reads = np.ascontiguousarray(reads)
+            quals = qualities(srng, args.reads, args.read_length, args.q_start, args.q_end - 5 * (mate - 1))
+            errors += add_errors(srng, reads, quals, args.error_scale)
+            write_fastq(os.path.join(args.out, '%s_S%d_L001_R%d_001.fastq.gz' % (name, s + 1, mate)),
+                name, reads, quals, mate)
+        for asv in sorted(counts, key=str):
+            truth.write('%s\t%s\t%d\n' % (name, asv if asv == 'chimera' else 'asv%d' % asv, counts[asv]))
+    truth.close()
+    manifest = dict(vars(args), out=os.path.abspath(args.out), amplicon_length=amplicon_len,
+        template_length=amplicon_len + len(args.primer_f) + len(args.primer_r), substitutions=errors)
+    with open(os.path.join(args.out, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def parser():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--out', required=True, help='directory to write to')
+    p.add_argument('--samples', type=int, default=10)
+    p.add_argument('--reads', type=int, default=10000, help='read pairs per sample')
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--read-length', type=int, default=150)
+    p.add_argument('--overlap', type=int, default=60, help='bases shared by R1 and R2')
+    p.add_argument('--primer-f', default=PRIMER_F)
+    p.add_argument('--primer-r', default=PRIMER_R)
+    p.add_argument('--asvs', type=int, default=200, help='ASVs in the community')
+    p.add_argument('--asvs-per-sample', type=int, default=40)
+    p.add_argument('--divergence', type=float, default=0.08, help='fraction of positions where ASVs differ')
+    p.add_argument('--chimera-fraction', type=float, default=0.03)
+    p.add_argument('--q-start', type=float, default=38)
+    p.add_argument('--q-end', type=float, default=25)
+    p.add_argument('--error-scale', type=float, default=1.0, help='multiplies the error rate the qualities imply')
+    return p
+
+
+def main():
+    manifest = generate(parser().parse_args())
+    print('%d samples x %d read pairs, %d bp amplicon, %d substitutions, in %s' % (manifest['samples'],
+        manifest['reads'], manifest['amplicon_length'], manifest['substitutions'], manifest['out']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/python
+
+# Copyright: (c) 2019, Tanner Dowhy <tanner.dowhy@usask.ca>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt
+
+"""Pilot runs on a small random subset of the reads. subset() draws N read
+pairs from every sample by seeded reservoir sampling in one pass over its
+files, into .biolighthouse/pilot/input. The pilot area
+(.biolighthouse/pilot) is laid out like a base_dir, with the software,
+conda environments and R scripts of the real one linked in, so a module
+given pilot only has its base_dir and input paths moved there by apply()
+and otherwise runs as usual.
+"""
+
+import glob
+import gzip
+import itertools
+import json
+import math
+import os
+import random
+from collections import deque
+
+WORK_DIRS = ('primer_removal/output', 'primer_removal/reports', 'merge/output', 'merge/reports', 'DADA2')
+# Shared with the real work area rather than copied.
+SHARED = ('software', 'conda')
+PATH_PARAMS = ('input_files', 'reads', 'input_rds', 'input_samples', 'quality_profile')
+
+def pilot_base(base_dir):
+    return '%s/.biolighthouse/pilot' % base_dir
+
+def input_dir(base_dir):
+    return '%s/input' % pilot_base(base_dir)
+
+def manifest_path(base_dir):
+    return '%s/pilot.json' % pilot_base(base_dir)
+
+def file_key(path):
+    st = os.stat(path)
+    return [st.st_size, int(st.st_mtime)]
+
+def open_fastq(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def skip(f, records):
+    """Skip up to records records of f and return how many there were."""
+    last = deque(enumerate(itertools.islice(f, 4 * records), 1), maxlen=1)
+    return last[0][0] // 4 if last else 0
+
+def uniform(rng):
+    # In (0, 1], so its log is defined.
+    return 1.0 - rng.random()
+
+def reservoir(files, n, rng):
+    """Return (reads, sample) for one pass over files read side by side
+    (the mates of a sample, or one file): the number of records read and n
+    of them drawn uniformly, in file order, as (index, record of each
+    file...). Algorithm L: the gaps between replacements are drawn
+    directly, so skipped reads are only read past."""
+    def take():
+        records = [list(itertools.islice(f, 4)) for f in files]
+        return records if all(len(r) == 4 for r in records) else None
+    sample = []
+    for i in range(n):
+        records = take()
+        if records is None:
+            return i, sample
+        sample.append(tuple([i] + records))
+    if not n:
+        return 0, sample
+    reads = n
+    w = math.exp(math.log(uniform(rng)) / n)
+    while True:
+        gap = int(math.floor(math.log(uniform(rng)) / math.log(1 - w))) if w < 1 else 0
+        skipped = skip(files[0], gap)
+        for f in files[1:]:
+            deque(itertools.islice(f, 4 * skipped), maxlen=0)
+        reads += skipped
+        if skipped < gap:
+            break
+        records = take()
+        if records is None:
+            break
+        sample[rng.randrange(n)] = tuple([reads] + records)
+        reads += 1
+        w *= math.exp(math.log(uniform(rng)) / n)
+    return reads, sorted(sample)
+
+def subset_sample(sample, out_dir, n, seed):
+    """Draw n pairs of a sample (as from samples.discover_samples) into
+    out_dir and return the pairs read and kept."""
+    rng = random.Random('%d:%s' % (seed, sample['name']))
+    f1 = [open_fastq(p) for p in sample['r1']]
+    f2 = [open_fastq(p) for p in sample['r2']]
+    try:
+        reads, drawn = reservoir([itertools.chain(*f1), itertools.chain(*f2)], n, rng)
+    finally:
+        for f in f1 + f2:
+            f.close()
+    stem_r2 = sample['stem'].replace('_R1', '_R2')
+    for stem, mate in ((sample['stem'], 1), (stem_r2, 2)):
+        tmp = '%s/%s.fastq.gz.tmp' % (out_dir, stem)
+        with gzip.open(tmp, 'wb') as out:
+            for record in drawn:
+                out.writelines(record[mate])
+        os.rename(tmp, '%s/%s.fastq.gz' % (out_dir, stem))
+    return reads, len(drawn)
+
+def load_manifest(base_dir):
+    path = manifest_path(base_dir)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(base_dir, manifest):
+    with open(manifest_path(base_dir), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+def prepare_area(base_dir):
+    """Create the pilot work area and link the shared parts of the real
+    one into it."""
+    real = '%s/.biolighthouse' % base_dir
+    work = '%s/.biolighthouse' % pilot_base(base_dir)
+    for d in ['%s/%s' % (work, d) for d in WORK_DIRS] + [input_dir(base_dir)]:
+        if not os.path.isdir(d):
+            os.makedirs(d)
+    for name in SHARED:
+        if os.path.isdir('%s/%s' % (real, name)) and not os.path.lexists('%s/%s' % (work, name)):
+            os.symlink('%s/%s' % (real, name), '%s/%s' % (work, name))
+    for script in glob.glob('%s/DADA2/*.R' % real):
+        link = '%s/DADA2/%s' % (work, os.path.basename(script))
+        if not os.path.lexists(link):
+            os.symlink(script, link)
+
+def subset(base_dir, source, found, n, seed, force=False):
+    """Draw n pairs from each sample of source into the pilot input,
+    skipping samples drawn before with the same n and seed from unchanged
+    files. Return one dict per sample with the pairs read and kept."""
+    prepare_area(base_dir)
+    old = load_manifest(base_dir) or {}
+    same = not force and old.get('reads') == n and old.get('seed') == seed and old.get('source') == source
+    manifest = dict(source=source, reads=n, seed=seed, samples={})
+    results = []
+    for sample in found:
+        keys = [file_key(p) for p in sample['r1'] + sample['r2']]
+        prev = old.get('samples', {}).get(sample['name']) if same else None
+        if prev and prev['keys'] == keys and os.path.isfile('%s/%s.fastq.gz' % (input_dir(base_dir), sample['stem'])):
+            entry = dict(prev, reused=True)
+        else:
+            reads, kept = subset_sample(sample, input_dir(base_dir), n, seed)
+            entry = dict(keys=keys, reads=reads, kept=kept, reused=False)
+        manifest['samples'][sample['name']] = dict((k, v) for k, v in entry.items() if k != 'reused')
+        results.append(dict(sample=sample['name'], reads=entry['reads'], kept=entry['kept'], reused=entry['reused']))
+    save_manifest(base_dir, manifest)
+    return results
+
+def apply(module, result):
+    """Point a module given pilot at the pilot area: base_dir becomes the
+    pilot area, paths inside the real work area move to the same place in
+    it, and the input the subset was drawn from becomes the subset."""
+    if not module.params.get('pilot'):
+        return
+    base_dir = module.params['base_dir']
+    if not base_dir:
+        module.fail_json(msg='pilot needs base_dir.')
+    manifest = load_manifest(base_dir)
+    if manifest is None:
+        module.fail_json(msg='No pilot subset in %s; run pilot_subset first.' % pilot_base(base_dir))
+    real = '%s/.biolighthouse/' % base_dir.rstrip('/')
+
+    def move(path):
+        full = os.path.abspath(os.path.expanduser(path))
+        if full.rstrip('/') == manifest['source'].rstrip('/'):
+            return input_dir(base_dir)
+        if full.startswith(real) and not full.startswith('%s/' % pilot_base(base_dir)):
+            return '%s/.biolighthouse/%s' % (pilot_base(base_dir), full[len(real):])
+        return path
+
+    for name in PATH_PARAMS:
+        value = module.params.get(name)
+        if isinstance(value, list):
+            module.params[name] = [move(v) for v in value]
+        elif value:
+            module.params[name] = move(value)
+    module.params['base_dir'] = pilot_base(base_dir)
+    result['pilot'] = module.params['base_dir']
@@ -0,0 +1,262 @@
+#!/usr/bin/python
+
+# Copyright: (c) 2019, Tanner Dowhy <tanner.dowhy@usask.ca>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt
+
+"""Checks of paired FASTQ input before the expensive steps: gzip
+integrity, record structure, equal read counts and matching read IDs
+between mates. Each file pair is streamed once, a batch of records at a
+time, so memory does not grow with the file.
+
+The results go to .biolighthouse/preflight/counts.json keyed by file, with
+the size and modification time they were taken at, so later runs skip
+unchanged files and later steps can take the read counts from there.
+"""
+
+import gzip
+import itertools
+import json
+import multiprocessing
+import os
+import time
+import zlib
+try:
+    import queue as queue_errors
+except ImportError:
+    import Queue as queue_errors
+
+BATCH = 50000
+
+# Seconds between checks that the workers are still alive while waiting
+# for results.
+POLL = 5
+
+def counts_path(base_dir):
+    return '%s/.biolighthouse/preflight/counts.json' % base_dir
+
+def file_key(path):
+    st = os.stat(path)
+    return [st.st_size, int(st.st_mtime)]
+
+def open_fastq(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def read_id(header):
+    # @ID[/1|/2] [comment]
+    name = header[1:].split(None, 1)[0] if len(header) > 1 else b''
+    if name[-2:] in (b'/1', b'/2'):
+        name = name[:-2]
+    return name
+
+def check_batch(lines, first):
+    """Return an error for the first malformed record of a batch of
+    lines, numbering records from first, or None."""
+    if len(lines) % 4:
+        return 'record %d: file ends inside a record' % (first + len(lines) // 4)
+    heads, seqs, pluses, quals = lines[0::4], lines[1::4], lines[2::4], lines[3::4]
+    for i, (h, p) in enumerate(zip(heads, pluses)):
+        if h[:1] != b'@' or p[:1] != b'+':
+            return 'record %d: expected @ header and + separator lines' % (first + i)
+    if list(map(len, seqs)) != list(map(len, quals)):
+        for i, (s, q) in enumerate(zip(seqs, quals)):
+            if len(s) != len(q):
+                return 'record %d: sequence and quality lengths differ' % (first + i)
+    return None
+
+def validate_pair(r1, r2):
+    """Stream both mates together and return a dict with the read count
+    of each and the errors found. The first error in a mate stops it."""
+    result = dict(r1=r1, r2=r2, reads_r1=0, reads_r2=0, errors=[])
+    if not os.path.isfile(r2):
+        result['errors'].append('%s: mate file is missing' % r2)
+        return result
+    start = time.time()
+    f1 = open_fastq(r1)
+    f2 = open_fastq(r2)
+    try:
+        while True:
+            try:
+                b1 = list(itertools.islice(f1, 4 * BATCH))
+            except (IOError, OSError, EOFError, zlib.error) as e:
+                result['errors'].append('%s: not a complete gzip file (%s)' % (r1, e))
+                break
+            try:
+                b2 = list(itertools.islice(f2, 4 * BATCH))
+            except (IOError, OSError, EOFError, zlib.error) as e:
+                result['errors'].append('%s: not a complete gzip file (%s)' % (r2, e))
+                break
+            if not b1 and not b2:
+                break
+            for path, lines, key in ((r1, b1, 'reads_r1'), (r2, b2, 'reads_r2')):
+                error = check_batch(lines, result[key] + 1)
+                if error:
+                    result['errors'].append('%s: %s' % (path, error))
+                result[key] += len(lines) // 4
+            if result['errors']:
+                break
+            if len(b1) != len(b2):
+                continue
+            ids = list(map(read_id, b1[0::4]))
+            if ids != list(map(read_id, b2[0::4])):
+                for i, (a, b) in enumerate(zip(ids, map(read_id, b2[0::4]))):
+                    if a != b:
+                        result['errors'].append('record %d: read IDs differ between mates (%s, %s)'
+                            % (result['reads_r1'] - len(ids) + i + 1, a.decode('ascii', 'replace'),
+                            b.decode('ascii', 'replace')))
+                        break
+                break
+        if not result['errors'] and result['reads_r1'] != result['reads_r2']:
+            result['errors'].append('read counts differ: %d in R1, %d in R2' % (result['reads_r1'], result['reads_r2']))
+    finally:
+        f1.close()
+        f2.close()
+    result['seconds'] = round(time.time() - start, 3)
+    return result
+
+def failed_pair(r1, r2, error, crashed=False):
+    """A result for a pair that could not be checked. crashed ones are not
+    stored with their file keys, so the next run checks them again."""
+    return dict(r1=r1, r2=r2, reads_r1=0, reads_r2=0, errors=['%s: %s' % (r1, error)], crashed=crashed)
+
+def worker(slot, current, jobs, results):
+    """Validate (index, r1, r2) jobs until None. The index of the pair being
+    checked is kept in current[slot], shared memory that is written at
+    once, so a worker that dies can be blamed on its pair."""
+    for i, r1, r2 in iter(jobs.get, None):
+        current[slot] = i
+        try:
+            results.put(validate_pair(r1, r2))
+        except Exception as e:
+            results.put(failed_pair(r1, r2, e))
+
+def collect(workers, current, results, jobs):
+    """Gather the result of every pair in jobs from the workers. A worker
+    that dies (e.g. killed for running out of memory) fails the pair it
+    was checking, and once none is left the pairs not yet checked fail
+    too, so this returns instead of waiting forever."""
+    pending = dict(jobs)
+    done = []
+    def take(result):
+        if result['r1'] in pending:
+            del pending[result['r1']]
+            done.append(result)
+    while pending:
+        try:
+            take(results.get(timeout=POLL))
+            continue
+        except queue_errors.Empty:
+            pass
+        dead = [(slot, w) for slot, w in enumerate(workers) if not w.is_alive()]
+        if not dead:
+            continue
+        # Take what the dead workers sent before they went
+        try:
+            while True:
+                take(results.get_nowait())
+        except queue_errors.Empty:
+            pass
+        for slot, w in dead:
+            if current[slot] >= 0 and jobs[current[slot]][0] in pending:
+                r1, r2 = jobs[current[slot]]
+                del pending[r1]
+                done.append(failed_pair(r1, r2, 'preflight worker exited with code %s' % w.exitcode,
+                    True))
+        if len(dead) == len(workers):
+            for r1 in sorted(pending):
+                done.append(failed_pair(r1, pending[r1], 'not checked, every preflight worker exited', True))
+            pending.clear()
+    return done
+
+def load_counts(base_dir):
+    path = counts_path(base_dir)
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        try:
+            return json.load(f)
+        except ValueError:
+            return {}
+
+def save_counts(base_dir, counts):
+    path = counts_path(base_dir)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    tmp = '%s.tmp' % path
+    with open(tmp, 'w') as f:
+        json.dump(counts, f, indent=1, sort_keys=True)
+    os.rename(tmp, path)
+
+def cached(counts, r1, r2):
+    """The stored result for a pair whose files are unchanged, else None."""
+    entry = counts.get(r1)
+    if not entry or entry.get('r2') != r2 or not os.path.isfile(r2):
+        return None
+    if entry.get('key') != file_key(r1) or entry.get('key_r2') != file_key(r2):
+        return None
+    return entry
+
+def validate(base_dir, found, processes=None, reuse=True):
+    """Validate every lane pair of the samples (as from
+    samples.discover_samples) in a process pool, largest first, and return
+    one dict per sample with its reads, errors and whether it was reused.
+    """
+    counts = load_counts(base_dir) if reuse else {}
+    jobs = []
+    pairs = []
+    for sample in found:
+        for r1, r2 in zip(sample['r1'], sample['r2']):
+            pairs.append((sample, r1, r2))
+            if cached(counts, r1, r2) is None:
+                jobs.append((r1, r2))
+    jobs.sort(key=lambda j: -os.path.getsize(j[0]))
+    if jobs:
+        # Forked workers fed from a queue rather than a Pool: this module is
+        # loaded with imp, so its functions cannot be pickled by name.
+        queue = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+        n = min(processes or multiprocessing.cpu_count(), len(jobs))
+        current = multiprocessing.Array('i', [-1] * n, lock=False)
+        workers = [multiprocessing.Process(target=worker, args=(slot, current, queue, results))
+            for slot in range(n)]
+        for i, (r1, r2) in enumerate(jobs):
+            queue.put((i, r1, r2))
+        for w in workers:
+            queue.put(None)
+            w.start()
+        try:
+            for result in collect(workers, current, results, jobs):
+                # Not saved with the counts, whether or not r2 exists
+                crashed = result.pop('crashed', False)
+                if os.path.isfile(result['r2']) and not crashed:
+                    result['key'] = file_key(result['r1'])
+                    result['key_r2'] = file_key(result['r2'])
+                counts[result['r1']] = result
+        finally:
+            for w in workers:
+                w.join(POLL)
+                if w.is_alive():
+                    w.terminate()
+    save_counts(base_dir, counts)
+    out = {}
+    for sample, r1, r2 in pairs:
+        entry = counts[r1]
+        s = out.setdefault(sample['name'], dict(sample=sample['name'], reads=0, bytes=sample['bytes'],
+            errors=[], reused=True))
+        s['reads'] += entry['reads_r1']
+        s['errors'].extend(entry['errors'])
+        s['reused'] = s['reused'] and (r1, r2) not in jobs
+    return [out[k] for k in sorted(out)]
+
+def sample_reads(base_dir, sample):
+    """The read pairs of a sample from the preflight counts, or None when
+    any of its files is missing from them, changed since or invalid."""
+    counts = load_counts(base_dir)
+    total = 0
+    for r1, r2 in zip(sample['r1'], sample['r2']):
+        entry = cached(counts, r1, r2)
+        if entry is None or entry['errors']:
+            return None
+        total += entry['reads_r1']
+    return total
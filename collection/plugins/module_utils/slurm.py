@@ -3,6 +3,52 @@
 # Copyright: (c) 2019, Tanner Dowhy <tanner.dowhy@usask.ca>
 # GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt
 from os.path import expanduser
+import datetime
+import heapq
+import json
+import math
+import os
+import time as _time
+
+# Smallest per-job request a bin is scaled down to, so that tiny bins
+# (e.g. a handful of negative controls) still get a sane allocation.
+MIN_TIME_MINUTES = 10
+MIN_MEM_MB = 1024
+
+# Seconds between sacct queries when waiting; the interval doubles after
+# every query up to the maximum.
+POLL_INTERVAL = 10
+MAX_POLL_INTERVAL = 300
+
+# Without slurm_spec.max_wait, waiting gives up after this many times the
+# time the jobs asked for (queueing included), and after this many sacct
+# failures in a row.
+WAIT_FACTOR = 4
+MAX_SACCT_ERRORS = 5
+
+# Safety margins applied to fitted requests, and how many past runs of a
+# tool are fitted.
+MEM_MARGIN = 1.5
+TIME_MARGIN = 2.0
+HISTORY_RUNS = 50
+
+# Terminal states worth another try with more memory or time.
+RETRY_STATES = ('OUT_OF_MEMORY', 'TIMEOUT')
+
+# Jobs submitted by this run, by ID: (sbatch command, cwd). Kept so that
+# jobs can be resubmitted when retrying.
+submitted = {}
+
+# The input of the step being submitted (tool, bytes, samples and the
+# bytes of its largest sample) as given to autosize, and the bytes of the
+# samples of each packed bin by job ID, recorded with the measurements of
+# finished jobs.
+sizing = {}
+job_sizes = {}
+
+# Job states that sacct will not change again.
+TERMINAL_STATES = ('COMPLETED', 'FAILED', 'CANCELLED', 'TIMEOUT', 'OUT_OF_MEMORY', 'NODE_FAIL',
+    'PREEMPTED', 'BOOT_FAIL', 'DEADLINE')
 
 def slurm_arg_spec():
     return dict(
@@ -13,19 +59,600 @@ def slurm_arg_spec():
         mem=dict(type='str', defualt=None, required=False),
         tasks_per_node=dict(type='int', default=None, required=False),
         # array=dict(type='str', default=None, required=False),
+        num_jobs=dict(type='int', default=None, required=False),
+        bytes_per_job=dict(type='int', default=None, required=False),
+        poll_interval=dict(type='int', default=POLL_INTERVAL, required=False),
+        max_poll_interval=dict(type='int', default=MAX_POLL_INTERVAL, required=False),
+        max_wait=dict(type='int', default=None, required=False),
+        retries=dict(type='int', default=0, required=False),
+        mem_factor=dict(type='float', default=2.0, required=False),
+        time_factor=dict(type='float', default=2.0, required=False),
+        max_mem=dict(type='str', default=None, required=False),
+        max_time=dict(type='str', default=None, required=False),
+        auto_size=dict(type='bool', default=False, required=False),
         cmd=dict(type='str', default=None, required=False)
     )
 
-def build_slurm_cmd(module):
-    cmd = ['sbatch', '--dependency=singleton', '--nodes=%s' % module.params['slurm_spec']['num_nodes'],'--account=%s' % module.params['slurm_spec']['account'], '--time=%s' % module.params['slurm_spec']['time']]
+def build_slurm_cmd(module, time=None, mem=None, job_name=None, dependency='singleton'):
+    spec = module.params['slurm_spec']
+    cmd = ['sbatch']
+    if dependency is not None:
+        cmd.extend(['--dependency=%s' % dependency])
+    cmd.extend(['--nodes=%s' % spec['num_nodes'],'--account=%s' % spec['account'], '--time=%s' % (time or spec['time'])])
     # if module.params['slurm_spec']['array'] is not None:
     #     cmd += " --array=%s" % (module.params['slurm_spec']['array'])
-    if module.params['slurm_spec']['job_name'] is not None:
-        cmd.extend(['--job-name=%s' % module.params['slurm_spec']['job_name']])
+    if job_name is not None:
+        cmd.extend(['--job-name=%s' % job_name])
+    elif spec['job_name'] is not None:
+        cmd.extend(['--job-name=%s' % spec['job_name']])
     # if module.params['slurm_spec']['num_nodes'] is not None:
     #     cmd += " --nodes=%s" % (module.params['slurm_spec']['num_nodes'])
-    if module.params['slurm_spec']['mem'] is not None:
-        cmd.extend(['--mem=%s' % module.params['slurm_spec']['mem']])
-    if module.params['slurm_spec']['tasks_per_node'] is not None:
-        cmd.extend(['--tasks-per-node=%s' % module.params['slurm_spec']['tasks_per_node']])
+    if mem is not None:
+        cmd.extend(['--mem=%s' % mem])
+    elif spec['mem'] is not None:
+        cmd.extend(['--mem=%s' % spec['mem']])
+    if spec['tasks_per_node'] is not None:
+        cmd.extend(['--tasks-per-node=%s' % spec['tasks_per_node']])
+    return cmd
+
+def packing_requested(module):
+    spec = module.params['slurm_spec'] or {}
+    return bool(spec.get('num_jobs') or spec.get('bytes_per_job'))
+
+def parse_mem(mem):
+    """Convert a SLURM memory string (e.g. 500M, 48G) to megabytes."""
+    units = {'K': 1.0 / 1024, 'M': 1, 'G': 1024, 'T': 1024 * 1024}
+    mem = str(mem).strip().upper()
+    if mem[-1] in units:
+        return int(math.ceil(float(mem[:-1]) * units[mem[-1]]))
+    return int(mem)
+
+def format_mem(mb):
+    if mb % 1024 == 0:
+        return '%dG' % (mb // 1024)
+    return '%dM' % mb
+
+def parse_time(time):
+    """Convert a SLURM time string to minutes.
+    Accepts minutes, minutes:seconds, hours:minutes:seconds, days-hours,
+    days-hours:minutes and days-hours:minutes:seconds.
+    """
+    days = 0
+    time = str(time).strip()
+    if '-' in time:
+        d, time = time.split('-', 1)
+        days = int(d)
+        parts = [int(p) for p in time.split(':')]
+        parts += [0] * (3 - len(parts))
+        hours, minutes, seconds = parts
+    else:
+        parts = [int(p) for p in time.split(':')]
+        if len(parts) == 1:
+            hours, minutes, seconds = 0, parts[0], 0
+        elif len(parts) == 2:
+            hours, minutes, seconds = 0, parts[0], parts[1]
+        else:
+            hours, minutes, seconds = parts
+    return days * 24 * 60 + hours * 60 + minutes + int(math.ceil(seconds / 60.0))
+
+def format_time(minutes):
+    days, rem = divmod(int(minutes), 24 * 60)
+    hours, minutes = divmod(rem, 60)
+    if days:
+        return '%d-%02d:%02d:00' % (days, hours, minutes)
+    return '%02d:%02d:00' % (hours, minutes)
+
+def pack_samples(samples, num_jobs=None, bytes_per_job=None):
+    """Group (name, size) pairs into bins of roughly equal total size.
+    Either a fixed number of bins or a target number of bytes per bin
+    may be given. Samples are placed largest first onto the currently
+    lightest bin, which keeps the heaviest bin close to the mean.
+    """
+    if not samples:
+        return []
+    total = sum(size for name, size in samples)
+    if bytes_per_job:
+        num_jobs = int(math.ceil(total / float(bytes_per_job)))
+    num_jobs = max(1, min(num_jobs or 1, len(samples)))
+    bins = [dict(samples=[], bytes=0) for i in range(num_jobs)]
+    heap = [(0, i) for i in range(num_jobs)]
+    for name, size in sorted(samples, key=lambda s: s[1], reverse=True):
+        load, i = heapq.heappop(heap)
+        bins[i]['samples'].append(name)
+        bins[i]['bytes'] += size
+        heapq.heappush(heap, (load + size, i))
+    return [b for b in bins if b['samples']]
+
+def scale_resources(module, bin_bytes, max_bytes):
+    """Scale the slurm_spec time to a bin; slurm_spec time is taken to be
+    what the largest bin needs. The samples of a bin run one after
+    another, so its peak memory is that of one sample and mem is left as
+    given.
+    """
+    spec = module.params['slurm_spec']
+    frac = float(bin_bytes) / max_bytes if max_bytes else 1.0
+    time = None
+    if spec['time'] is not None:
+        full = parse_time(spec['time'])
+        time = format_time(min(full, max(MIN_TIME_MINUTES, int(math.ceil(full * frac)))))
+    return time, spec.get('mem')
+
+def active_job_ids(module, job_name):
+    if job_name is None:
+        return []
+    rc, out, err = module.run_command(['squeue', '--noheader', '--format=%i', '--name=%s' % job_name])
+    if rc != 0:
+        return []
+    return [j.strip() for j in out.splitlines() if j.strip()]
+
+def submit_bins(module, scripts, cwd):
+    """Submit one job per (script, sample bytes) bin with scaled resources.
+    Bins of a step run side by side but still wait for the previous
+    step; a trailing job carrying the step's job name completes when
+    every bin has succeeded so the next singleton step waits on it.
+    Returns (rc, out, err, cmds, job_ids).
+    """
+    if not scripts:
+        module.fail_json(msg='No samples found to submit in %s.' % cwd)
+    job_name = module.params['slurm_spec']['job_name']
+    previous = active_job_ids(module, job_name)
+    dependency = 'afterok:%s' % ':'.join(previous) if previous else None
+    max_bytes = max(sum(sizes) for s, sizes in scripts)
+    cmds = []
+    ids = []
+    out_all = ''
+    err_all = ''
+    for i, (script, sizes) in enumerate(scripts):
+        time, mem = scale_resources(module, sum(sizes), max_bytes)
+        name = '%s_%d' % (job_name, i) if job_name is not None else None
+        cmd = build_slurm_cmd(module, time=time, mem=mem, job_name=name, dependency=dependency)
+        cmd.extend(['--parsable', script])
+        rc, out, err, job_id = submit(module, cmd, cwd)
+        cmds.append(cmd)
+        out_all += out
+        err_all += err
+        if rc != 0:
+            return rc, out_all, err_all, cmds, ids
+        ids.append(job_id)
+        job_sizes[job_id] = sizes
+    cmd = build_slurm_cmd(module, time=format_time(MIN_TIME_MINUTES), mem=format_mem(MIN_MEM_MB),
+        dependency='afterok:%s' % ':'.join(ids))
+    cmd.extend(['--parsable', '--wrap=true'])
+    rc, out, err, job_id = submit(module, cmd, cwd)
+    cmds.append(cmd)
+    if rc == 0:
+        ids.append(job_id)
+    return rc, out_all + out, err_all + err, cmds, ids
+
+def submit_chain(module, stages, cwd):
+    """Submit (script, report, extra) stages one after the other, each
+    depending on the one before and the first on the step before it
+    (singleton). extra holds further sbatch options, e.g. --array.
+    Returns (rc, out, err, cmds, job_ids)."""
+    cmds = []
+    job_ids = []
+    out_all = ''
+    err_all = ''
+    job_id = None
+    rc = 0
+    for script, report, extra in stages:
+        if job_id is None:
+            cmd = build_slurm_cmd(module)
+        else:
+            cmd = build_slurm_cmd(module, dependency='afterok:%s' % job_id)
+        cmd.extend(extra + ['--output=%s' % report, script])
+        rc, out, err, job_id = submit(module, cmd, cwd)
+        cmds.append(cmd)
+        out_all += out
+        err_all += err
+        if rc != 0:
+            break
+        job_ids.append(job_id)
+    return rc, out_all, err_all, cmds, job_ids
+
+def submit(module, cmd, cwd):
+    """Submit a job and return (rc, out, err, job_id)."""
+    if '--parsable' not in cmd:
+        cmd.insert(-1, '--parsable')
+    rc, out, err = module.run_command(cmd, cwd=cwd)
+    job_id = out.strip().split(';')[0] if rc == 0 else None
+    if job_id is not None:
+        submitted[job_id] = (list(cmd), cwd)
+    return rc, out, err, job_id
+
+def parse_elapsed(elapsed):
+    """Convert a sacct elapsed time ([days-]hours:minutes:seconds) to seconds."""
+    days = 0
+    if '-' in elapsed:
+        d, elapsed = elapsed.split('-', 1)
+        days = int(d)
+    seconds = 0
+    for part in elapsed.split(':'):
+        seconds = seconds * 60 + int(float(part))
+    return days * 24 * 60 * 60 + seconds
+
+def job_states(module, job_ids):
+    """Query sacct once for all of job_ids and return a dict of jobs by id,
+    with array tasks as <id>_<index>. Each holds the state, exit code,
+    elapsed and CPU seconds and the largest MaxRSS of its steps in
+    megabytes. Jobs sacct does not know about yet are missing. Returns None
+    if sacct fails.
+    """
+    rc, out, err = module.run_command(['sacct', '--noheader', '--parsable2', '--jobs=%s' % ','.join(job_ids),
+        '--format=JobID,State,ExitCode,Elapsed,MaxRSS,TotalCPU'])
+    if rc != 0:
+        return None
+    jobs = {}
+    for line in out.splitlines():
+        fields = line.strip().split('|')
+        if len(fields) < 5:
+            continue
+        job_id, state, exit_code, elapsed, max_rss = fields[:5]
+        total_cpu = fields[5] if len(fields) > 5 else ''
+        key = job_id.split('.')[0]
+        job = jobs.setdefault(key, dict(job_id=key, state=None, exit_code=None, elapsed=None, max_rss_mb=None,
+            cpu_seconds=None))
+        if '.' not in job_id:
+            # e.g. "CANCELLED by 1234"
+            job['state'] = state.split()[0] if state else None
+            job['exit_code'] = exit_code
+            job['elapsed'] = parse_elapsed(elapsed) if elapsed else None
+            job['cpu_seconds'] = parse_elapsed(total_cpu) if total_cpu else None
+        if max_rss:
+            job['max_rss_mb'] = max(job['max_rss_mb'] or 0, parse_mem(max_rss))
+    return jobs
+
+def job_tasks(job_id, jobs):
+    return [j for k, j in jobs.items() if k == job_id or k.startswith('%s_' % job_id)]
+
+def jobs_finished(job_ids, jobs):
+    for job_id in job_ids:
+        tasks = job_tasks(job_id, jobs)
+        if not tasks or any(t['state'] not in TERMINAL_STATES for t in tasks):
+            return False
+    return True
+
+def never_satisfied(module, job_ids):
+    """Return the queued jobs among job_ids whose dependencies failed."""
+    rc, out, err = module.run_command(['squeue', '--noheader', '--format=%i|%r', '--jobs=%s' % ','.join(job_ids)])
+    if rc != 0:
+        return []
+    return [line.split('|')[0].strip() for line in out.splitlines() if 'DependencyNeverSatisfied' in line]
+
+def escalate(module, cmd, state, max_rss_mb):
+    """Return cmd with --mem (OUT_OF_MEMORY) or --time (TIMEOUT) multiplied
+    by slurm_spec.mem_factor or time_factor, up to max_mem or max_time.
+    Returns None when the cap is already reached.
+    """
+    spec = module.params['slurm_spec'] or {}
+    if state == 'OUT_OF_MEMORY':
+        key, parse, fmt = '--mem=', parse_mem, format_mem
+        factor, cap = spec.get('mem_factor') or 2.0, spec.get('max_mem')
+        default = max_rss_mb
+    else:
+        key, parse, fmt = '--time=', parse_time, format_time
+        factor, cap = spec.get('time_factor') or 2.0, spec.get('max_time')
+        default = None
+    current = [parse(arg[len(key):]) for arg in cmd if arg.startswith(key) and arg[len(key):] != 'None']
+    old = current[0] if current else default
+    if not old:
+        return None
+    new = int(math.ceil(old * factor))
+    if cap is not None:
+        new = min(new, parse(cap))
+    if new <= old:
+        return None
+    cmd = [arg for arg in cmd if not arg.startswith(key)]
+    cmd.insert(1, key + fmt(new))
     return cmd
+
+def job_completed(job_id, jobs):
+    tasks = job_tasks(job_id, jobs)
+    return bool(tasks) and all(t['state'] == 'COMPLETED' for t in tasks)
+
+def rewrite_dependency(cmd, replaced, jobs):
+    """Point afterok dependencies at the resubmitted jobs and drop the
+    ones that already completed, which SLURM may have forgotten."""
+    out = []
+    for arg in cmd:
+        if arg.startswith('--dependency=afterok:'):
+            ids = [replaced.get(j, j) for j in arg.split(':')[1:]]
+            ids = [j for j in ids if j in replaced.values() or not job_completed(j, jobs)]
+            if not ids:
+                continue
+            arg = '--dependency=afterok:%s' % ':'.join(ids)
+        out.append(arg)
+    return out
+
+def retry_jobs(module, job_ids, jobs, attempts, retries):
+    """Resubmit the jobs in job_ids that ran out of memory or time, with
+    escalated resources and only the failed tasks of an array, as long as
+    slurm_spec.retries allows. Jobs queued behind them would never start,
+    so they are cancelled and resubmitted against the new IDs. Each retry
+    is appended to retries. Returns a dict of old to new job IDs.
+    """
+    spec = module.params['slurm_spec'] or {}
+    replaced = {}
+    for job_id in job_ids:
+        if job_id not in submitted or attempts.get(job_id, 0) >= (spec.get('retries') or 0):
+            continue
+        tasks = job_tasks(job_id, jobs)
+        failed = [t for t in tasks if t['state'] in RETRY_STATES]
+        if not failed or any(t['state'] not in TERMINAL_STATES for t in tasks):
+            continue
+        cmd, cwd = submitted[job_id]
+        for state in sorted(set(t['state'] for t in failed)):
+            cmd = escalate(module, cmd, state, max(t['max_rss_mb'] or 0 for t in failed))
+            if cmd is None:
+                break
+        if cmd is None:
+            continue
+        indices = [t['job_id'].split('_', 1)[1] for t in failed if '_' in t['job_id']]
+        if indices:
+            cmd = ['--array=%s' % ','.join(indices) if arg.startswith('--array=') else arg for arg in cmd]
+        rc, out, err, new_id = submit(module, rewrite_dependency(cmd, replaced, jobs), cwd)
+        if rc != 0:
+            continue
+        replaced[job_id] = new_id
+        attempts[new_id] = attempts.get(job_id, 0) + 1
+        retries.append(dict(job_id=job_id, tasks=[t['job_id'] for t in failed],
+            states=sorted(set(t['state'] for t in failed)), new_job_id=new_id, cmd=submitted[new_id][0]))
+    if not replaced:
+        return replaced
+    for job_id in job_ids:
+        if job_id in replaced or job_id not in submitted:
+            continue
+        cmd, cwd = submitted[job_id]
+        deps = [arg.split(':')[1:] for arg in cmd if arg.startswith('--dependency=afterok:')]
+        if not deps or not set(deps[0]) & set(replaced):
+            continue
+        if not all(t['state'] in ('PENDING', 'CANCELLED') for t in job_tasks(job_id, jobs)):
+            continue
+        module.run_command(['scancel', job_id])
+        rc, out, err, new_id = submit(module, rewrite_dependency(cmd, replaced, jobs), cwd)
+        if rc == 0:
+            replaced[job_id] = new_id
+            attempts[new_id] = attempts.get(job_id, 0)
+    return replaced
+
+def requested_minutes(job_ids):
+    """The --time asked for by the submitted jobs in job_ids, in minutes,
+    or None if any of them has no limit."""
+    total = 0
+    for job_id in job_ids:
+        times = [arg[len('--time='):] for arg in submitted.get(job_id, ([], None))[0] if arg.startswith('--time=')]
+        if not times or times[0] == 'None':
+            return None
+        total += parse_time(times[0])
+    return total
+
+def max_wait_seconds(module, job_ids):
+    """slurm_spec.max_wait in seconds, or by default WAIT_FACTOR times the
+    time limits of job_ids. None means no deadline."""
+    spec = module.params['slurm_spec'] or {}
+    if spec.get('max_wait'):
+        return spec['max_wait'] * 60
+    minutes = requested_minutes(job_ids)
+    return minutes * 60 * WAIT_FACTOR if minutes else None
+
+def wait_for_jobs(module, job_ids, retries=None):
+    """Poll sacct until every job in job_ids, and every task of the arrays
+    among them, has finished, then return job_states. There is one query
+    per round however many jobs there are, and the interval backs off from
+    slurm_spec.poll_interval to max_poll_interval. Jobs that ran out of
+    memory or time are retried (see retry_jobs), and the retries are added
+    to the retries list. Jobs left waiting on a failed dependency would
+    never start, so they are cancelled. The task fails once max_wait_seconds
+    have passed, extended by the time of every retry, or after
+    MAX_SACCT_ERRORS sacct failures in a row.
+    """
+    spec = module.params['slurm_spec'] or {}
+    interval = spec.get('poll_interval') or POLL_INTERVAL
+    max_interval = spec.get('max_poll_interval') or MAX_POLL_INTERVAL
+    attempts = {}
+    if retries is None:
+        retries = []
+    job_ids = list(job_ids)
+    max_wait = max_wait_seconds(module, job_ids)
+    deadline = _time.time() + max_wait if max_wait else None
+    errors = 0
+    while True:
+        jobs = job_states(module, job_ids)
+        if jobs is None:
+            errors += 1
+            if errors >= MAX_SACCT_ERRORS:
+                module.fail_json(msg='sacct failed %d times in a row while waiting for jobs %s' % (errors,
+                    ', '.join(job_ids)), job_ids=job_ids, retries=retries)
+            jobs = {}
+        else:
+            errors = 0
+        replaced = retry_jobs(module, job_ids, jobs, attempts, retries)
+        if replaced:
+            job_ids = [replaced.get(j, j) for j in job_ids]
+            if deadline is not None and not spec.get('max_wait'):
+                deadline += (requested_minutes(replaced.values()) or 0) * 60 * WAIT_FACTOR
+            interval = spec.get('poll_interval') or POLL_INTERVAL
+            continue
+        if jobs_finished(job_ids, jobs):
+            return jobs
+        if deadline is not None and _time.time() >= deadline:
+            module.fail_json(msg='Gave up waiting for jobs %s after %d minutes' % (', '.join(job_ids),
+                max_wait // 60), job_ids=job_ids, jobs=[jobs[k] for k in sorted(jobs)], retries=retries)
+        if any(j['state'] in TERMINAL_STATES and j['state'] != 'COMPLETED' for j in jobs.values()):
+            waiting = sorted(set(k.split('_')[0] for k, j in jobs.items() if j['state'] not in TERMINAL_STATES))
+            stuck = never_satisfied(module, waiting) if waiting else []
+            if stuck:
+                module.run_command(['scancel'] + stuck)
+        _time.sleep(interval)
+        interval = min(max_interval, interval * 2)
+
+def wait_result(module, job_ids, result):
+    """Wait for job_ids and put the final jobs in result['jobs']. rc is 0
+    only if every job completed; the jobs that did not are returned.
+    """
+    retries = []
+    jobs = wait_for_jobs(module, job_ids, retries)
+    result['jobs'] = [jobs[k] for k in sorted(jobs)]
+    result['retries'] = retries
+    record_history(module, result['jobs'])
+    failed = [j for j in result['jobs'] if j['state'] != 'COMPLETED']
+    result['rc'] = 1 if failed else 0
+    return failed
+
+def wait_if_requested(module, job_ids, result):
+    """With the module's wait option, wait for job_ids and fail the task
+    unless every job completed."""
+    if not module.params.get('wait') or not job_ids:
+        return
+    failed = wait_result(module, job_ids, result)
+    if failed:
+        module.fail_json(msg='%d of %d SLURM jobs did not complete: %s' % (len(failed), len(result['jobs']),
+            ', '.join('%s %s' % (j['job_id'], j['state']) for j in failed)), **result)
+
+def history_path(module):
+    return '%s/.biolighthouse/slurm_history.jsonl' % module.params['base_dir']
+
+def load_history(module, tool):
+    path = history_path(module)
+    if not os.path.isfile(path):
+        return []
+    runs = []
+    with open(path) as f:
+        for line in f:
+            try:
+                run = json.loads(line)
+            except ValueError:
+                continue
+            if run.get('tool') == tool:
+                runs.append(run)
+    return runs[-HISTORY_RUNS:]
+
+def record_history(module, jobs):
+    """Append the measurements of the completed jobs of the step given to
+    autosize to the history. Packed bins are recorded one by one with
+    their own input; the other jobs of a step as one run with its peaks.
+    """
+    if not sizing:
+        return
+    date = datetime.datetime.now().isoformat()
+    runs = []
+    step = []
+    for job in jobs:
+        base = job['job_id'].split('_')[0]
+        if job['state'] != 'COMPLETED' or job['elapsed'] is None or '--wrap=true' in submitted.get(base, ([], None))[0]:
+            continue
+        if base in job_sizes:
+            sizes = job_sizes[base]
+            runs.append(history_run(sum(sizes), len(sizes), max(sizes), [job], date))
+        else:
+            step.append(job)
+    if step:
+        runs.append(history_run(sizing['bytes'], sizing['samples'], sizing.get('sample_bytes'), step, date))
+    if not runs:
+        return
+    with open(history_path(module), 'a') as f:
+        for run in runs:
+            f.write('%s\n' % json.dumps(run, sort_keys=True))
+
+def history_run(size, samples, sample_bytes, jobs, date):
+    cpus = [int(math.ceil(j['cpu_seconds'] / float(j['elapsed']))) for j in jobs if j['cpu_seconds'] and j['elapsed']]
+    return dict(tool=sizing['tool'], bytes=size, samples=samples, sample_bytes=sample_bytes, date=date,
+        elapsed=max(j['elapsed'] for j in jobs), max_rss_mb=max(j['max_rss_mb'] or 0 for j in jobs),
+        cpus=max(cpus) if cpus else None)
+
+def least_squares(rows, ys):
+    """Solve the normal equations for rows * coef = ys by Gaussian
+    elimination, with the columns scaled to 1. Returns None when the
+    columns are not independent."""
+    n = len(rows[0])
+    scale = [max(abs(r[j]) for r in rows) or 1.0 for j in range(n)]
+    x = [[r[j] / scale[j] for j in range(n)] for r in rows]
+    a = [[sum(r[i] * r[j] for r in x) for j in range(n)] + [sum(r[i] * y for r, y in zip(x, ys))] for i in range(n)]
+    for i in range(n):
+        pivot = max(range(i, n), key=lambda k: abs(a[k][i]))
+        if abs(a[pivot][i]) < 1e-9 * len(rows):
+            return None
+        a[i], a[pivot] = a[pivot], a[i]
+        for k in range(i + 1, n):
+            f = a[k][i] / a[i][i]
+            a[k] = [v - f * w for v, w in zip(a[k], a[i])]
+    coef = [0.0] * n
+    for i in reversed(range(n)):
+        coef[i] = (a[i][n] - sum(a[i][j] * coef[j] for j in range(i + 1, n))) / a[i][i]
+    return [c / s for c, s in zip(coef, scale)]
+
+def predict(runs, key, total_bytes, samples, size_key='bytes'):
+    """Predict key for an input from past runs: a linear fit on the input
+    bytes (size_key) and sample count once there are enough runs,
+    otherwise the largest key per input byte seen. Without samples the fit
+    is on bytes alone. None without history."""
+    points = [(r[size_key], r['samples'] if samples is not None else 0, r[key]) for r in runs
+        if r.get(key) is not None and r.get(size_key)]
+    if not points:
+        return None
+    if len(points) >= 5:
+        if samples is None:
+            coef = least_squares([[1.0, b] for b, n, y in points], [y for b, n, y in points])
+            coef = coef + [0.0] if coef is not None else None
+            samples = 0
+        else:
+            coef = least_squares([[1.0, b, n] for b, n, y in points], [y for b, n, y in points])
+        if coef is not None:
+            value = coef[0] + coef[1] * total_bytes + coef[2] * samples
+            if value > 0:
+                return value
+    return max(y / float(b) for b, n, y in points) * total_bytes
+
+def largest_bin(module, sizes):
+    """The bytes and sample count of the largest job that samples of the
+    given sizes are packed into, or of the whole step when not packing."""
+    if not packing_requested(module):
+        return sum(sizes), len(sizes)
+    spec = module.params['slurm_spec']
+    bins = pack_samples(list(enumerate(sizes)), spec.get('num_jobs'), spec.get('bytes_per_job'))
+    if not bins:
+        return 0, 0
+    largest = max(bins, key=lambda b: b['bytes'])
+    return largest['bytes'], len(largest['samples'])
+
+def autosize(module, tool, total_bytes, samples, sizes=None):
+    """Note the input of the step for the history and, with
+    slurm_spec.auto_size, fill in the mem, time and tasks_per_node left
+    empty in slurm_spec from earlier runs of tool, with safety margins and
+    within max_mem and max_time. Returns the values filled in.
+    The history holds one run per job, so with the bytes of each sample in
+    sizes the time is predicted for the largest packed bin, which is what
+    scale_resources takes slurm_spec to be. Samples run one after another,
+    so mem is predicted for the largest sample from the largest sample of
+    earlier jobs, where the history has it.
+    """
+    sizing.update(tool=tool, bytes=total_bytes, samples=samples, sample_bytes=max(sizes) if sizes else None)
+    spec = module.params['slurm_spec']
+    if not spec or not spec.get('auto_size'):
+        return {}
+    if sizes is not None:
+        total_bytes, samples = largest_bin(module, sizes)
+    runs = load_history(module, tool)
+    filled = {}
+    if spec.get('mem') is None:
+        if sizes and any(r.get('sample_bytes') for r in runs):
+            mb = predict(runs, 'max_rss_mb', max(sizes), None, 'sample_bytes')
+        else:
+            mb = predict(runs, 'max_rss_mb', total_bytes, samples)
+        if mb is not None:
+            mb = max(MIN_MEM_MB, int(math.ceil(mb * MEM_MARGIN)))
+            if spec.get('max_mem'):
+                mb = min(mb, parse_mem(spec['max_mem']))
+            spec['mem'] = filled['mem'] = format_mem(mb)
+    if spec.get('time') is None:
+        seconds = predict(runs, 'elapsed', total_bytes, samples)
+        if seconds is not None:
+            minutes = max(MIN_TIME_MINUTES, int(math.ceil(seconds * TIME_MARGIN / 60.0)))
+            if spec.get('max_time'):
+                minutes = min(minutes, parse_time(spec['max_time']))
+            spec['time'] = filled['time'] = format_time(minutes)
+    if spec.get('tasks_per_node') is None:
+        cpus = [r['cpus'] for r in runs if r.get('cpus')]
+        if cpus:
+            spec['tasks_per_node'] = filled['tasks_per_node'] = max(cpus)
+    return filled
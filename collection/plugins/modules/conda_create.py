@@ -67,6 +67,10 @@ RETURN = '''
 original_message:
     description: The original name param that was passed in
     type: str
+plan:
+    description: In check mode, the environment and whether it would be
+                 created.
+    type: dict
 '''
 
 from ansible.module_utils.basic import AnsibleModule
@@ -110,10 +114,12 @@ def main():
     # Create conda object
     conda = conda.Conda(module, name)
 
+    name_exists = conda.check_env(name)
     if module.check_mode:
-        return result
+        result['changed'] = not name_exists and state != 'absent'
+        result['plan'] = dict(env=name, create=result['changed'])
+        module.exit_json(**result)
 
-    name_exists = conda.check_env(name)
     if not name_exists:
         if state == 'absent':
             result['msg'] = "%s is already absent." % (name)
@@ -32,7 +32,9 @@ options:
                  requires a different path such as in the case of Compute Canada.
     input_files:
         description:
-            - The path to the directory containing the input files.
+            - The path to the directory containing the input files. Samples
+              sequenced over several lanes (_L001, _L002, ...) are trimmed
+              as one sample, reading the lanes as a single stream.
         required: true
     hpc: 
         description: 
@@ -47,15 +49,101 @@ options:
         description:
             - The DNA sequence of the reverse primer.
         required: true
+    primers:
+        description:
+            - A panel of named primer pairs, each a dict with name, forward and
+              reverse, used instead of primer and primer_r for multiplexed
+              libraries. Reads are trimmed and demultiplexed in one pass into
+              output/<name>/, with unmatched pairs in output/unknown/.
+              flash2_merge and dada2_sample_inference process each amplicon
+              directory separately.
+        required: false
     pypath:
         description:
             - The path to the python library:
         required: false
+    sniff_reads:
+        description:
+            - Number of read pairs per sample to inspect before trimming. When
+              greater than 0, only the primer orientations that occur in at
+              least sniff_min_fraction of the inspected reads are passed to
+              cutadapt, matched with error_rate mismatches as cutadapt does.
+              The 3' adapters are kept with their 5' primer, since only
+              read-through reads hold them. The counts are written to
+              reports/orientation.json.
+        required: false
+        default: 0
+    sniff_samples:
+        description:
+            - The number of samples to inspect when sniff_reads is set,
+              spread evenly over the samples in name order.
+        required: false
+        default: 4
+    sniff_min_fraction:
+        description:
+            - Minimum fraction of inspected reads an orientation must occur in
+              to be kept.
+        required: false
+        default: 0.01
+    ledger:
+        description:
+            - Run each command of the generated scripts through
+              .biolighthouse/ledger.py, which appends its step, sample,
+              times, CPU, peak memory and I/O to .biolighthouse/ledger.jsonl.
+              Query it with python .biolighthouse/ledger.py slowest or trends.
+            - The commands are measured with the python3 (or python) found
+              where the script runs, and run unmeasured where there is none.
+        required: false
+        default: false
+    wait:
+        description:
+            - With hpc, wait for the submitted jobs to finish instead of
+              returning as soon as sbatch accepts them. sacct is polled for
+              all jobs at once, backing off from slurm_spec.poll_interval to
+              max_poll_interval seconds. The task fails unless every job
+              completed. Combine with async for long steps.
+            - With slurm_spec.retries, jobs that end OUT_OF_MEMORY or
+              TIMEOUT are resubmitted that many times with mem or time
+              multiplied by slurm_spec.mem_factor or time_factor (default
+              2), up to max_mem or max_time. Only the failed tasks of an
+              array are rerun, and jobs queued behind them are resubmitted
+              to wait on the new ones.
+            - Waiting fails the task after slurm_spec.max_wait minutes (by
+              default four times the time the jobs asked for, plus that of
+              any retries) or after five sacct failures in a row, naming
+              the jobs that were still running.
+        required: false
+        default: false
+    cost_model:
+        description:
+            - A report written by benchmarks/pipeline_benchmark.py, used by
+              check mode to estimate times when neither the ledger nor the
+              SLURM history has runs of this step.
+        required: false
     slurm_spec: 
         description:
             - The SLURM options if hpc was set to true.
+            - Setting num_jobs or bytes_per_job packs the samples into that many
+              jobs (or jobs of roughly that many input bytes) balanced by input
+              size. time is then taken as the request for the largest job
+              and scaled down for the others. Every job gets mem, since the
+              samples of a job run one after another.
+            - With auto_size, the mem, time and tasks_per_node left empty are
+              filled in from the input bytes and sample count of the
+              largest job (mem from the largest sample), using a fit per
+              tool over earlier jobs in .biolighthouse/slurm_history.jsonl
+              plus safety margins, within max_mem and max_time. Each job is
+              added to the history with its own input when wait is set.
         required: false
         note: Required if hpc was set to true.
+    pilot:
+        description:
+            - Run on the subset drawn by pilot_subset, in its work area
+              (.biolighthouse/pilot) instead of base_dir. Paths under
+              base_dir/.biolighthouse, and the input the subset was drawn
+              from, are moved there.
+        required: false
+        default: false
 notes:
     - Cutadapt must be installed.
 '''
@@ -69,6 +157,26 @@ EXAMPLES = '''
     primer_r: GGACTACCGGGGTATCT
     hpc: False
 
+- name: Trim and demultiplex a multi-amplicon library
+  cutadapt_paired_end:
+    input_files: "{{ input_data }}"
+    base_dir: "{{ base_path }}"
+    primers:
+      - name: 16S-V4
+        forward: GTGYCAGCMGCCGCGGTAA
+        reverse: GGACTACNVGGGTWTCTAAT
+      - name: ITS2
+        forward: GTGAATCATCGAATCTTTGAA
+        reverse: TCCTCCGCTTATTGATATGC
+
+- name: Execute cutadapt with only the primer orientations present
+  cutadapt_paired_end:
+    input_files: "{{ input_data }}"
+    base_dir: "{{ base_path }}"
+    primer: CTACGGGGGGCAGCAG
+    primer_r: GGACTACCGGGGTATCT
+    sniff_reads: 5000
+
 - name: Execute cutadapt on HPC
   cutadapt_paired_end:
     input_files: "{{ input_data }}"
@@ -92,12 +200,37 @@ out:
     description: The output message that the module generates
 err:
     description: The error message that the modules generates
+orientation:
+    description: Per-orientation match counts when sniff_reads is set
+    type: dict
+jobs:
+    description: With hpc and wait, the final state, exit code, elapsed
+                 seconds and MaxRSS (max_rss_mb) of every job and array task.
+    type: list
+slurm_auto:
+    description: With hpc and slurm_spec.auto_size, the slurm_spec values that
+                 were filled in from the history.
+    type: dict
+retries:
+    description: With hpc and wait, the jobs resubmitted after running out of
+                 memory or time, with the new job ID and sbatch command.
+    type: list
+plan:
+    description: In check mode, what would run instead of running it - the
+                 samples, the command of each, input bytes, expected output
+                 bytes and estimated cpu_hours and wall_hours, with the source
+                 of the estimate (ledger, slurm_history or benchmark; null if
+                 none has runs of the step). Nothing is written or submitted.
+    type: dict
 '''
 
 from ansible.module_utils.basic import AnsibleModule
 import imp
 import glob
 import os
+import re
+import gzip
+import json
 from os.path import expanduser
 from Bio.SeqIO.FastaIO import SimpleFastaParser
 from Bio.Seq import Seq
@@ -106,11 +239,16 @@ def cutadapt_arg_spec(slurm, **kwargs):
     spec = dict(
         executable=dict(type='path', default=None, required=False),
         hpc=dict(type='bool', default=False),
+        ledger=dict(type='bool', default=False),
+        wait=dict(type='bool', default=False),
+        cost_model=dict(type='path', default=None, required=False),
         pypath=dict(type='path', required=False),
         base_dir=dict(type='path', default=expanduser('~')),
+        pilot=dict(type='bool', default=False),
         input_files=dict(type='path', default=None, required=True),
         primer=dict(type='str', default=None, required=False),
         primer_r=dict(type='str', default=None, required=False),
+        primers=dict(type='list', default=None, required=False),
         front=dict(type='str', default=None, required=False),
         anywhere=dict(type='str', default=None, required=False),
         error_rate=dict(type='float', default=0.1),
@@ -160,6 +298,9 @@ def cutadapt_arg_spec(slurm, **kwargs):
         untrimmed_paired_output=dict(type='path', default=None, required=False),
         too_short_paired_output=dict(type='path', default=None, required=False),
         too_long_paired_output=dict(type='path', default=None, required=False),
+        sniff_reads=dict(type='int', default=0, required=False),
+        sniff_samples=dict(type='int', default=4, required=False),
+        sniff_min_fraction=dict(type='float', default=0.01, required=False),
         slurm_spec=dict(type='dict', default=slurm.slurm_arg_spec(), required=False)
     )
     spec.update(kwargs)
@@ -176,25 +317,96 @@ def write_fasta(f_path, forward, reverse):
         f.write(reverse)
         f.close()
 
-def run_cutadapt(fi, perms, executable, cut_path, module):
-    f = fi.split('/')
-    f = f[-1]
-    f = f.replace('.fastq.gz', '')
-    b = f.replace('_R1', '')
-    file_r = fi.replace('_R1', '_R2')
+def write_panel_fasta(f_path, pairs):
+    """Write a primer panel; each record is tagged with its amplicon
+    name after the slash so the adapters can be grouped again."""
+    with open('%s/primers.fa' % (f_path), 'w') as f:
+        for pair in pairs:
+            f.write('>%s_forward/%s\n%s\n' % (pair['name'], pair['name'], pair['forward']))
+            f.write('>%s_reverse/%s\n%s\n' % (pair['name'], pair['name'], pair['reverse']))
+        f.close()
+
+def cutadapt_cmd(sample, perms, executable, cut_path, module):
+    f = sample['stem']
+    b = sample['name']
     f_r = f.replace('_R1', '_R2')
     cmd = get_common_spec(module, executable)
-    cmd = build_primer_pe_cmd(perms, cmd)
-    cmd.extend([fi, file_r, '-o', '%s/output/%s.fastq.gz' % (cut_path, f), '-p', '%s/output/%s.fastq.gz' % (cut_path, f_r), '>', '%s/reports/%s.report' % (cut_path, b)])
-    with open('%s/primer_removal.sh' % (cut_path), 'a+') as f:
-        f.write('%s\n' % (' '.join(cmd)))
+    if module.params['primers']:
+        # Demultiplex on the name of the amplicon whose primers matched.
+        cmd = build_panel_pe_cmd(perms, cmd)
+        out_dir = '%s/output/{name}' % cut_path
+    else:
+        cmd = build_primer_pe_cmd(perms, cmd)
+        out_dir = '%s/output' % cut_path
+    cmd.extend([sample['r1_in'], sample['r2_in'], '-o', '%s/%s.fastq.gz' % (out_dir, f), '-p', '%s/%s.fastq.gz' % (out_dir, f_r), '>', '%s/reports/%s.report' % (cut_path, b)])
+    return cmd
+
+def run_cutadapt(sample, perms, executable, cut_path, module, script='primer_removal.sh', ledger=None):
+    cmd = cutadapt_cmd(sample, perms, executable, cut_path, module)
+    line = ' '.join(cmd)
+    if ledger is not None:
+        line = ledger.line(module, 'cutadapt_paired_end', sample['name'], line, sample['bytes'])
+    with open('%s/%s' % (cut_path, script), 'a+') as f:
+        f.write('%s\n' % line)
         f.close()
     return cmd
 
+def parse_report(text):
+    """Return (pairs processed, pairs written) from a full or minimal
+    cutadapt report, or (None, None)."""
+    pairs = re.search(r'Total read pairs processed:\s+([\d,]+)', text)
+    written = re.search(r'Pairs written \(passing filters\):\s+([\d,]+)', text)
+    if pairs and written:
+        return int(pairs.group(1).replace(',', '')), int(written.group(1).replace(',', ''))
+    lines = text.strip().splitlines()
+    if len(lines) >= 2 and 'in_reads' in lines[-2].split('\t'):
+        row = dict(zip(lines[-2].split('\t'), lines[-1].split('\t')))
+        return int(row['in_reads']), int(row['out_reads'])
+    return None, None
+
+def track_cutadapt(module, tracking, found, cut_path):
+    """Record the pairs read and written for each sample from its report
+    for the read tracking."""
+    rows = []
+    for sample in found:
+        report = '%s/reports/%s.report' % (cut_path, sample['name'])
+        if os.path.isfile(report):
+            with open(report) as f:
+                pairs, written = parse_report(f.read())
+            if pairs is not None:
+                rows.append(dict(sample=sample['name'], stage='cutadapt', reads_in=pairs, reads_out=written))
+    tracking.write(tracking.stage_path(module.params['base_dir'], 'cutadapt'), rows)
+
 def build_primer_pe_cmd(primers, cmd):
-    cmd.extend([primers[0][2], '%s=%s' % (primers[0][0], primers[0][1]), primers[1][2], '%s=%s' % (primers[1][0],primers[1][1]),
-        primers[2][2], '%s=%s' % (primers[2][0],primers[2][1]), primers[3][2],
-        '%s=%s' % (primers[3][0],primers[3][1])])
+    for p in primers:
+        cmd.extend([p[2], '%s=%s' % (p[0], p[1])])
+    return cmd
+
+def amplicon_name(perm):
+    return perm[3][:-3] if perm[3].endswith('_rc') else perm[3]
+
+def build_panel_pe_cmd(primers, cmd):
+    """Build one linked adapter per amplicon and read, named after the
+    amplicon. The 5' primer is required and the reverse complement of
+    the mate's primer is trimmed from the 3' end when present. Adapters
+    are paired so both mates must match the same amplicon.
+    """
+    amplicons = []
+    seqs = {}
+    for p in primers:
+        name = amplicon_name(p)
+        if name not in seqs:
+            amplicons.append(name)
+            seqs[name] = {}
+        seqs[name][p[2].strip()] = p[1]
+    for flag, front, back in (('-a', '-g', '-a'), ('-A', '-G', '-A')):
+        for name in amplicons:
+            if back in seqs[name]:
+                # Quoted since the commands are written to a shell script.
+                cmd.extend([flag, "'%s=%s;required...%s;optional'" % (name, seqs[name][front], seqs[name][back])])
+            else:
+                cmd.extend([front, '%s=%s' % (name, seqs[name][front])])
+    cmd.extend(['--pair-adapters'])
     return cmd
 
 def get_common_spec(module, executable):
@@ -231,42 +443,172 @@ def get_common_spec(module, executable):
         cmd.extend(['--max-n', str(module.params['max_n'])])
     return cmd
 
+def primer_records(module):
+    """The (title, sequence) records write_fasta or write_panel_fasta
+    would write for the module's primers."""
+    if module.params['primers']:
+        records = []
+        for pair in module.params['primers']:
+            records.append(('%s_forward/%s' % (pair['name'], pair['name']), pair['forward']))
+            records.append(('%s_reverse/%s' % (pair['name'], pair['name']), pair['reverse']))
+        return records
+    return [('forward/f', module.params['primer']), ('reverse/r', module.params['primer_r'])]
+
 def gen_permutations_pe(fasta):
+    with open(fasta) as f:
+        records = list(SimpleFastaParser(f))
+    f.close()
+    return permutations_pe(records)
+
+def permutations_pe(records):
     primers = []
     primers_rc = []
     primers_tmp = []
 
-    with open(fasta) as f:
-        for t in SimpleFastaParser(f):
-            a = t[0].split('/')
-            primers_tmp.append([a[0], a[1], t[1]])
-    f.close()
+    for t in records:
+        a = t[0].split('/')
+        primers_tmp.append([a[0], a[1], t[1]])
 
     for a in primers_tmp:
         primers_rc.append([a[0], a[1], a[2]])
         primers_rc.append([a[0]+str("_rc"), a[1]+str('_rc'), str(Seq(a[2]).reverse_complement())])
 
-    one = primers_rc[0]
-    one_rc = primers_rc[1]
-    two = primers_rc[2]
-    two_rc = primers_rc[3]
-
-    for a in range(4):
-        if a == 0:
-            primers.append([one[0], one[2], " -g", one[1]])
-        elif a == 1:
-            primers.append([one_rc[0], one_rc[2], "-A", one_rc[1]])
-        elif a == 2:
-            primers.append([two[0], two[2], "-G", two[1]])
-        elif a == 3:
-            primers.append([two_rc[0], two_rc[2], "-a", two_rc[1]])
-        else:
-            print("Something's gone horribly wrong. Have fun debugging.")
+    # Each forward/reverse pair expands to four adapters.
+    for i in range(0, len(primers_rc), 4):
+        one = primers_rc[i]
+        one_rc = primers_rc[i + 1]
+        two = primers_rc[i + 2]
+        two_rc = primers_rc[i + 3]
+
+        for a in range(4):
+            if a == 0:
+                primers.append([one[0], one[2], " -g", one[1]])
+            elif a == 1:
+                primers.append([one_rc[0], one_rc[2], "-A", one_rc[1]])
+            elif a == 2:
+                primers.append([two[0], two[2], "-G", two[1]])
+            elif a == 3:
+                primers.append([two_rc[0], two_rc[2], "-a", two_rc[1]])
+            else:
+                print("Something's gone horribly wrong. Have fun debugging.")
     return primers
 
+IUPAC = {'A': 'A', 'C': 'C', 'G': 'G', 'T': 'T', 'U': 'T', 'R': '[AG]', 'Y': '[CT]',
+    'S': '[CG]', 'W': '[AT]', 'K': '[GT]', 'M': '[AC]', 'B': '[CGT]', 'D': '[AGT]',
+    'H': '[ACT]', 'V': '[ACG]', 'N': '[ACGTN]'}
+
+def primer_matcher(seq, error_rate):
+    """Return a function telling whether a sequence holds seq with at most
+    error_rate mismatches per primer base, cutadapt's default error rate
+    (substitutions only). Of max_errors + 1 pieces of the primer one must
+    match exactly, so the pieces are found with re and the whole primer is
+    compared where they are."""
+    seq = seq.upper()
+    bases = [IUPAC.get(c, c).strip('[]') for c in seq]
+    k = int(error_rate * len(seq))
+    size = len(seq) // (k + 1)
+    pieces = []
+    for j in range(k + 1):
+        a = j * size
+        b = len(seq) if j == k else a + size
+        pieces.append((a, re.compile('(?=%s)' % ''.join(IUPAC.get(c, c) for c in seq[a:b]))))
+    def matches(read):
+        tried = set()
+        for a, piece in pieces:
+            for m in piece.finditer(read):
+                start = m.start() - a
+                if start in tried or start < 0 or start + len(seq) > len(read):
+                    continue
+                tried.add(start)
+                errors = 0
+                for base, allowed in zip(read[start:start + len(seq)], bases):
+                    if base not in allowed:
+                        errors += 1
+                        if errors > k:
+                            break
+                if errors <= k:
+                    return True
+        return False
+    return matches
+
+def read_sequences(path, n):
+    """Return the sequences of the first n records of a FASTQ file."""
+    seqs = []
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt') as f:
+        for i, line in enumerate(f):
+            if i % 4 == 1:
+                seqs.append(line.strip().upper())
+                if len(seqs) >= n:
+                    break
+    return seqs
+
+def sniff_orientations(pairs, perms, n_reads, n_samples, min_fraction, error_rate=0.1):
+    """Count how often each primer orientation occurs in the first
+    n_reads read pairs of up to n_samples (R1, R2) file pairs, spread
+    evenly over them in sorted order. Adapters searched in R1 (-g/-a) are
+    matched against R1 and the others against R2, with error_rate
+    mismatches allowed. Orientations seen in fewer than min_fraction of
+    the sampled reads are dropped; if none pass, every orientation is
+    kept. The 3' adapters only show up in reads running through the
+    amplicon, so they are kept whenever their 5' partner (-a with -g, -A
+    with -G of the same primer pair) is.
+    """
+    pairs = sorted(pairs)
+    if len(pairs) > n_samples:
+        pairs = [pairs[i * len(pairs) // n_samples] for i in range(n_samples)]
+    reads = {'R1': [], 'R2': []}
+    for r1, r2 in pairs:
+        reads['R1'].extend(read_sequences(r1, n_reads))
+        reads['R2'].extend(read_sequences(r2, n_reads))
+    stats = {}
+    keep = []
+    for p in perms:
+        mate = 'R1' if p[2].strip() in ('-g', '-a') else 'R2'
+        matcher = primer_matcher(p[1], error_rate)
+        matches = sum(1 for r in reads[mate] if matcher(r))
+        fraction = float(matches) / len(reads[mate]) if reads[mate] else 0.0
+        stats[p[0]] = dict(adapter=p[2].strip(), read=mate, reads=len(reads[mate]),
+            matches=matches, fraction=round(fraction, 4), used=fraction >= min_fraction)
+        if fraction >= min_fraction:
+            keep.append(p)
+    if not keep:
+        for name in stats:
+            stats[name]['used'] = True
+        return perms, stats
+    # permutations_pe gives -g, -A, -G, -a for each primer pair
+    for i in range(0, len(perms) - 3, 4):
+        for five, three in ((perms[i], perms[i + 3]), (perms[i + 2], perms[i + 1])):
+            if five in keep and three not in keep:
+                stats[three[0]]['used'] = True
+                keep.append(three)
+    return [p for p in perms if p in keep], stats
+
+def plan_cutadapt(module, slurm, samples, plan, ledger, executable, cut_path, result):
+    """Return the check-mode plan: the cutadapt command of every sample,
+    with every primer orientation since sniff_reads is not applied."""
+    perms = permutations_pe(primer_records(module))
+    found = samples.discover_samples(module.params['input_files'])
+    total = sum(s['bytes'] for s in found)
+    concurrency = 1
+    if module.params['hpc']:
+        result['slurm_auto'] = slurm.autosize(module, 'cutadapt_paired_end', total, len(found),
+            [s['bytes'] for s in found])
+        if slurm.packing_requested(module):
+            concurrency = len(slurm.pack_samples([(i, s['bytes']) for i, s in enumerate(found)],
+                module.params['slurm_spec'].get('num_jobs'), module.params['slurm_spec'].get('bytes_per_job')))
+    cmds = [' '.join(cutadapt_cmd(s, perms, executable, cut_path, module)) for s in found]
+    return plan.build(module, slurm, ledger, 'cutadapt_paired_end', [s['name'] for s in found], cmds, total,
+        concurrency)
+
 def main():
     slurm = imp.load_source('utils.slurm', '/tmp/biol/slurm.py')
     tool = imp.load_source('utils.tool', '/tmp/biol/tool.py')
+    samples = imp.load_source('utils.samples', '/tmp/biol/samples.py')
+    ledger = imp.load_source('utils.ledger', '/tmp/biol/ledger.py')
+    plan = imp.load_source('utils.plan', '/tmp/biol/plan.py')
+    tracking = imp.load_source('utils.tracking', '/tmp/biol/tracking.py')
+    pilot = imp.load_source('utils.pilot', '/tmp/biol/pilot.py')
     argument_spec=cutadapt_arg_spec(slurm)
     module = AnsibleModule(argument_spec,
                            supports_check_mode=True
@@ -278,39 +620,94 @@ def main():
         err='',
         cmd=''
     )
+    pilot.apply(module, result)
+    if not module.params['primers'] and not (module.params['primer'] and module.params['primer_r']):
+        module.fail_json(msg='Either primer and primer_r or primers must be given.')
+    for pair in module.params['primers'] or []:
+        if not isinstance(pair, dict) or not all(pair.get(k) for k in ('name', 'forward', 'reverse')):
+            module.fail_json(msg='Each entry in primers needs a name, forward and reverse.')
     # Define the variables
     cutadapt = tool.Tool(module.params['base_dir'], 'cutadapt')
     executable = cutadapt.get_executable_path(module)
 
-    if module.check_mode:
-        return result
-
     cut_path = "%s/.biolighthouse/primer_removal" % module.params['base_dir']
 
-    # if module.params['slurm_spec']['account'] is not None:
-    if module.params['hpc']:
-        slurm_cmd = slurm.build_slurm_cmd(module)
+    if module.check_mode:
+        plan.exit_plan(module, result, plan_cutadapt(module, slurm, samples, plan, ledger, executable, cut_path, result))
+
     with open('%s/primer_removal.sh' % (cut_path), 'w') as f:
         f.write('%s\n\n' % ('#!/bin/bash'))
         f.close()
     import subprocess
     subprocess.call(['chmod', '0777', '%s/primer_removal.sh' % cut_path])
-    write_fasta(cut_path, module.params['primer'], module.params['primer_r'])
+    if module.params['primers']:
+        write_panel_fasta(cut_path, module.params['primers'])
+        for name in [p['name'] for p in module.params['primers']] + ['unknown']:
+            if not os.path.isdir('%s/output/%s' % (cut_path, name)):
+                os.makedirs('%s/output/%s' % (cut_path, name))
+    else:
+        write_fasta(cut_path, module.params['primer'], module.params['primer_r'])
     perms = gen_permutations_pe("%s/primers.fa" % cut_path)
-    for fi in glob.glob('%s/*_R1*' % (module.params['input_files'])):
-        cmd = run_cutadapt(fi, perms, executable, cut_path, module)
+    found = samples.discover_samples(module.params['input_files'])
+    if module.params['hpc']:
+        sizes = [s['bytes'] for s in found]
+        result['slurm_auto'] = slurm.autosize(module, 'cutadapt_paired_end', sum(sizes), len(found), sizes)
+    if module.params['sniff_reads'] > 0 and found:
+        kept, stats = sniff_orientations([(s['r1'][0], s['r2'][0]) for s in found], perms,
+            module.params['sniff_reads'], module.params['sniff_samples'], module.params['sniff_min_fraction'],
+            module.params['error_rate'])
+        if module.params['primers']:
+            # The 5' primers name the amplicon, so they are always kept.
+            kept = [p for p in perms if p in kept or p[2].strip() in ('-g', '-G')]
+        perms = kept
+        with open('%s/reports/orientation.json' % cut_path, 'w') as f:
+            json.dump(stats, f, indent=2, sort_keys=True)
+        result['orientation'] = stats
+    if module.params['hpc'] and slurm.packing_requested(module):
+        sizes = [(i, s['bytes']) for i, s in enumerate(found)]
+        bins = slurm.pack_samples(sizes, module.params['slurm_spec'].get('num_jobs'),
+            module.params['slurm_spec'].get('bytes_per_job'))
+        scripts = []
+        for n, b in enumerate(bins):
+            script = 'primer_removal_%d.sh' % n
+            with open('%s/%s' % (cut_path, script), 'w') as f:
+                f.write('%s\n\n' % ('#!/bin/bash'))
+                f.close()
+            subprocess.call(['chmod', '0777', '%s/%s' % (cut_path, script)])
+            for i in b['samples']:
+                run_cutadapt(found[i], perms, executable, cut_path, module, script, ledger)
+            scripts.append(('%s/%s' % (cut_path, script), [found[i]['bytes'] for i in b['samples']]))
+        rc, out, err, cmds, job_ids = slurm.submit_bins(module, scripts, cut_path)
+        result['cmd'] = cmds
+        result['changed'] = True
+        result['out'] = out
+        result['err'] = err
+        result['rc'] = rc
+        slurm.wait_if_requested(module, job_ids, result)
+        if module.params['wait']:
+            track_cutadapt(module, tracking, found, cut_path)
+        module.exit_json(**result)
+    for sample in found:
+        cmd = run_cutadapt(sample, perms, executable, cut_path, module, ledger=ledger)
     # if module.params['slurm_spec']['account'] is not None:
     if module.params['hpc']:
-        cmd_2 = slurm_cmd
+        cmd_2 = slurm.build_slurm_cmd(module)
         cmd_2.append('%s/primer_removal.sh' % cut_path)
     else:
         cmd_2 = ['./primer_removal.sh']
     result['cmd'] = cmd_2
-    rc, out, err = module.run_command(cmd_2, cwd=cut_path)
+    if module.params['hpc']:
+        rc, out, err, job_id = slurm.submit(module, cmd_2, cut_path)
+    else:
+        rc, out, err = module.run_command(cmd_2, cwd=cut_path)
     result['changed'] = True
     result['out'] = out
     result['err'] = err
     result['rc'] = rc
+    if module.params['hpc'] and rc == 0:
+        slurm.wait_if_requested(module, [job_id], result)
+    if not module.params['hpc'] or module.params['wait']:
+        track_cutadapt(module, tracking, found, cut_path)
     module.exit_json(**result)
 
 if __name__ == '__main__':
@@ -17,7 +17,8 @@ options:
     name:
         reads:
             - This is the path to the input FASTQ reads
-        required: true
+            - Required unless worker_state is stopped.
+        required: false
     executable:
         description:
             - The path to the Cutadapt executable. Should be specified but if
@@ -45,6 +46,12 @@ options:
             - Truncation length for reads. Should not be set for most use cases.
         required: false
         default: 0
+    quality_profile:
+        description:
+            - A profile written by quality_profile. The trunc_len and max_ee
+              it recommends for each amplicon are used instead of the
+              trunc_len and max_ee options.
+        required: false
     nbases:
         description:
             - The number of bases to use in learning sequencing errors with DADA2.
@@ -52,8 +59,13 @@ options:
         default: 1000000
     output:
         description:
-            - The name of the output ASV tables.
-        required: true
+            - The name of the output ASV tables. If reads holds one directory
+              per amplicon, one table named <output>_<amplicon> is written
+              for each. The ASVs of every sample are also kept in
+              DADA2/samples/<output> for chunked chimera removal in
+              dada2_taxonomy.
+            - Required unless worker_state is stopped.
+        required: false
     random_seed:
         description:
             - The random seed used for learning sequencing errors with DADA2.
@@ -65,11 +77,182 @@ options:
               sequencing errors.
         required: false
         default: 10
+    learn_reads:
+        description:
+            - Learn the error model from this many filtered reads drawn
+              evenly across all samples with seeded reservoir sampling
+              (random_seed), written to filtered/learn.fastq.gz, instead of
+              whole files in order. Small or atypical samples such as
+              negative controls then cannot dominate the model. 0 reads the
+              samples in order up to nbases.
+        required: false
+        default: 0
+    max_ee:
+        description:
+            - Reads with more expected errors than this are discarded by
+              filterAndTrim (maxEE). Unset means no limit.
+        required: false
+    trunc_q:
+        description:
+            - Truncate reads at the first base with quality at or below this (truncQ).
+        required: false
+        default: 2
+    max_n:
+        description:
+            - Reads with more Ns than this are discarded (maxN).
+        required: false
+        default: 0
+    min_len:
+        description:
+            - Reads shorter than this after trimming are discarded (minLen).
+        required: false
+        default: 20
+    chunk_size:
+        description:
+            - The number of reads filterAndTrim streams per chunk (n). Lower it
+              to reduce memory per thread.
+        required: false
+        default: 100000
+    threads:
+        description:
+            - The number of threads for filtering, error learning and
+              denoising. If unset on HPC with slurm_spec.mem, one thread per
+              mem_per_thread of the allocation is used (at most
+              tasks_per_node); otherwise every core is used.
+        required: false
+    mem_per_thread:
+        description:
+            - Memory budgeted per thread when threads is derived from slurm_spec.mem.
+        required: false
+        default: 4G
+    pool:
+        description:
+            - How samples are denoised. false denoises each sample
+              independently. pseudo runs two per-sample passes; sequences
+              found in two or more samples in the first pass are given as
+              priors to the second, which gives close to pooled sensitivity
+              to rare variants with per-sample memory. The first pass is
+              the same as false, so its checkpoints are reused. With hpc,
+              shards runs both passes as SLURM array jobs. true pools
+              every read into one dada call and needs memory for the whole
+              project.
+        required: false
+        default: false
+        choices: [false, pseudo, true]
+    shards:
+        description:
+            - With hpc and pool false or pseudo, split the per-sample passes
+              over this many SLURM array tasks. Filtering and error learning
+              run first as one job, then each pass as an array (for pseudo
+              with the job collecting the priors in between) and a last job
+              writing the tables, each depending on the one before. Needs
+              checkpoint, through which the jobs hand over.
+        required: false
+        default: 1
+    asv_ids:
+        description:
+            - How ASVs are named in the CSV tables. md5 and sha1 use the hash
+              of the sequence, which is stable across runs and projects, and
+              write the sequences to <output>_asvs.fasta. sequence keeps the
+              full sequence as the name. The RDS output always keeps the
+              sequences.
+        required: false
+        default: md5
+        choices: [md5, sha1, sequence]
+    checkpoint:
+        description:
+            - Save the filtering step, the error model and every denoised
+              sample under DADA2/checkpoints/<output> as soon as they finish.
+              A rerun, e.g. after a SLURM time limit or preemption, loads
+              the finished samples and continues with the rest.
+              Checkpoints made with other filtering or error learning
+              settings, or from changed merged reads, are discarded.
+        required: false
+        default: true
+    worker:
+        description:
+            - Run the R script in a long-lived local R worker (worker.R)
+              instead of a new Rscript, started on first use. The worker
+              keeps dada2 loaded and the most recently read RDS files in
+              memory (up to 2 GB), so repeated runs while tuning parameters
+              skip the library and table loading. Ignored with hpc.
+            - Requests go through a FIFO in .biolighthouse/worker, which only
+              the owner can open, and the worker only runs the scripts
+              next to worker.R.
+        required: false
+        default: false
+    worker_name:
+        description:
+            - Name of the worker, so several can run under one base_dir.
+        required: false
+        default: worker
+    worker_state:
+        description:
+            - C(stopped) stops the worker named worker_name and removes its
+              FIFO, lock and pid files instead of running anything, e.g. at
+              the end of a tuning session. Only base_dir and worker_name are
+              read then. changed is whether a worker was running.
+        required: false
+        default: started
+        choices: [started, stopped]
+    restart:
+        description:
+            - Discard existing checkpoints and start from the beginning.
+        required: false
+        default: false
+    ledger:
+        description:
+            - Run each command of the generated scripts through
+              .biolighthouse/ledger.py, which appends its step, sample,
+              times, CPU, peak memory and I/O to .biolighthouse/ledger.jsonl.
+              Query it with python .biolighthouse/ledger.py slowest or trends.
+            - The commands are measured with the python3 (or python) found
+              where the script runs, and run unmeasured where there is none.
+        required: false
+        default: false
+    wait:
+        description:
+            - With hpc, wait for the submitted jobs to finish instead of
+              returning as soon as sbatch accepts them. sacct is polled for
+              all jobs at once, backing off from slurm_spec.poll_interval to
+              max_poll_interval seconds. The task fails unless every job
+              completed. Combine with async for long steps.
+            - With slurm_spec.retries, jobs that end OUT_OF_MEMORY or
+              TIMEOUT are resubmitted that many times with mem or time
+              multiplied by slurm_spec.mem_factor or time_factor (default
+              2), up to max_mem or max_time. Only the failed tasks of an
+              array are rerun, and jobs queued behind them are resubmitted
+              to wait on the new ones.
+            - Waiting fails the task after slurm_spec.max_wait minutes (by
+              default four times the time the jobs asked for, plus that of
+              any retries) or after five sacct failures in a row, naming
+              the jobs that were still running.
+        required: false
+        default: false
+    cost_model:
+        description:
+            - A report written by benchmarks/pipeline_benchmark.py, used by
+              check mode to estimate times when neither the ledger nor the
+              SLURM history has runs of this step.
+        required: false
     slurm_spec: 
         description:
             - The SLURM options if hpc was set to true.
+            - With auto_size, the mem, time and tasks_per_node left empty are
+              filled in from the input bytes and sample count, using a fit
+              per tool over earlier runs in .biolighthouse/slurm_history.jsonl
+              plus safety margins, within max_mem and max_time. Runs are
+              added to the history when wait is set.
         required: false
         note: Required if hpc was set to true.
+    pilot:
+        description:
+            - Run on the subset drawn by pilot_subset, in its work area
+              (.biolighthouse/pilot) instead of base_dir. Paths under
+              base_dir/.biolighthouse, and the input the subset was drawn
+              from, are moved there.
+        required: false
+        default: false
 notes:
     - DADA2 must be installed.
 '''
@@ -82,12 +265,20 @@ EXAMPLES = '''
     output: seqtab
     hpc: False
 
+- name: Stop the R worker once the parameters are tuned
+  dada2_sample_inference:
+    base_dir: "{{ base_path }}"
+    worker_state: stopped
+
 - name: Run DADA2 Sample Inference
   dada2_sample_inference:
     reads: "{{ base_path }}/.biolighthouse/merge/output"
     base_dir: "{{ base_path }}"
     executable: "{{ base_path }}/.biolighthouse/software/conda/envs/dada2/bin/Rscript"
     output: seqtab
+    max_ee: 2
+    chunk_size: 50000
+    learn_reads: 500000
     hpc: True
     slurm_spec:
       account: "{{ account }}"
@@ -105,44 +296,212 @@ out:
     description: The output message that the module generates
 err:
     description: The error message that the modules generates
+jobs:
+    description: With hpc and wait, the final state, exit code, elapsed
+                 seconds and MaxRSS (max_rss_mb) of every job and array task.
+    type: list
+slurm_auto:
+    description: With hpc and slurm_spec.auto_size, the slurm_spec values that
+                 were filled in from the history.
+    type: dict
+retries:
+    description: With hpc and wait, the jobs resubmitted after running out of
+                 memory or time, with the new job ID and sbatch command.
+    type: list
+filter:
+    description: With quality_profile, the trunc_len and max_ee used for each amplicon.
+    type: dict
+plan:
+    description: In check mode, what would run instead of running it - the
+                 samples, the command of each, input bytes, expected output
+                 bytes and estimated cpu_hours and wall_hours, with the source
+                 of the estimate (ledger, slurm_history or benchmark; null if
+                 none has runs of the step). Nothing is written or submitted.
+    type: dict
 '''
 
 from ansible.module_utils.basic import AnsibleModule
 import glob
 import subprocess
 import imp
+import json
+import os
+import shutil
 # import importlib
 from os.path import expanduser
 
 def dada2_sample_inference_arg_spec(slurm, **kwargs):
     spec = dict(
-        reads=dict(type='path', default=None, required=True),
+        reads=dict(type='path', default=None, required=False),
         hpc=dict(type='bool', default=False),
+        ledger=dict(type='bool', default=False),
+        wait=dict(type='bool', default=False),
+        cost_model=dict(type='path', default=None, required=False),
         executable=dict(type='path', default=None, required=False),
         base_dir=dict(type='path', default=None, required=False),
+        pilot=dict(type='bool', default=False),
         extension=dict(type='str', default='.extendedFrags.fastq'),
         trunc_len=dict(type='int', default=0, required=False),
+        quality_profile=dict(type='path', default=None, required=False),
         nbases=dict(type='int', default=1000000, required=False),
-        output=dict(type='str', required=True),
+        output=dict(type='str', required=False),
         random_seed=dict(type='int', default=0),
         max_consist=dict(type='int', default=10),
+        learn_reads=dict(type='int', default=0),
+        max_ee=dict(type='float', default=None, required=False),
+        trunc_q=dict(type='int', default=2, required=False),
+        max_n=dict(type='int', default=0, required=False),
+        min_len=dict(type='int', default=20, required=False),
+        chunk_size=dict(type='int', default=100000, required=False),
+        threads=dict(type='int', default=None, required=False),
+        mem_per_thread=dict(type='str', default='4G', required=False),
+        pool=dict(type='raw', default='false'),
+        shards=dict(type='int', default=1),
+        asv_ids=dict(type='str', default='md5', choices=['md5', 'sha1', 'sequence']),
+        checkpoint=dict(type='bool', default=True),
+        restart=dict(type='bool', default=False),
+        worker=dict(type='bool', default=False),
+        worker_name=dict(type='str', default='worker'),
+        worker_state=dict(type='str', default='started', choices=['started', 'stopped']),
         slurm_spec=dict(type='dict', default=slurm.slurm_arg_spec(), required=False)
     )
     spec.update(kwargs)
     return spec
 
-def build_sample_inference_command(module, dada2_path, executable):
+def build_sample_inference_command(module, slurm, dada2_path, executable, reads=None, output=None, amplicon=None,
+        tracking=None, mode='all'):
+    reads = reads or module.params['reads']
+    output = output or module.params['output']
+    trunc_len, max_ee = filter_settings(module, amplicon)
     cmd = [executable, '%s/sample_inference.R' % dada2_path, '%s/.biolighthouse/conda/envs/biolighthouse/lib/R/library' % module.params['base_dir'],
-        module.params['reads'], ".extended", str(module.params['trunc_len']), ".extended", str(module.params['random_seed']),
-        str(module.params['nbases']), str(module.params['max_consist']), '%s/%s.csv' % (dada2_path, module.params['output']),
-        '%s/%s.rds' % (dada2_path, module.params['output'])]
+        reads, ".extended", str(trunc_len), ".extended", str(module.params['random_seed']),
+        str(module.params['nbases']), str(module.params['max_consist']), '%s/%s.csv' % (dada2_path, output),
+        '%s/%s.rds' % (dada2_path, output), checkpoint_dir(module, dada2_path, output) if module.params['checkpoint'] else '""',
+        'Inf' if max_ee is None else str(max_ee), str(module.params['trunc_q']),
+        str(module.params['max_n']), str(module.params['min_len']), str(module.params['chunk_size']),
+        thread_count(module, slurm), pool_mode(module), module.params['asv_ids'], '%s/%s_asvs.fasta' % (dada2_path, output),
+        '%s/samples/%s' % (dada2_path, output), str(module.params['learn_reads']),
+        tracking.stage_path(module.params['base_dir'], 'denoise', output) if tracking else '""', amplicon or '""',
+        fingerprint(module, amplicon), mode, str(module.params['shards'])]
     return cmd
 
+def fingerprint(module, amplicon=None):
+    """Return the settings the filtered reads, error model and denoised
+    samples of a checkpoint depend on, as one shell-safe word. pool is left
+    out: its checkpoints are kept in files of their own."""
+    trunc_len, max_ee = filter_settings(module, amplicon)
+    return ','.join('%s=%s' % kv for kv in (('trunc_len', trunc_len), ('max_ee', 'Inf' if max_ee is None else max_ee),
+        ('trunc_q', module.params['trunc_q']), ('max_n', module.params['max_n']), ('min_len', module.params['min_len']),
+        ('random_seed', module.params['random_seed']), ('nbases', module.params['nbases']),
+        ('max_consist', module.params['max_consist']), ('learn_reads', module.params['learn_reads'])))
+
+def reset_checkpoints(module, ckpt, amplicon=None):
+    """Remove the checkpoints in ckpt on restart, or when they were made
+    with other settings than the current ones. The R script checks the
+    settings again when it starts, along with the merged reads, which on
+    HPC may still be written by an earlier job."""
+    if not os.path.isdir(ckpt):
+        return
+    old = None
+    if os.path.isfile('%s/fingerprint.txt' % ckpt):
+        with open('%s/fingerprint.txt' % ckpt) as f:
+            old = f.readline().rstrip('\n')
+    if module.params['restart'] or old != fingerprint(module, amplicon):
+        shutil.rmtree(ckpt)
+
+def filter_settings(module, amplicon=None):
+    """Return the (trunc_len, max_ee) of an amplicon: the recommendation
+    in quality_profile if one is given, else the options."""
+    if not module.params['quality_profile']:
+        return module.params['trunc_len'], module.params['max_ee']
+    with open(module.params['quality_profile']) as f:
+        rec = json.load(f).get('amplicons', {}).get(amplicon or '')
+    if not rec or rec.get('trunc_len') is None:
+        module.fail_json(msg='%s has no recommendation for %s.' % (module.params['quality_profile'],
+            amplicon or 'these reads'))
+    return rec['trunc_len'], rec['max_ee']
+
+def pool_mode(module):
+    # Accept YAML booleans as well as the strings.
+    return str(module.params['pool']).lower()
+
+def thread_count(module, slurm):
+    """Return the thread count for the R script. Without an explicit
+    threads value, a job with slurm_spec.mem is limited to one thread
+    per mem_per_thread so parallel filtering cannot exhaust the
+    allocation; otherwise DADA2 uses every core.
+    """
+    if module.params['threads']:
+        return str(module.params['threads'])
+    spec = module.params['slurm_spec'] or {}
+    if module.params['hpc'] and spec.get('mem'):
+        threads = max(1, slurm.parse_mem(spec['mem']) // slurm.parse_mem(module.params['mem_per_thread']))
+        if spec.get('tasks_per_node'):
+            threads = min(threads, spec['tasks_per_node'])
+        return str(threads)
+    return 'TRUE'
+
+def sharded(module):
+    return module.params['hpc'] and module.params['shards'] > 1 and pool_mode(module) != 'true'
+
+def stages(module):
+    """Return the (mode, array) stages of a sharded run."""
+    array = ['--array=0-%d' % (module.params['shards'] - 1)]
+    passes = [('denoise', array)]
+    if pool_mode(module) == 'pseudo':
+        passes += [('priors', []), ('pseudo', array)]
+    return [('prepare', [])] + passes + [('final', [])]
+
+def submit_sharded(module, slurm, ledger, tracking, dada2_path, executable, amplicons):
+    """Submit the stages of a sharded run, each a script with one line per
+    (amplicon, reads, output) and depending on the one before."""
+    scripts = []
+    for mode, extra in stages(module):
+        name = 'dada2_sample_inference_%s' % mode
+        # Array tasks are told apart by their index in the ledger.
+        sample = 'shard_$SLURM_ARRAY_TASK_ID' if extra else None
+        lines = [ledger.line(module, name, sample or amplicon, ' '.join(build_sample_inference_command(module, slurm, dada2_path, executable, reads, output, amplicon,
+            tracking, mode))) for amplicon, reads, output in amplicons]
+        with open('%s/%s.sh' % (dada2_path, name), 'w') as f:
+            f.write('%s\n\n%s' % ('#!/bin/bash', '\n'.join(lines)))
+        subprocess.call(['chmod', '0700', '%s/%s.sh' % (dada2_path, name)])
+        report = '%s_%%a.report' % name if extra else '%s.report' % name
+        scripts.append(('%s/%s.sh' % (dada2_path, name), '%s/%s' % (dada2_path, report), extra))
+    return slurm.submit_chain(module, scripts, dada2_path)
+
+def checkpoint_dir(module, dada2_path, output=None):
+    return '%s/checkpoints/%s' % (dada2_path, output or module.params['output'])
+
+def plan_sample_inference(module, slurm, samples, plan, ledger, tracking, dada2_path, executable, result):
+    """Return the check-mode plan: one command per amplicon over its
+    merged reads."""
+    names = []
+    cmds = []
+    total = 0
+    for amplicon, reads in samples.amplicon_dirs(module.params['reads'], '*.extended*'):
+        output = '%s_%s' % (module.params['output'], amplicon) if amplicon else None
+        files = sorted(glob.glob('%s/*.extended*' % reads))
+        names.extend(os.path.basename(f).split('.extended')[0] for f in files)
+        total += samples.input_size(['%s/*.extended*' % reads])[0]
+        for mode, extra in stages(module) if sharded(module) else [('all', [])]:
+            cmds.append(' '.join(build_sample_inference_command(module, slurm, dada2_path, executable, reads, output,
+                amplicon, tracking, mode)))
+    if module.params['hpc']:
+        result['slurm_auto'] = slurm.autosize(module, 'dada2_sample_inference', total, len(names))
+    return plan.build(module, slurm, ledger, 'dada2_sample_inference', names, cmds, total)
+
 def main():
     tool = imp.load_source('utils.tool', '/tmp/biol/tool.py')
     slurm = imp.load_source('utils.slurm', '/tmp/biol/slurm.py')
+    rworker = imp.load_source('utils.rworker', '/tmp/biol/rworker.py')
+    samples = imp.load_source('utils.samples', '/tmp/biol/samples.py')
+    ledger = imp.load_source('utils.ledger', '/tmp/biol/ledger.py')
+    plan = imp.load_source('utils.plan', '/tmp/biol/plan.py')
+    tracking = imp.load_source('utils.tracking', '/tmp/biol/tracking.py')
+    pilot = imp.load_source('utils.pilot', '/tmp/biol/pilot.py')
     argument_spec=dada2_sample_inference_arg_spec(slurm)
     module = AnsibleModule(argument_spec,
+                           required_if=[['worker_state', 'started', ['reads', 'output']]],
                            supports_check_mode=True
                            )
     result = dict(
@@ -152,18 +511,60 @@ def main():
         err='',
         cmd=''
     )
+    if module.params['worker_state'] == 'stopped':
+        if module.check_mode:
+            result['changed'] = rworker.worker_pid(module.params['base_dir'], module.params['worker_name']) is not None
+        else:
+            result['changed'] = rworker.stop(module, module.params['worker_name'])
+        module.exit_json(**result)
+    pilot.apply(module, result)
+    if pool_mode(module) not in ('false', 'pseudo', 'true'):
+        module.fail_json(msg='pool must be false, pseudo or true.')
+    if sharded(module) and not module.params['checkpoint']:
+        module.fail_json(msg='shards needs checkpoint, through which the jobs hand over.')
     dada2 = tool.Tool(module.params['base_dir'], 'rscript')
     executable = dada2.get_executable_path(module)
 
+    dada2_path = "%s/.biolighthouse/DADA2" % module.params['base_dir']
+
     if module.check_mode:
-        return result
+        plan.exit_plan(module, result, plan_sample_inference(module, slurm, samples, plan, ledger, tracking, dada2_path,
+            executable, result))
 
-    dada2_path = "%s/.biolighthouse/DADA2" % module.params['base_dir']
+    if module.params['hpc']:
+        # Before the commands, as the thread count follows slurm_spec.mem.
+        size, count = samples.input_size(['%s/*.extended*' % module.params['reads'],
+            '%s/*/*.extended*' % module.params['reads']])
+        result['slurm_auto'] = slurm.autosize(module, 'dada2_sample_inference', size, count)
 
-    cmd = build_sample_inference_command(module, dada2_path, executable)
+    # One inference per amplicon when the merged reads were demultiplexed.
+    cmds = []
+    lines = []
+    amplicons = []
+    for amplicon, reads in samples.amplicon_dirs(module.params['reads'], '*.extended*'):
+        output = '%s_%s' % (module.params['output'], amplicon) if amplicon else None
+        if module.params['checkpoint']:
+            reset_checkpoints(module, checkpoint_dir(module, dada2_path, output), amplicon)
+        amplicons.append((amplicon, reads, output))
+        cmds.append(build_sample_inference_command(module, slurm, dada2_path, executable, reads, output, amplicon,
+            tracking))
+        if module.params['quality_profile']:
+            trunc_len, max_ee = filter_settings(module, amplicon)
+            result.setdefault('filter', {})[amplicon or ''] = dict(trunc_len=trunc_len, max_ee=max_ee)
+        lines.append(ledger.line(module, 'dada2_sample_inference', amplicon, ' '.join(cmds[-1]),
+            samples.input_size(['%s/*.extended*' % reads])[0]))
+    if sharded(module):
+        rc, out, err, cmds, job_ids = submit_sharded(module, slurm, ledger, tracking, dada2_path, executable, amplicons)
+        result['cmd'] = cmds
+        result['changed'] = True
+        result['out'] = out
+        result['err'] = err
+        result['rc'] = rc
+        slurm.wait_if_requested(module, job_ids, result)
+        module.exit_json(**result)
     # print(cmd)
     with open('%s/dada2_sample_inference.sh' % (dada2_path), 'w') as f:
-        f.write('%s\n\n%s' % ('#!/bin/bash', ' '.join(cmd)))
+        f.write('%s\n\n%s' % ('#!/bin/bash', '\n'.join(lines)))
         f.close()
 
     # if module.params['slurm_spec']['account'] is not None:
@@ -177,11 +578,19 @@ def main():
         # rc, out, err = module.run_command(cmd, cwd=dada2_path)
     import subprocess
     subprocess.call(['chmod', '0700', '%s/dada2_sample_inference.sh' % dada2_path])
-    rc, out, err = module.run_command(cmd_2, cwd=dada2_path)
+    job_id = None
+    if module.params['hpc']:
+        rc, out, err, job_id = slurm.submit(module, cmd_2, dada2_path)
+    elif module.params['worker']:
+        rc, out, err = rworker.run_all(module, executable, cmds, module.params['worker_name'])
+    else:
+        rc, out, err = module.run_command(cmd_2, cwd=dada2_path)
     result['changed'] = True
     # result['out'] = out
     result['err'] = err
     result['rc'] = rc
+    if job_id is not None:
+        slurm.wait_if_requested(module, [job_id], result)
     # result['cmd'] = cmd_2
 
     module.exit_json(**result)
@@ -16,8 +16,37 @@ author: "Tanner Dowhy (@TannerDowhy)"
 options:
     input_rds:
         description: 
-            -Input .rds ASV table from DADA2 sample inference step.
-        required: True
+            - Input .rds ASV table from DADA2 sample inference step, or a list
+              of them (one per sequencing run) to merge with
+              mergeSequenceTables. Sample names must be unique across runs.
+            - Not read when chimera_chunk_size is set.
+        required: false
+    input_samples:
+        description:
+            - Per-sample ASV directories written by DADA2 Sample Inference
+              (DADA2/samples/<output>), one per run, for chimera_chunk_size.
+              Sample names must be unique across runs.
+        required: false
+    chimera_chunk_size:
+        description:
+            - Remove chimeras this many samples at a time from input_samples
+              instead of loading the whole table. Consensus votes and pooled
+              abundances are summed over the chunks, so peak memory follows
+              the chunk size and not the number of samples. 0 loads
+              input_rds in one piece.
+        required: false
+        default: 0
+    min_length:
+        description:
+            - Shortest ASV kept. With chimera_chunk_size, shorter ASVs are
+              dropped as each sample is loaded.
+        required: false
+        default: 50
+    max_length:
+        description:
+            - Longest ASV kept.
+        required: false
+        default: 500
     executable:
         description:
             - The path to the Cutadapt executable. Should be specified but if
@@ -43,7 +72,105 @@ options:
     training_set:
         description:
             - The path to the training set for assigning taxonomy.
-        required: true
+            - Required unless worker_state is stopped.
+        required: false
+    species_ref:
+        description:
+            - Optional species reference FASTA with "ID Genus species"
+              headers, e.g. silva_species_assignment_v132.fa.gz. Adds a
+              Species column from the references of the genus assignTaxonomy
+              gave each ASV that match it exactly or, failing that, contain
+              it (ASVs cut by trunc_len, references not cut to the
+              amplicon). When several species match the ASV gets none,
+              unless allow_multiple is set. The reference is indexed by
+              sequence once, into <name>.index.rds next to the training set,
+              and the index is reused until the reference changes.
+        required: false
+    species_primers:
+        description:
+            - Forward and reverse primers (IUPAC codes allowed) used to cut
+              each species reference to the amplicon when the index is
+              built, so ASVs can match it exactly. Without them the
+              reference must already hold the amplicon region.
+        required: false
+        suboptions:
+            forward:
+                description: Forward primer, 5' to 3'.
+            reverse:
+                description: Reverse primer, 5' to 3'.
+    allow_multiple:
+        description:
+            - With species_ref, name every species that matches an ASV,
+              joined with "/", instead of none when they tie, like
+              assignSpecies' allowMultiple.
+        required: false
+        default: false
+    cache:
+        description:
+            - Keep chimera verdicts under DADA2/cache, one file per
+              output_seqtab and chimera_method, and taxonomy assignments
+              under DADA2/cache/<training set>_<key> and reuse them, so only
+              ASVs not seen in an earlier run are checked and classified. The
+              key is a hash of the size and modification time of the
+              training set and of random_seed, so a new release of the
+              training set under the same name is classified afresh. Not
+              used for chimera checking with the per-sample method.
+        required: false
+        default: true
+    asv_ids:
+        description:
+            - How ASVs are named in the CSV tables. md5 and sha1 use the hash
+              of the sequence, which is stable across runs and projects, and
+              write the sequences to <output_seqtab>_asvs.fasta. sequence keeps the
+              full sequence as the name. The RDS output always keeps the
+              sequences.
+        required: false
+        default: md5
+        choices: [md5, sha1, sequence]
+    random_seed:
+        description:
+            - The random seed for the taxonomy bootstrap.
+        required: false
+        default: 0
+    shards:
+        description:
+            - With hpc, split the ASVs to classify into this many chunks after
+              chimera removal and classify each in its own SLURM array task
+              with the same training set and seed. A final job merges the
+              chunks into the taxonomy table. Each task gets slurm_spec.
+        required: false
+        default: 1
+    shard_threads:
+        description:
+            - Threads assignTaxonomy uses in each array task.
+        required: false
+        default: 1
+    worker:
+        description:
+            - Run the R script in a long-lived local R worker (worker.R)
+              instead of a new Rscript, started on first use. The worker
+              keeps dada2 loaded and the most recently read RDS files in
+              memory (up to 2 GB), so repeated runs while tuning parameters
+              skip the library and table loading. Ignored with hpc.
+            - Requests go through a FIFO in .biolighthouse/worker, which only
+              the owner can open, and the worker only runs the scripts
+              next to worker.R.
+        required: false
+        default: false
+    worker_name:
+        description:
+            - Name of the worker, so several can run under one base_dir.
+        required: false
+        default: worker
+    worker_state:
+        description:
+            - C(stopped) stops the worker named worker_name and removes its
+              FIFO, lock and pid files instead of running anything, e.g. at
+              the end of a tuning session. Only base_dir and worker_name are
+              read then. changed is whether a worker was running.
+        required: false
+        default: started
+        choices: [started, stopped]
     output_seqtab:
         description:
             - Name of the output ASV table:
@@ -54,13 +181,62 @@ options:
             - Name of the output taxonomy table
         required: false
         default: taxonomy_final
+    ledger:
+        description:
+            - Run each command of the generated scripts through
+              .biolighthouse/ledger.py, which appends its step, sample,
+              times, CPU, peak memory and I/O to .biolighthouse/ledger.jsonl.
+              Query it with python .biolighthouse/ledger.py slowest or trends.
+            - The commands are measured with the python3 (or python) found
+              where the script runs, and run unmeasured where there is none.
+        required: false
+        default: false
+    wait:
+        description:
+            - With hpc, wait for the submitted jobs to finish instead of
+              returning as soon as sbatch accepts them. sacct is polled for
+              all jobs at once, backing off from slurm_spec.poll_interval to
+              max_poll_interval seconds. The task fails unless every job
+              completed. Combine with async for long steps.
+            - With slurm_spec.retries, jobs that end OUT_OF_MEMORY or
+              TIMEOUT are resubmitted that many times with mem or time
+              multiplied by slurm_spec.mem_factor or time_factor (default
+              2), up to max_mem or max_time. Only the failed tasks of an
+              array are rerun, and jobs queued behind them are resubmitted
+              to wait on the new ones.
+            - Waiting fails the task after slurm_spec.max_wait minutes (by
+              default four times the time the jobs asked for, plus that of
+              any retries) or after five sacct failures in a row, naming
+              the jobs that were still running.
+        required: false
+        default: false
+    cost_model:
+        description:
+            - A report written by benchmarks/pipeline_benchmark.py, used by
+              check mode to estimate times when neither the ledger nor the
+              SLURM history has runs of this step.
+        required: false
     slurm_spec: 
         description:
             - The SLURM options if hpc was set to true.
+            - With auto_size, the mem, time and tasks_per_node left empty are
+              filled in from the input bytes and sample count, using a fit
+              per tool over earlier runs in .biolighthouse/slurm_history.jsonl
+              plus safety margins, within max_mem and max_time. Runs are
+              added to the history when wait is set.
         required: false
         note: Required if hpc was set to true.
+    pilot:
+        description:
+            - Run on the subset drawn by pilot_subset, in its work area
+              (.biolighthouse/pilot) instead of base_dir. Paths under
+              base_dir/.biolighthouse, and the input the subset was drawn
+              from, are moved there.
+        required: false
+        default: false
 notes:
     - Requires DADA2 Sample Inference as input. 
+    - One of input_rds or input_samples is required.
 '''
 
 EXAMPLES = '''
@@ -71,6 +247,36 @@ EXAMPLES = '''
     training_set: "{{ base_path }}/.biolighthouse/DADA2/silva_nr_v132_train_set.fa.gz"
     hpc: False
 
+- name: Merge a new run into a longitudinal project
+  dada2_taxonomy:
+    input_rds:
+      - "{{ base_path }}/.biolighthouse/DADA2/seqtab_run1.rds"
+      - "{{ base_path }}/.biolighthouse/DADA2/seqtab_run2.rds"
+    base_dir: "{{ base_path }}"
+    training_set: "{{ base_path }}/.biolighthouse/DADA2/silva_nr_v132_train_set.fa.gz"
+    hpc: False
+
+- name: Assign species from the V4 region of the SILVA species reference
+  dada2_taxonomy:
+    input_rds: "{{ base_path }}/.biolighthouse/DADA2/seqtab.rds"
+    base_dir: "{{ base_path }}"
+    training_set: "{{ base_path }}/.biolighthouse/DADA2/silva_nr_v132_train_set.fa.gz"
+    species_ref: "{{ base_path }}/.biolighthouse/DADA2/silva_species_assignment_v132.fa.gz"
+    species_primers:
+      forward: GTGYCAGCMGCCGCGGTAA
+      reverse: GGACTACNVGGGTWTCTAAT
+    hpc: False
+
+- name: Remove chimeras 200 samples at a time
+  dada2_taxonomy:
+    input_samples: "{{ base_path }}/.biolighthouse/DADA2/samples/seqtab"
+    chimera_chunk_size: 200
+    min_length: 250
+    max_length: 260
+    base_dir: "{{ base_path }}"
+    training_set: "{{ base_path }}/.biolighthouse/DADA2/silva_nr_v132_train_set.fa.gz"
+    hpc: False
+
 - name: Run DADA2 Taxonomy module
   dada2_taxonomy:
     input_rds: "{{ base_path }}/.biolighthouse/DADA2/seqtab.rds"
@@ -85,6 +291,21 @@ EXAMPLES = '''
       time: 48:00
       num_nodes: 4
       tasks_per_node: 32
+
+- name: Classify ASVs in 16 array tasks
+  dada2_taxonomy:
+    input_rds: "{{ base_path }}/.biolighthouse/DADA2/seqtab.rds"
+    base_dir: "{{ base_path }}"
+    training_set: "{{ base_path }}/.biolighthouse/DADA2/silva_nr_v132_train_set.fa.gz"
+    shards: 16
+    shard_threads: 4
+    hpc: True
+    slurm_spec:
+      account: "{{ account }}"
+      job_name: "biolighthouse"
+      mem: 16G
+      time: 6:00:00
+      tasks_per_node: 4
 '''
 
 RETURN = '''
@@ -95,41 +316,189 @@ out:
     description: The output message that the module generates
 err:
     description: The error message that the modules generates
+jobs:
+    description: With hpc and wait, the final state, exit code, elapsed
+                 seconds and MaxRSS (max_rss_mb) of every job and array task.
+    type: list
+slurm_auto:
+    description: With hpc and slurm_spec.auto_size, the slurm_spec values that
+                 were filled in from the history.
+    type: dict
+retries:
+    description: With hpc and wait, the jobs resubmitted after running out of
+                 memory or time, with the new job ID and sbatch command.
+    type: list
+plan:
+    description: In check mode, what would run instead of running it - the
+                 samples, the command of each, input bytes, expected output
+                 bytes and estimated cpu_hours and wall_hours, with the source
+                 of the estimate (ledger, slurm_history or benchmark; null if
+                 none has runs of the step). Nothing is written or submitted.
+    type: dict
 '''
 
 from ansible.module_utils.basic import AnsibleModule
 import imp
 import glob
 import subprocess
+import os
+import hashlib
 from os.path import expanduser
 
 def dada2_taxonomy_arg_spec(slurm, **kwargs):
     spec = dict(
-        input_rds=dict(type='path', required=True),
+        input_rds=dict(type='list', default=None, required=False),
+        input_samples=dict(type='list', default=None, required=False),
+        chimera_chunk_size=dict(type='int', default=0),
+        min_length=dict(type='int', default=50),
+        max_length=dict(type='int', default=500),
         hpc=dict(type='bool', default=False),
+        ledger=dict(type='bool', default=False),
+        wait=dict(type='bool', default=False),
+        cost_model=dict(type='path', default=None, required=False),
         executable=dict(type='path', default=None, required=False),
         base_dir=dict(type='path', default=None, required=False),
+        pilot=dict(type='bool', default=False),
         chimera_method=dict(type='str', default='consensus', choices=['consensus', 'pooled', 'per-sample']),
-        training_set=dict(type='path', required=True),
+        training_set=dict(type='path', required=False),
+        species_ref=dict(type='path', default=None, required=False),
+        species_primers=dict(type='dict', default=None, required=False),
+        allow_multiple=dict(type='bool', default=False),
         output_seqtab=dict(type='str', default='seqtab_final'),
         output_taxonomy=dict(type='str', default='taxonomy_final'),
+        cache=dict(type='bool', default=True),
+        asv_ids=dict(type='str', default='md5', choices=['md5', 'sha1', 'sequence']),
+        random_seed=dict(type='int', default=0),
+        shards=dict(type='int', default=1),
+        shard_threads=dict(type='int', default=1),
+        worker=dict(type='bool', default=False),
+        worker_name=dict(type='str', default='worker'),
+        worker_state=dict(type='str', default='started', choices=['started', 'stopped']),
         slurm_spec=dict(type='dict', default=slurm.slurm_arg_spec(), required=False)
     )
     spec.update(kwargs)
     return spec
 
-def build_taxonomy_command(module, dada2_path, executable):
+def build_taxonomy_command(module, dada2_path, executable, mode='all', tracking=None):
     cmd = [executable, '%s/taxonomy.R' % dada2_path, '%s/.biolighthouse/software/R/library' % module.params['base_dir'],
-        module.params['input_rds'], module.params['chimera_method'], module.params['training_set'], '%s/%s.csv' % (dada2_path, module.params['output_seqtab']),
+        joined_paths(module.params['input_rds']), module.params['chimera_method'], module.params['training_set'], '%s/%s.csv' % (dada2_path, module.params['output_seqtab']),
         '%s/%s.csv' % (dada2_path, module.params['output_taxonomy']), '%s/%s.rds' % (dada2_path, module.params['output_seqtab']), '%s/%s.rds'
         % (dada2_path, module.params['output_taxonomy'])]
+    if module.params['cache']:
+        cmd.extend(['%s/cache' % dada2_path, taxonomy_cache_dir(module, dada2_path)])
+    else:
+        cmd.extend(['""', '""'])
+    cmd.extend([module.params['asv_ids'], '%s/%s_asvs.fasta' % (dada2_path, module.params['output_seqtab'])])
+    cmd.extend([mode, shard_dir(module, dada2_path), str(module.params['shards']), str(module.params['random_seed'])])
+    cmd.extend([str(module.params['chimera_chunk_size']), str(module.params['min_length']), str(module.params['max_length']),
+        joined_paths(module.params['input_samples'])])
+    cmd.extend(build_species_args(module))
+    cmd.append(tracking.stage_path(module.params['base_dir'], 'nonchim', module.params['output_seqtab']) if tracking else '""')
+    cmd.append(str(module.params['allow_multiple']))
     return cmd
 
+def build_species_args(module):
+    if not module.params['species_ref']:
+        return ['""', '""', '""', '""']
+    primers = module.params['species_primers'] or {}
+    return [module.params['species_ref'], species_index_path(module), primers.get('forward') or '""',
+        primers.get('reverse') or '""']
+
+def species_index_path(module):
+    """Return the species index next to the training set. The name
+    carries the primers, since they change which region is indexed."""
+    name = os.path.basename(module.params['species_ref'])
+    for ext in ('.gz', '.fa', '.fasta'):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    primers = module.params['species_primers']
+    if primers:
+        name = '%s_%s' % (name, hashlib.md5(('%s,%s' % (primers.get('forward'), primers.get('reverse'))).encode()).hexdigest()[:8])
+    return '%s/%s.index.rds' % (os.path.dirname(module.params['training_set']), name)
+
+def joined_paths(paths):
+    if not paths:
+        return '""'
+    return ','.join(expanduser(path) for path in paths)
+
+def shard_dir(module, dada2_path):
+    return '%s/shards/%s' % (dada2_path, module.params['output_taxonomy'])
+
+def build_shard_command(module, dada2_path, executable):
+    return [executable, '%s/taxonomy_shard.R' % dada2_path, '%s/.biolighthouse/software/R/library' % module.params['base_dir'],
+        shard_dir(module, dada2_path), module.params['training_set'], str(module.params['random_seed']),
+        str(module.params['shard_threads'])]
+
+def write_script(path, line):
+    with open(path, 'w') as f:
+        f.write('%s\n\n%s' % ('#!/bin/bash', line))
+        f.close()
+    subprocess.call(['chmod', '0700', path])
+
+def submit_sharded(module, slurm, ledger, tracking, dada2_path, executable):
+    """Submit chimera removal, one array task per shard of ASVs to
+    classify, and the final merge, each depending on the one before."""
+    stages = [('dada2_taxonomy', build_taxonomy_command(module, dada2_path, executable, 'chimera', tracking), []),
+        ('dada2_taxonomy_shard', build_shard_command(module, dada2_path, executable),
+            ['--array=0-%d' % (module.params['shards'] - 1)]),
+        ('dada2_taxonomy_merge', build_taxonomy_command(module, dada2_path, executable, 'merge'), [])]
+    scripts = []
+    for name, cmd, extra in stages:
+        # Array tasks are told apart by their index in the ledger.
+        sample = 'shard_$SLURM_ARRAY_TASK_ID' if extra else None
+        write_script('%s/%s.sh' % (dada2_path, name), ledger.line(module, name, sample, ' '.join(cmd)))
+        report = '%s_%%a.report' % name if extra else '%s.report' % name
+        scripts.append(('%s/%s.sh' % (dada2_path, name), '%s/%s' % (dada2_path, report), extra))
+    return slurm.submit_chain(module, scripts, dada2_path)
+
+def taxonomy_cache_dir(module, dada2_path):
+    """Return the taxonomy cache of the training set. The name carries the
+    size and modification time of the file and the random seed, so a new
+    release under the same name, or another seed, starts a new cache."""
+    try:
+        st = os.stat(module.params['training_set'])
+    except OSError:
+        module.fail_json(msg='training_set %s not found.' % module.params['training_set'])
+    key = '%d,%d,%d' % (st.st_size, int(st.st_mtime), module.params['random_seed'])
+    return '%s/cache/%s_%s' % (dada2_path, training_set_name(module), hashlib.md5(key.encode()).hexdigest()[:8])
+
+def training_set_name(module):
+    name = os.path.basename(module.params['training_set'])
+    for ext in ('.gz', '.fa', '.fasta'):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return name
+
+def input_patterns(module):
+    return ([expanduser(rds) for rds in module.params['input_rds'] or []]
+        + ['%s/*.rds' % expanduser(d) for d in module.params['input_samples'] or []])
+
+def plan_taxonomy(module, slurm, samples, plan, ledger, tracking, dada2_path, executable, result):
+    """Return the check-mode plan: the taxonomy command, or with shards
+    the chimera, shard and merge commands."""
+    size, count = samples.input_size(input_patterns(module))
+    names = [os.path.basename(f) for p in input_patterns(module) for f in sorted(glob.glob(p))]
+    if module.params['hpc']:
+        result['slurm_auto'] = slurm.autosize(module, 'dada2_taxonomy', size, count)
+    if module.params['hpc'] and module.params['shards'] > 1:
+        cmds = [build_taxonomy_command(module, dada2_path, executable, 'chimera', tracking),
+            build_shard_command(module, dada2_path, executable), build_taxonomy_command(module, dada2_path, executable, 'merge')]
+    else:
+        cmds = [build_taxonomy_command(module, dada2_path, executable, tracking=tracking)]
+    return plan.build(module, slurm, ledger, 'dada2_taxonomy', names, [' '.join(c) for c in cmds], size)
+
 def main():
     slurm = imp.load_source('utils.slurm', '/tmp/biol/slurm.py')
+    rworker = imp.load_source('utils.rworker', '/tmp/biol/rworker.py')
+    samples = imp.load_source('utils.samples', '/tmp/biol/samples.py')
+    ledger = imp.load_source('utils.ledger', '/tmp/biol/ledger.py')
     tool = imp.load_source('utils.tool', '/tmp/biol/tool.py')
+    plan = imp.load_source('utils.plan', '/tmp/biol/plan.py')
+    tracking = imp.load_source('utils.tracking', '/tmp/biol/tracking.py')
+    pilot = imp.load_source('utils.pilot', '/tmp/biol/pilot.py')
     argument_spec=dada2_taxonomy_arg_spec(slurm)
     module = AnsibleModule(argument_spec,
+                           required_if=[['worker_state', 'started', ['training_set']]],
                            supports_check_mode=True
                            )
     # if module.params['hpc']:
@@ -140,33 +509,58 @@ def main():
         err='',
         cmd=''
     )
+    if module.params['worker_state'] == 'stopped':
+        if module.check_mode:
+            result['changed'] = rworker.worker_pid(module.params['base_dir'], module.params['worker_name']) is not None
+        else:
+            result['changed'] = rworker.stop(module, module.params['worker_name'])
+        module.exit_json(**result)
+    if not module.params['input_rds'] and not module.params['input_samples']:
+        module.fail_json(msg='one of the following is required: input_rds, input_samples')
+    pilot.apply(module, result)
     dada2 = tool.Tool(module.params['base_dir'], 'rscript')
     executable = dada2.get_executable_path(module)
 
+    dada2_path = "%s/.biolighthouse/DADA2" % module.params['base_dir']
+
     if module.check_mode:
-        return result
+        plan.exit_plan(module, result, plan_taxonomy(module, slurm, samples, plan, ledger, tracking, dada2_path, executable,
+            result))
 
-    dada2_path = "%s/.biolighthouse/DADA2" % module.params['base_dir']
+    size, count = samples.input_size(input_patterns(module))
+    if module.params['hpc']:
+        result['slurm_auto'] = slurm.autosize(module, 'dada2_taxonomy', size, count)
 
-    cmd = build_taxonomy_command(module, dada2_path, executable)
+    if module.params['hpc'] and module.params['shards'] > 1:
+        rc, out, err, cmds, job_ids = submit_sharded(module, slurm, ledger, tracking, dada2_path, executable)
+        result['cmd'] = cmds
+        result['changed'] = True
+        result['out'] = out
+        result['err'] = err
+        result['rc'] = rc
+        slurm.wait_if_requested(module, job_ids, result)
+        module.exit_json(**result)
 
-    with open('%s/dada2_taxonomy.sh' % (dada2_path), 'w') as f:
-        f.write('%s\n\n%s' % ('#!/bin/bash', ' '.join(cmd)))
-        f.close()
+    cmd = build_taxonomy_command(module, dada2_path, executable, tracking=tracking)
+    write_script('%s/dada2_taxonomy.sh' % dada2_path, ledger.line(module, 'dada2_taxonomy', None, ' '.join(cmd), size))
 
     # if module.params['slurm_spec']['account'] is not None:
-    import subprocess
-    subprocess.call(['chmod', '0700', '%s/dada2_taxonomy.sh' % dada2_path])
+    job_id = None
     if module.params['hpc']:
         slurm_cmd = slurm.build_slurm_cmd(module)
         slurm_cmd.extend(['--output=%s/dada2_taxonomy.report' % dada2_path, '%s/dada2_taxonomy.sh' % dada2_path])
-        rc, out, err = module.run_command(slurm_cmd, cwd=dada2_path)
+        rc, out, err, job_id = slurm.submit(module, slurm_cmd, dada2_path)
+    elif module.params['worker']:
+        rc, out, err = rworker.run_all(module, executable, [cmd], module.params['worker_name'])
     else:
-        rc, out, err = module.run_command(cmd, cwd=dada2_path)
+        # Run through the script so quoted empty arguments reach R intact.
+        rc, out, err = module.run_command(['./dada2_taxonomy.sh'], cwd=dada2_path)
     result['changed'] = True
     result['out'] = out
     result['err'] = err
     result['rc'] = rc
+    if job_id is not None:
+        slurm.wait_if_requested(module, [job_id], result)
 
     module.exit_json(**result)
 
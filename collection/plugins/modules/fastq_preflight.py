@@ -0,0 +1,159 @@
+#!/usr/bin/python
+
+# Copyright: (c) 2019, Tanner Dowhy <tanner.dowhy@usask.ca>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+ANSIBLE_METADATA = {'metadata_version': '1.1'}
+
+DOCUMENTATION = '''
+---
+module: Validate paired FASTQ input before the pipeline runs on it.
+description:
+    - Checks every R1/R2 file pair for gzip integrity (a truncated or
+      corrupt .fastq.gz fails), record structure (@ header, + separator,
+      sequence and quality of equal length), equal read counts and the
+      same read ID at every position in both mates.
+    - Pairs are checked in a process pool, largest first, each streamed
+      once with constant memory. A pair whose worker dies (e.g. killed for
+      running out of memory) is reported invalid and checked again on the
+      next run.
+    - Read counts go to .biolighthouse/preflight/counts.json with the size
+      and modification time of each file. Unchanged files are not read
+      again, and later steps take input read counts from there. The
+      read pairs of every valid sample are the input of the read tracking
+      (see read_tracking).
+version_added: "2.7"
+author: "Tanner Dowhy (@TannerDowhy)"
+options:
+    input_files:
+        description:
+            - Path to the paired FASTQ files. Samples sequenced over several
+              lanes are checked lane by lane and counted as one sample.
+        required: true
+    base_dir:
+        description:
+            - The path to where the analysis is to take place.
+        required: true
+        default: Home directory. This needs to be changed if the user doesn't
+                 have write access to the home directory or if the environment
+                 requires a different path such as in the case of Compute Canada.
+    processes:
+        description:
+            - Pairs checked at the same time. 0 uses every core.
+        required: false
+        default: 0
+    reuse:
+        description:
+            - Take the results of files unchanged since the last check from
+              counts.json instead of reading them again.
+        required: false
+        default: true
+    fail_on_error:
+        description:
+            - Fail the task when any pair is invalid. Otherwise the invalid
+              samples are only listed in the result.
+        required: false
+        default: true
+    pilot:
+        description:
+            - Run on the subset drawn by pilot_subset, in its work area
+              (.biolighthouse/pilot) instead of base_dir. Paths under
+              base_dir/.biolighthouse, and the input the subset was drawn
+              from, are moved there.
+        required: false
+        default: false
+notes:
+    - In check mode the pairs that would be read are listed, without reading them.
+'''
+
+EXAMPLES = '''
+- name: Validate the reads before primer removal
+  fastq_preflight:
+    input_files: "{{ base_path }}/reads"
+    base_dir: "{{ base_path }}"
+    processes: 8
+'''
+
+RETURN = '''
+samples:
+    description: Per sample, the read pairs, input bytes, errors found and
+                 whether the result was reused from an earlier check.
+    type: list
+invalid:
+    description: The samples with errors.
+    type: list
+reads:
+    description: Read pairs over all samples.
+    type: int
+plan:
+    description: In check mode, the samples, the file pairs that would be
+                 read and their bytes.
+    type: dict
+'''
+
+from ansible.module_utils.basic import AnsibleModule
+import imp
+import time
+from os.path import expanduser
+
+def fastq_preflight_arg_spec(**kwargs):
+    spec = dict(
+        input_files=dict(type='path', required=True),
+        base_dir=dict(type='path', default=expanduser('~')),
+        pilot=dict(type='bool', default=False),
+        processes=dict(type='int', default=0),
+        reuse=dict(type='bool', default=True),
+        fail_on_error=dict(type='bool', default=True)
+    )
+    spec.update(kwargs)
+    return spec
+
+def main():
+    samples = imp.load_source('utils.samples', '/tmp/biol/samples.py')
+    preflight = imp.load_source('utils.preflight', '/tmp/biol/preflight.py')
+    tracking = imp.load_source('utils.tracking', '/tmp/biol/tracking.py')
+    pilot = imp.load_source('utils.pilot', '/tmp/biol/pilot.py')
+    argument_spec=fastq_preflight_arg_spec()
+    module = AnsibleModule(argument_spec,
+                           supports_check_mode=True
+                           )
+    result = dict(
+        changed=False,
+        samples=[],
+        invalid=[],
+        reads=0
+    )
+    pilot.apply(module, result)
+
+    found = samples.discover_samples(module.params['input_files'])
+    if not found:
+        module.fail_json(msg='No paired FASTQ files found in %s.' % module.params['input_files'], **result)
+
+    if module.check_mode:
+        counts = preflight.load_counts(module.params['base_dir']) if module.params['reuse'] else {}
+        pairs = [[r1, r2] for s in found for r1, r2 in zip(s['r1'], s['r2'])
+            if preflight.cached(counts, r1, r2) is None]
+        result['plan'] = dict(step='fastq_preflight', samples=[s['name'] for s in found], pairs=pairs,
+            input_bytes=sum(s['bytes'] for s in found))
+        result['changed'] = bool(pairs)
+        module.exit_json(**result)
+
+    start = time.time()
+    checked = preflight.validate(module.params['base_dir'], found, module.params['processes'], module.params['reuse'])
+    result['samples'] = checked
+    result['invalid'] = [s['sample'] for s in checked if s['errors']]
+    result['reads'] = sum(s['reads'] for s in checked)
+    result['seconds'] = round(time.time() - start, 3)
+    result['changed'] = any(not s['reused'] for s in checked)
+    tracking.write(tracking.stage_path(module.params['base_dir'], 'input'), [dict(sample=s['sample'], stage='input',
+        reads_in=s['reads'], reads_out=s['reads']) for s in checked if not s['errors']])
+    if result['invalid'] and module.params['fail_on_error']:
+        module.fail_json(msg='%d of %d samples failed preflight: %s' % (len(result['invalid']), len(checked),
+            '; '.join('%s: %s' % (s['sample'], s['errors'][0]) for s in checked if s['errors'])), **result)
+    module.exit_json(**result)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+#!/usr/bin/python
+
+# Copyright: (c) 2019, Tanner Dowhy <tanner.dowhy@usask.ca>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+ANSIBLE_METADATA = {'metadata_version': '1.1'}
+
+DOCUMENTATION = '''
+---
+module: Choose trunc_len and max_ee for DADA2 from the quality of the merged reads.
+description:
+    - Reads the quality scores of reads drawn uniformly from the whole of
+      every sample (seeded reservoir sampling in one pass, as in
+      pilot_subset) and profiles them per position across samples.
+    - For every truncation length and each of max_ee_choices it counts the
+      reads filterAndTrim would keep, with trunc_q and min_len applied the
+      same way, and recommends the longest trunc_len that keeps
+      target_retention of the reads, with the strictest maxEE that does
+      not force it shorter.
+    - The profile is written to .biolighthouse/quality/<output>.json:
+      per amplicon the recommendation, the 10/25/50/75/90th percentile of
+      quality and the number of reads at each position, the fraction kept
+      at every truncation length for each maxEE, and the retention of each
+      sample. Give it to dada2_sample_inference as quality_profile to use
+      the recommendations.
+version_added: "2.7"
+author: "Tanner Dowhy (@TannerDowhy)"
+options:
+    reads:
+        description:
+            - The path to the merged reads, as given to
+              dada2_sample_inference. If it holds one directory per
+              amplicon, each is profiled on its own.
+        required: true
+    base_dir:
+        description:
+            - The path to where the analysis is to take place.
+        required: true
+        default: Home directory. This needs to be changed if the user doesn't
+                 have write access to the home directory or if the environment
+                 requires a different path such as in the case of Compute Canada.
+    extension:
+        description:
+            - The part of the file name after the sample name.
+        required: false
+        default: .extended
+    output:
+        description:
+            - The name of the profile file.
+        required: false
+        default: profile
+    subsample:
+        description:
+            - The number of reads drawn from each sample. Samples with
+              fewer are read whole.
+        required: false
+        default: 10000
+    seed:
+        description:
+            - The random seed of the draw, which depends only on it and the
+              sample name.
+        required: false
+        default: 0
+    target_retention:
+        description:
+            - The fraction of the profiled reads, over all samples, that
+              filtering should keep.
+        required: false
+        default: 0.9
+    max_ee_choices:
+        description:
+            - The maxEE values to choose from.
+        required: false
+        default: [1, 2, 3, 5]
+    trunc_q:
+        description:
+            - truncQ as it will be given to dada2_sample_inference.
+        required: false
+        default: 2
+    min_len:
+        description:
+            - The shortest trunc_len to recommend (minLen of dada2_sample_inference).
+        required: false
+        default: 20
+    pilot:
+        description:
+            - Run on the subset drawn by pilot_subset, in its work area
+              (.biolighthouse/pilot) instead of base_dir. Paths under
+              base_dir/.biolighthouse, and the input the subset was drawn
+              from, are moved there.
+        required: false
+        default: false
+notes:
+    - Needs numpy on the host.
+    - Fails when no truncation length keeps target_retention of the reads
+      of an amplicon; the profile is still written.
+'''
+
+EXAMPLES = '''
+- name: Profile the merged reads
+  quality_profile:
+    reads: "{{ base_path }}/.biolighthouse/merge/output"
+    base_dir: "{{ base_path }}"
+    target_retention: 0.85
+
+- name: Run DADA2 Sample Inference with the recommended filtering
+  dada2_sample_inference:
+    reads: "{{ base_path }}/.biolighthouse/merge/output"
+    base_dir: "{{ base_path }}"
+    output: seqtab
+    quality_profile: "{{ base_path }}/.biolighthouse/quality/profile.json"
+'''
+
+RETURN = '''
+trunc_len:
+    description: The recommended truncation length. With one directory per
+                 amplicon, see amplicons.
+    type: int
+max_ee:
+    description: The recommended maxEE.
+    type: float
+retention:
+    description: The fraction of the profiled reads kept with the recommendation.
+    type: float
+amplicons:
+    description: The trunc_len, max_ee and retention of each amplicon.
+    type: dict
+low_samples:
+    description: Samples keeping less than half the target retention with
+                 the recommendation.
+    type: list
+profile:
+    description: The path of the profile file.
+    type: str
+'''
+
+from ansible.module_utils.basic import AnsibleModule
+import imp
+import time
+from os.path import expanduser
+
+try:
+    import numpy
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+def quality_profile_arg_spec(**kwargs):
+    spec = dict(
+        reads=dict(type='path', required=True),
+        base_dir=dict(type='path', default=expanduser('~')),
+        pilot=dict(type='bool', default=False),
+        extension=dict(type='str', default='.extended'),
+        output=dict(type='str', default='profile'),
+        subsample=dict(type='int', default=10000),
+        seed=dict(type='int', default=0),
+        target_retention=dict(type='float', default=0.9),
+        max_ee_choices=dict(type='list', default=[1, 2, 3, 5]),
+        trunc_q=dict(type='int', default=2),
+        min_len=dict(type='int', default=20)
+    )
+    spec.update(kwargs)
+    return spec
+
+def main():
+    samples = imp.load_source('utils.samples', '/tmp/biol/samples.py')
+    pilot = imp.load_source('utils.pilot', '/tmp/biol/pilot.py')
+    argument_spec=quality_profile_arg_spec()
+    module = AnsibleModule(argument_spec,
+                           supports_check_mode=True
+                           )
+    result = dict(
+        changed=False,
+        amplicons={},
+        low_samples=[]
+    )
+    pilot.apply(module, result)
+    if not HAS_NUMPY:
+        module.fail_json(msg='quality_profile needs numpy on the host.')
+    quality = imp.load_source('utils.quality', '/tmp/biol/quality.py')
+    if not 0 < module.params['target_retention'] <= 1:
+        module.fail_json(msg='target_retention must be above 0 and at most 1.')
+    max_ees = [float(e) for e in module.params['max_ee_choices']]
+
+    path = quality.profile_path(module.params['base_dir'], module.params['output'])
+    result['profile'] = path
+    dirs = samples.amplicon_dirs(module.params['reads'], '*%s*' % module.params['extension'])
+    if module.check_mode:
+        result['plan'] = dict(step='quality_profile', amplicons=[a or '' for a, d in dirs],
+            samples=[n for a, d in dirs for n, f in quality.sample_files(d, module.params['extension'])],
+            reads_per_sample=module.params['subsample'], output=path)
+        module.exit_json(**result)
+
+    start = time.time()
+    saved = dict(target_retention=module.params['target_retention'], subsample=module.params['subsample'],
+        seed=module.params['seed'], trunc_q=module.params['trunc_q'], min_len=module.params['min_len'],
+        amplicons={})
+    for amplicon, reads in dirs:
+        p = quality.profile(reads, module.params['extension'], module.params['subsample'], max_ees,
+            module.params['target_retention'], module.params['trunc_q'], module.params['min_len'], pilot,
+            module.params['seed'])
+        saved['amplicons'][amplicon or ''] = p
+        result['amplicons'][amplicon or ''] = dict((k, p[k]) for k in ('trunc_len', 'max_ee', 'retention', 'reads'))
+        result['low_samples'].extend(s['sample'] for s in p['samples']
+            if s.get('retention', 0) < module.params['target_retention'] / 2)
+    quality.save(path, saved)
+    result['changed'] = True
+    result['seconds'] = round(time.time() - start, 3)
+    if len(dirs) == 1:
+        result.update((k, v) for k, v in list(result['amplicons'].values())[0].items() if k != 'reads')
+
+    failed = [a or 'reads' for a, v in sorted(result['amplicons'].items()) if v['trunc_len'] is None]
+    if failed:
+        module.fail_json(msg='No truncation length keeps %s of the reads of %s within max_ee_choices %s.'
+            % (module.params['target_retention'], ', '.join(failed), max_ees), **result)
+    module.exit_json(**result)
+
+if __name__ == '__main__':
+    main()
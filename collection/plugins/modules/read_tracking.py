@@ -0,0 +1,131 @@
+#!/usr/bin/python
+
+# Copyright: (c) 2019, Tanner Dowhy <tanner.dowhy@usask.ca>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+ANSIBLE_METADATA = {'metadata_version': '1.1'}
+
+DOCUMENTATION = '''
+---
+module: Join the read counts of every step into one read tracking table.
+description:
+    - Each step records the reads in and out of every sample as it
+      finishes, from what it already has rather than by counting files -
+      fastq_preflight the read pairs (input), cutadapt_paired_end its
+      reports (cutadapt), flash2_merge and pear_merge theirs (merge),
+      dada2_sample_inference the filterAndTrim result (filter) and the
+      denoised reads (denoise), and dada2_taxonomy the reads left after
+      chimera removal (nonchim). The stage files are in
+      .biolighthouse/tracking/stages/.
+    - This module joins them into .biolighthouse/tracking/read_tracking.tsv,
+      one row per sample (and amplicon, with a primer panel) with the reads
+      left after each stage, the fraction of the input left after the last
+      one and the stage that lost the largest share, and flags the rows
+      keeping less than min_fraction.
+    - Run it after any step to catch samples losing most of their reads
+      before the next one.
+version_added: "2.7"
+author: "Tanner Dowhy (@TannerDowhy)"
+options:
+    base_dir:
+        description:
+            - The path to where the analysis is to take place.
+        required: true
+        default: Home directory. This needs to be changed if the user doesn't
+                 have write access to the home directory or if the environment
+                 requires a different path such as in the case of Compute Canada.
+    min_fraction:
+        description:
+            - Rows keeping less than this fraction of their input reads are flagged.
+        required: false
+        default: 0.5
+    fail_on_flagged:
+        description:
+            - Fail the task when any row is flagged.
+        required: false
+        default: false
+    pilot:
+        description:
+            - Run on the subset drawn by pilot_subset, in its work area
+              (.biolighthouse/pilot) instead of base_dir. Paths under
+              base_dir/.biolighthouse, and the input the subset was drawn
+              from, are moved there.
+        required: false
+        default: false
+notes:
+    - Without fastq_preflight, the input is what the first recorded step read.
+    - With a primer panel, the input and cutadapt counts are of the whole
+      sample and repeated on each of its amplicons, so the fraction of an
+      amplicon is of all the sample's reads. dada2_taxonomy does not know
+      the amplicon of its tables, so nonchim is left empty.
+'''
+
+EXAMPLES = '''
+- name: Check how many reads each sample kept
+  read_tracking:
+    base_dir: "{{ base_path }}"
+    min_fraction: 0.3
+'''
+
+RETURN = '''
+samples:
+    description: The rows of the table.
+    type: list
+flagged:
+    description: The rows keeping less than min_fraction of their input.
+    type: list
+table:
+    description: The path of the table.
+    type: str
+'''
+
+from ansible.module_utils.basic import AnsibleModule
+import imp
+from os.path import expanduser
+
+def read_tracking_arg_spec(**kwargs):
+    spec = dict(
+        base_dir=dict(type='path', default=expanduser('~')),
+        pilot=dict(type='bool', default=False),
+        min_fraction=dict(type='float', default=0.5),
+        fail_on_flagged=dict(type='bool', default=False)
+    )
+    spec.update(kwargs)
+    return spec
+
+def main():
+    tracking = imp.load_source('utils.tracking', '/tmp/biol/tracking.py')
+    pilot = imp.load_source('utils.pilot', '/tmp/biol/pilot.py')
+    argument_spec=read_tracking_arg_spec()
+    module = AnsibleModule(argument_spec,
+                           supports_check_mode=True
+                           )
+    result = dict(
+        changed=False,
+        samples=[],
+        flagged=[]
+    )
+    pilot.apply(module, result)
+    result['table'] = '%s/read_tracking.tsv' % tracking.tracking_dir(module.params['base_dir'])
+
+    rows = tracking.join(tracking.load(module.params['base_dir']), module.params['min_fraction'])
+    if not rows:
+        module.fail_json(msg='No read counts in %s/stages; run a step first.'
+            % tracking.tracking_dir(module.params['base_dir']), **result)
+    result['samples'] = rows
+    result['flagged'] = [r for r in rows if r['flagged']]
+    if not module.check_mode:
+        tracking.write_table(result['table'], rows)
+        result['changed'] = True
+    if result['flagged'] and module.params['fail_on_flagged']:
+        module.fail_json(msg='%d of %d samples kept less than %s of their reads: %s' % (len(result['flagged']),
+            len(rows), module.params['min_fraction'], ', '.join('%s%s (%s, most lost at %s)' % (r['sample'],
+            '/%s' % r['amplicon'] if r['amplicon'] else '', r['fraction'], r['worst_stage'])
+            for r in result['flagged'])), **result)
+    module.exit_json(**result)
+
+if __name__ == '__main__':
+    main()
@@ -74,6 +74,10 @@ RETURN = '''
 actions:
   description: A list of actions taken by conda that modified packages.
   returned: changed
+plan:
+  description: In check mode, the packages that would be installed, removed
+               or updated.
+  returned: check mode
 '''
 
 from ansible.module_utils.basic import AnsibleModule
@@ -123,6 +127,7 @@ def main():
 
     target_packages = [conda.split_name_version(n, version) for n in name]
     installed_packages = conda.list_packages(environment)
+    plan = dict(install=[], remove=[], update=[])
 
     if state == 'present':
         absent_packages = conda.get_absent_packages(target_packages, installed_packages, check_version=True)
@@ -130,6 +135,7 @@ def main():
             if not module.check_mode:
                 actions = conda.install_packages(absent_packages, channel)
                 result['actions'] += actions
+            plan['install'] = absent_packages
             result['changed'] = True
     elif state == 'absent':
         present_packages = conda.get_present_packages(
@@ -140,6 +146,7 @@ def main():
             if not module.check_mode:
                 actions = conda.remove_packages(names, channel)
                 result['actions'] += actions
+            plan['remove'] = names
             result['changed'] = True
     elif state == 'latest':
         # Find missing packages first
@@ -153,6 +160,7 @@ def main():
             if not module.check_mode:
                 actions = conda.install_packages(absent_packages, channel)
                 result['actions'] += actions
+            plan['install'] = absent_packages
             result['changed'] = True
 
         if present_packages:
@@ -163,11 +171,12 @@ def main():
                 if not module.check_mode:
                     actions = conda.update_packages(names, channel)
                     result['actions'] += actions
+                plan['update'] = dry_actions
                 result['changed'] = True
 
 
     if module.check_mode:
-        return result
+        result['plan'] = plan
 
 
     module.exit_json(**result)
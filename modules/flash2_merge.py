@@ -19,7 +19,10 @@ author: "Tanner Dowhy (@TannerDowhy)"
 options:
     input_files:
         description:
-            - Path to the input FASTQ files to be merged
+            - Path to the input FASTQ files to be merged. If it holds one
+              directory per amplicon, as written by cutadapt_paired_end with
+              a primer panel, each is merged into output/<amplicon>/. Samples
+              sequenced over several lanes are merged as one sample.
         required: true
     executable:
         description:
@@ -38,11 +41,70 @@ options:
             - Boolean variable on whether the run is executed on a regular or HPC machine.
         required: false
         default: false
+    parallel:
+        description:
+            - The number of samples merged at the same time.
+        required: false
+        default: 1
+    ledger:
+        description:
+            - Run each command of the generated scripts through
+              .biolighthouse/ledger.py, which appends its step, sample,
+              times, CPU, peak memory and I/O to .biolighthouse/ledger.jsonl.
+              Query it with python .biolighthouse/ledger.py slowest or trends.
+            - The commands are measured with the python3 (or python) found
+              where the script runs, and run unmeasured where there is none.
+        required: false
+        default: false
+    wait:
+        description:
+            - With hpc, wait for the submitted jobs to finish instead of
+              returning as soon as sbatch accepts them. sacct is polled for
+              all jobs at once, backing off from slurm_spec.poll_interval to
+              max_poll_interval seconds. The task fails unless every job
+              completed. Combine with async for long steps.
+            - With slurm_spec.retries, jobs that end OUT_OF_MEMORY or
+              TIMEOUT are resubmitted that many times with mem or time
+              multiplied by slurm_spec.mem_factor or time_factor (default
+              2), up to max_mem or max_time. Only the failed tasks of an
+              array are rerun, and jobs queued behind them are resubmitted
+              to wait on the new ones.
+            - Waiting fails the task after slurm_spec.max_wait minutes (by
+              default four times the time the jobs asked for, plus that of
+              any retries) or after five sacct failures in a row, naming
+              the jobs that were still running.
+        required: false
+        default: false
+    cost_model:
+        description:
+            - A report written by benchmarks/pipeline_benchmark.py, used by
+              check mode to estimate times when neither the ledger nor the
+              SLURM history has runs of this step.
+        required: false
     slurm_spec: 
         description:
             - The SLURM options if hpc was set to true.
+            - Setting num_jobs or bytes_per_job packs the samples into that many
+              jobs (or jobs of roughly that many input bytes) balanced by input
+              size. time is then taken as the request for the largest job
+              and scaled down for the others. Every job gets mem, which
+              should cover parallel samples running at once.
+            - With auto_size, the mem, time and tasks_per_node left empty are
+              filled in from the input bytes and sample count of the
+              largest job (mem from the largest sample), using a fit per
+              tool over earlier jobs in .biolighthouse/slurm_history.jsonl
+              plus safety margins, within max_mem and max_time. Each job is
+              added to the history with its own input when wait is set.
         required: false
         note: Required if hpc was set to true.
+    pilot:
+        description:
+            - Run on the subset drawn by pilot_subset, in its work area
+              (.biolighthouse/pilot) instead of base_dir. Paths under
+              base_dir/.biolighthouse, and the input the subset was drawn
+              from, are moved there.
+        required: false
+        default: false
 notes:
     - This module will make you cool.
 '''
@@ -71,6 +133,20 @@ EXAMPLES = '''
     tasks_per_node: 1
     job_name: biolighthouse
     mem: 2G
+
+- name: Submit the merge and wait for it in the background
+  flash2_merge:
+    input_files: "{{ base_path }}/.biolighthouse/primer_removal/output"
+    base_dir: "{{ base_path }}"
+    hpc: True
+    wait: True
+    slurm_spec:
+      account: "{{ account }}"
+      time: 5:00
+      job_name: biolighthouse
+      mem: 2G
+  async: 86400
+  poll: 60
 '''
 
 RETURN = '''
@@ -81,91 +157,51 @@ out:
     description: The output message that the module generates
 err:
     description: The error message that the modules generates
+samples:
+    description: Per-sample pairs, merged pairs and merge rate, also written to
+                 reports/merge_summary.tsv. Only set when hpc is false.
+    type: list
+jobs:
+    description: With hpc and wait, the final state, exit code, elapsed
+                 seconds and MaxRSS (max_rss_mb) of every job and array task.
+    type: list
+slurm_auto:
+    description: With hpc and slurm_spec.auto_size, the slurm_spec values that
+                 were filled in from the history.
+    type: dict
+retries:
+    description: With hpc and wait, the jobs resubmitted after running out of
+                 memory or time, with the new job ID and sbatch command.
+    type: list
+plan:
+    description: In check mode, what would run instead of running it - the
+                 samples, the command of each, input bytes, expected output
+                 bytes and estimated cpu_hours and wall_hours, with the source
+                 of the estimate (ledger, slurm_history or benchmark; null if
+                 none has runs of the step). Nothing is written or submitted.
+    type: dict
 '''
 
 from ansible.module_utils.basic import AnsibleModule
 import imp
-import glob
 from os.path import expanduser
 import os
 
-def flash2_arg_spec(slurm, **kwargs):
-    spec = dict(
-        input_files=dict(type='path', required=True),
-        base_dir=dict(type='path', default=expanduser('~')),
-        hpc=dict(type='bool', default=False),
-        executable=dict(type='path', default=None, required=False),
-        quality_cutoff=dict(type='int', default=2),
-        percent_cutoff=dict(type='int', default=50),
-        no_discard=dict(type='bool', default=False),
-        compress=dict(type='bool', default=False),
-        min_overlap=dict(type='int', default=10),
-        max_overlap=dict(type='int', default=None),
-        min_overlap_outie=dict(type='int', default=35),
-        max_mismatch_density=dict(type='float', default=0.25),
-        allow_outies=dict(type='bool', default=False),
-        phred_offset=dict(type='int', default=33, choices=[33, 64]),
-        read_len=dict(type='int', default=100),
-        fragment_len=dict(type='int', default=180),
-        fragment_len_stddev=dict(type='int', default=18),
-        threads=dict(type='int', default=1),
-        slurm_spec=dict(type='dict', default=slurm.slurm_arg_spec(), required=False)
-    )
+def flash2_arg_spec(slurm, merger, **kwargs):
+    spec = merger.merge_arg_spec(slurm, **merger.flash2_arg_spec())
     spec.update(kwargs)
     return spec
 
-def run_flash2(fi, executable, merge_path, module):
-    f = fi.split('/')
-    f = f[-1]
-    f = f.replace('.fastq.gz', '')
-    b = f.replace('_R1', '')
-    file_r = fi.replace('_R1', '_R2')
-    f_r = f.replace('_R1', '_R2')
-    cmd = get_common_spec(module, executable)
-    cmd.extend([fi, file_r, '-o', 'output/%s' % f, '>', 'reports/%s.report' % f])
-    with open('%s/merge.sh' % (merge_path), 'a+') as f:
-        f.write('%s\n' % (' '.join(cmd)))
-        f.close()
-    return cmd
-
-def get_common_spec(module, executable):
-    cmd = [executable]
-    if module.params['quality_cutoff'] != 2:
-        cmd.extend(['-Q', str(module.params['quality_cutoff'])])
-    if module.params['percent_cutoff'] != 50:
-        cmd.extend(['-C', str(module.params['percent_cutoff'])])
-    if module.params['no_discard']:
-        cmd.extend(['--no-discard'])
-    if module.params['min_overlap'] != 10:
-        cmd.extend(['-m', str(module.params['min_overlap'])])
-    if module.params['max_overlap'] is not None:
-        cmd.extend(['-M', str(module.params['max_overlap'])])
-    if module.params['min_overlap_outie'] != 35:
-        cmd.extend(['-e', str(module.params['min_overlap_outie'])])
-    if module.params['max_mismatch_density'] != 0.25:
-        cmd.extend(['-X', str(module.params['max_mismatch_density'])])
-    if module.params['allow_outies']:
-        cmd.extend(['--allow-outies'])
-    if module.params['phred_offset'] == 64:
-        cmd.extend(['-p 64'])
-    if module.params['compress'] == True:
-        cmd.extend(['-z'])
-    if module.params['phred_offset'] == 33:
-        cmd.extend(['-p 33'])
-    if module.params['read_len'] != 100:
-        cmd.extend(['-r', str(module.params['read_len'])])
-    if module.params['fragment_len'] != 180:
-        cmd.extend(['-f', str(module.params['fragment_len'])])
-    if module.params['fragment_len_stddev'] != 18:
-        cmd.extend(['-s', str(module.params['fragment_len_stddev'])])
-    # if module.params['threads'] != 1:
-    cmd.extend(['-t', str(module.params['threads'])])
-    return cmd
-
 def main():
     slurm = imp.load_source('utils.slurm', '/tmp/biol/slurm.py')
     tool = imp.load_source('utils.tool', '/tmp/biol/tool.py')
-    argument_spec=flash2_arg_spec(slurm)
+    samples = imp.load_source('utils.samples', '/tmp/biol/samples.py')
+    merger = imp.load_source('utils.merger', '/tmp/biol/merger.py')
+    ledger = imp.load_source('utils.ledger', '/tmp/biol/ledger.py')
+    plan = imp.load_source('utils.plan', '/tmp/biol/plan.py')
+    tracking = imp.load_source('utils.tracking', '/tmp/biol/tracking.py')
+    pilot = imp.load_source('utils.pilot', '/tmp/biol/pilot.py')
+    argument_spec=flash2_arg_spec(slurm, merger)
     module = AnsibleModule(argument_spec,
                            supports_check_mode=True
                            )
@@ -176,36 +212,18 @@ def main():
         err='',
         cmd=''
     )
+    pilot.apply(module, result)
     flash2 = tool.Tool(module.params['base_dir'], 'flash2')
     executable = flash2.get_executable_path(module)
 
     if module.check_mode:
-        return result
+        plan.exit_plan(module, result, merger.plan_merge(module, 'flash2', executable, slurm, samples,
+            plan, ledger, result))
 
     merge_path = "%s/.biolighthouse/merge" % module.params['base_dir']
 
-    # if module.params['slurm_spec']['account'] is not None:
-    if module.params['hpc']:
-        slurm_cmd = slurm.build_slurm_cmd(module)
-    with open('%s/merge.sh' % (merge_path), 'w') as f:
-        f.write('%s\n\n' % ('#!/bin/bash'))
-        f.close()
-    import subprocess
-    subprocess.call(['chmod', '0777', '%s/merge.sh' % merge_path])
-    for file in glob.glob("%s/*_R1*" % (module.params['input_files'])):
-        cmd = run_flash2(file, executable, merge_path, module)
-
-    # if module.params['slurm_spec']['account'] is not None:
-    if module.params['hpc']:
-        cmd_2 = slurm_cmd
-        cmd_2.append('%s/merge.sh' % merge_path)
-    else:
-        cmd_2 = ['./merge.sh']
-    rc, out, err = module.run_command(cmd_2, cwd=merge_path)
-    result['rc'] = '%s' % (rc)
-    result['err'] += '%s' % (err)
-    result['changed'] = True
-    result['cmd'] = cmd_2
+    merger.run_merge(module, 'flash2', executable, merge_path, slurm, samples, result, ledger,
+        tracking)
     module.exit_json(**result)
 
 if __name__ == '__main__':
@@ -0,0 +1,237 @@
+#!/usr/bin/python
+
+# Copyright: (c) 2019, Tanner Dowhy <tanner.dowhy@usask.ca>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+ANSIBLE_METADATA = {'metadata_version': '1.1'}
+
+DOCUMENTATION = '''
+---
+module: This is an Ansible module to merge paired-end reads with PEAR.
+description:
+    - Merges each sample's read pairs with PEAR. Shares sample discovery,
+      per-sample parallelism, SLURM packing and reporting with flash2_merge
+      so the two can be swapped per project. Merged reads are written as
+      <sample>.extendedFrags.fastq so the DADA2 modules pick them up.
+version_added: "2.7"
+author: "Tanner Dowhy (@TannerDowhy)"
+options:
+    input_files:
+        description:
+            - Path to the input FASTQ files to be merged. Per-amplicon
+              directories and multi-lane samples are handled as in flash2_merge.
+        required: true
+    executable:
+        description:
+            - The path to the PEAR executable. Should be specified but if
+              it isn't it will be located.
+        required: false
+    base_dir:
+        description:
+            - The path to where the analysis is to take place.
+        required: true
+        default: Home directory.
+    hpc: 
+        description: 
+            - Boolean variable on whether the run is executed on a regular or HPC machine.
+        required: false
+        default: false
+    parallel:
+        description:
+            - The number of samples merged at the same time.
+        required: false
+        default: 1
+    min_overlap:
+        description:
+            - Minimum overlap size (-v).
+        required: false
+        default: 10
+    max_assembly_length:
+        description:
+            - Maximum length of the assembled sequences, 0 for no limit (-m).
+        required: false
+        default: 0
+    min_assembly_length:
+        description:
+            - Minimum length of the assembled sequences (-n).
+        required: false
+        default: 50
+    quality_threshold:
+        description:
+            - Quality score threshold for trimming low quality parts of a read (-q).
+        required: false
+        default: 0
+    p_value:
+        description:
+            - The p-value of the statistical test for an overlap (-p).
+        required: false
+        default: 0.01
+    threads:
+        description:
+            - The number of threads PEAR uses per sample (-j).
+        required: false
+        default: 1
+    ledger:
+        description:
+            - Run each command of the generated scripts through
+              .biolighthouse/ledger.py, which appends its step, sample,
+              times, CPU, peak memory and I/O to .biolighthouse/ledger.jsonl.
+              Query it with python .biolighthouse/ledger.py slowest or trends.
+            - The commands are measured with the python3 (or python) found
+              where the script runs, and run unmeasured where there is none.
+        required: false
+        default: false
+    wait:
+        description:
+            - With hpc, wait for the submitted jobs to finish instead of
+              returning as soon as sbatch accepts them. sacct is polled for
+              all jobs at once, backing off from slurm_spec.poll_interval to
+              max_poll_interval seconds. The task fails unless every job
+              completed. Combine with async for long steps.
+            - With slurm_spec.retries, jobs that end OUT_OF_MEMORY or
+              TIMEOUT are resubmitted that many times with mem or time
+              multiplied by slurm_spec.mem_factor or time_factor (default
+              2), up to max_mem or max_time. Only the failed tasks of an
+              array are rerun, and jobs queued behind them are resubmitted
+              to wait on the new ones.
+            - Waiting fails the task after slurm_spec.max_wait minutes (by
+              default four times the time the jobs asked for, plus that of
+              any retries) or after five sacct failures in a row, naming
+              the jobs that were still running.
+        required: false
+        default: false
+    cost_model:
+        description:
+            - A report written by benchmarks/pipeline_benchmark.py, used by
+              check mode to estimate times when neither the ledger nor the
+              SLURM history has runs of this step.
+        required: false
+    slurm_spec: 
+        description:
+            - The SLURM options if hpc was set to true, as in flash2_merge.
+            - With auto_size, the mem, time and tasks_per_node left empty are
+              filled in from the input bytes and sample count of the
+              largest job (mem from the largest sample), using a fit per
+              tool over earlier jobs in .biolighthouse/slurm_history.jsonl
+              plus safety margins, within max_mem and max_time. Each job is
+              added to the history with its own input when wait is set.
+        required: false
+        note: Required if hpc was set to true.
+    pilot:
+        description:
+            - Run on the subset drawn by pilot_subset, in its work area
+              (.biolighthouse/pilot) instead of base_dir. Paths under
+              base_dir/.biolighthouse, and the input the subset was drawn
+              from, are moved there.
+        required: false
+        default: false
+notes:
+    - PEAR must be installed.
+'''
+
+EXAMPLES = '''
+- name: Merge reads with PEAR
+  pear_merge:
+    input_files: "{{ base_path }}/.biolighthouse/primer_removal/output"
+    base_dir: "{{ base_path }}"
+    min_overlap: 20
+    parallel: 4
+    hpc: False
+
+- name: Submit the merge and wait for it in the background
+  pear_merge:
+    input_files: "{{ base_path }}/.biolighthouse/primer_removal/output"
+    base_dir: "{{ base_path }}"
+    hpc: True
+    wait: True
+    slurm_spec:
+      account: "{{ account }}"
+      time: 5:00
+      job_name: biolighthouse
+      mem: 2G
+  async: 86400
+  poll: 60
+'''
+
+RETURN = '''
+cmd:
+    description: The command that was executed
+    type: str
+out:
+    description: The output message that the module generates
+err:
+    description: The error message that the modules generates
+samples:
+    description: Per-sample pairs, merged pairs and merge rate, also written to
+                 reports/merge_summary.tsv. Only set when hpc is false.
+    type: list
+jobs:
+    description: With hpc and wait, the final state, exit code, elapsed
+                 seconds and MaxRSS (max_rss_mb) of every job and array task.
+    type: list
+slurm_auto:
+    description: With hpc and slurm_spec.auto_size, the slurm_spec values that
+                 were filled in from the history.
+    type: dict
+retries:
+    description: With hpc and wait, the jobs resubmitted after running out of
+                 memory or time, with the new job ID and sbatch command.
+    type: list
+plan:
+    description: In check mode, what would run instead of running it - the
+                 samples, the command of each, input bytes, expected output
+                 bytes and estimated cpu_hours and wall_hours, with the source
+                 of the estimate (ledger, slurm_history or benchmark; null if
+                 none has runs of the step). Nothing is written or submitted.
+    type: dict
+'''
+
+from ansible.module_utils.basic import AnsibleModule
+import imp
+from os.path import expanduser
+import os
+
+def pear_arg_spec(slurm, merger, **kwargs):
+    spec = merger.merge_arg_spec(slurm, **merger.pear_arg_spec())
+    spec.update(kwargs)
+    return spec
+
+def main():
+    slurm = imp.load_source('utils.slurm', '/tmp/biol/slurm.py')
+    tool = imp.load_source('utils.tool', '/tmp/biol/tool.py')
+    samples = imp.load_source('utils.samples', '/tmp/biol/samples.py')
+    merger = imp.load_source('utils.merger', '/tmp/biol/merger.py')
+    ledger = imp.load_source('utils.ledger', '/tmp/biol/ledger.py')
+    plan = imp.load_source('utils.plan', '/tmp/biol/plan.py')
+    tracking = imp.load_source('utils.tracking', '/tmp/biol/tracking.py')
+    pilot = imp.load_source('utils.pilot', '/tmp/biol/pilot.py')
+    argument_spec=pear_arg_spec(slurm, merger)
+    module = AnsibleModule(argument_spec,
+                           supports_check_mode=True
+                           )
+    result = dict(
+        changed=False,
+        rc = '',
+        out= '',
+        err='',
+        cmd=''
+    )
+    pilot.apply(module, result)
+    pear = tool.Tool(module.params['base_dir'], 'pear')
+    executable = pear.get_executable_path(module)
+
+    if module.check_mode:
+        plan.exit_plan(module, result, merger.plan_merge(module, 'pear', executable, slurm, samples,
+            plan, ledger, result))
+
+    merge_path = "%s/.biolighthouse/merge" % module.params['base_dir']
+
+    merger.run_merge(module, 'pear', executable, merge_path, slurm, samples, result, ledger,
+        tracking)
+    module.exit_json(**result)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/python
+
+# Copyright: (c) 2019, Tanner Dowhy <tanner.dowhy@usask.ca>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+ANSIBLE_METADATA = {'metadata_version': '1.1'}
+
+DOCUMENTATION = '''
+---
+module: Draw a small random subset of every sample for pilot runs.
+description:
+    - Draws a number of read pairs (reads) from every sample by seeded
+      reservoir sampling, in one pass over its files (all lanes), into
+      .biolighthouse/pilot/input. The pairs are kept in file order and the
+      draw of a sample depends only on seed and the sample name.
+    - .biolighthouse/pilot is set up as a separate work area with the
+      software, conda environments and R scripts of base_dir linked in.
+      Give pilot to any later module to run it there instead - input_files
+      becomes the subset, paths under base_dir/.biolighthouse are moved to
+      the same place in the pilot area, and everything it writes stays
+      there - so primers, merge settings and DADA2 parameters can be tried
+      in minutes with the same plays.
+    - Samples drawn before with the same reads and seed from unchanged
+      files are not drawn again.
+version_added: "2.7"
+author: "Tanner Dowhy (@TannerDowhy)"
+options:
+    input_files:
+        description:
+            - Path to the paired FASTQ files the subset is drawn from.
+        required: true
+    base_dir:
+        description:
+            - The path to where the analysis is to take place.
+        required: true
+        default: Home directory. This needs to be changed if the user doesn't
+                 have write access to the home directory or if the environment
+                 requires a different path such as in the case of Compute Canada.
+    reads:
+        description:
+            - Read pairs drawn per sample. Samples with fewer are copied whole.
+        required: false
+        default: 10000
+    seed:
+        description:
+            - The random seed.
+        required: false
+        default: 0
+    force:
+        description:
+            - Draw every sample again.
+        required: false
+        default: false
+notes:
+    - Changing reads or seed replaces the subset; outputs already in the
+      pilot area are from the old one until their steps are rerun.
+'''
+
+EXAMPLES = '''
+- name: Draw 5000 read pairs per sample
+  pilot_subset:
+    input_files: "{{ base_path }}/reads"
+    base_dir: "{{ base_path }}"
+    reads: 5000
+
+- name: Try a primer pair on the subset
+  cutadapt_paired_end:
+    input_files: "{{ base_path }}/reads"
+    base_dir: "{{ base_path }}"
+    primer: GTGYCAGCMGCCGCGGTAA
+    primer_r: GGACTACNVGGGTWTCTAAT
+    pilot: True
+
+- name: Merge the trimmed subset
+  flash2_merge:
+    input_files: "{{ base_path }}/.biolighthouse/primer_removal/output"
+    base_dir: "{{ base_path }}"
+    pilot: True
+'''
+
+RETURN = '''
+samples:
+    description: Per sample, the pairs read and kept and whether an earlier
+                 draw was reused.
+    type: list
+pilot:
+    description: The pilot area, laid out like a base_dir.
+    type: str
+'''
+
+from ansible.module_utils.basic import AnsibleModule
+import imp
+import os
+import time
+from os.path import expanduser
+
+def pilot_subset_arg_spec(**kwargs):
+    spec = dict(
+        input_files=dict(type='path', required=True),
+        base_dir=dict(type='path', default=expanduser('~')),
+        reads=dict(type='int', default=10000),
+        seed=dict(type='int', default=0),
+        force=dict(type='bool', default=False)
+    )
+    spec.update(kwargs)
+    return spec
+
+def main():
+    samples = imp.load_source('utils.samples', '/tmp/biol/samples.py')
+    pilot = imp.load_source('utils.pilot', '/tmp/biol/pilot.py')
+    tracking = imp.load_source('utils.tracking', '/tmp/biol/tracking.py')
+    argument_spec=pilot_subset_arg_spec()
+    module = AnsibleModule(argument_spec,
+                           supports_check_mode=True
+                           )
+    result = dict(
+        changed=False,
+        samples=[],
+        pilot=pilot.pilot_base(module.params['base_dir'])
+    )
+    if module.params['reads'] < 1:
+        module.fail_json(msg='reads must be at least 1.')
+
+    source = os.path.abspath(module.params['input_files'])
+    found = samples.discover_samples(source)
+    if not found:
+        module.fail_json(msg='No paired FASTQ files found in %s.' % source, **result)
+
+    if module.check_mode:
+        result['plan'] = dict(step='pilot_subset', samples=[s['name'] for s in found], reads=module.params['reads'],
+            input_bytes=sum(s['bytes'] for s in found), output=pilot.input_dir(module.params['base_dir']))
+        module.exit_json(**result)
+
+    start = time.time()
+    result['samples'] = pilot.subset(module.params['base_dir'], source, found, module.params['reads'],
+        module.params['seed'], module.params['force'])
+    result['changed'] = any(not s['reused'] for s in result['samples'])
+    result['seconds'] = round(time.time() - start, 3)
+    # The subset is the input of the pilot's read tracking.
+    tracking.write(tracking.stage_path(result['pilot'], 'input'), [dict(sample=s['sample'], stage='input',
+        reads_in=s['kept'], reads_out=s['kept']) for s in result['samples']])
+    module.exit_json(**result)
+
+if __name__ == '__main__':
+    main()
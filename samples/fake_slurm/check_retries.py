@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+# Copyright: (c) 2019, Tanner Dowhy <tanner.dowhy@usask.ca>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt
+
+"""Run slurm.wait_for_jobs against fake_slurm and check that
+
+- a job that ran out of memory is resubmitted with more memory, and the
+  job queued behind it is cancelled and resubmitted against the new ID;
+- waiting gives up after MAX_SACCT_ERRORS sacct failures in a row;
+- waiting gives up on a job that never starts once the deadline passes.
+
+    python samples/fake_slurm/check_retries.py
+
+Prints one line per check and exits non-zero if any fails.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', '..', 'utils'))
+import slurm
+
+
+class Failed(Exception):
+    pass
+
+
+class Module(object):
+    """Just enough of AnsibleModule for utils/slurm.py."""
+
+    def __init__(self, **spec):
+        defaults = dict((k, v.get('default')) for k, v in slurm.slurm_arg_spec().items())
+        self.params = dict(slurm_spec=dict(defaults, account='a', time='10', mem='1G', poll_interval=1,
+            max_poll_interval=1))
+        self.params['slurm_spec'].update(spec)
+
+    def run_command(self, cmd, cwd=None):
+        proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True)
+        out, err = proc.communicate()
+        return proc.returncode, out, err
+
+    def fail_json(self, **kwargs):
+        raise Failed(kwargs['msg'])
+
+
+def submit(module, cwd, dependency=None, wrap='true', mem=None):
+    cmd = slurm.build_slurm_cmd(module, mem=mem, dependency=dependency)
+    cmd.extend(['--parsable', '--wrap=%s' % wrap])
+    rc, out, err, job_id = slurm.submit(module, cmd, cwd)
+    assert rc == 0, err
+    return job_id
+
+
+def check_retry(cwd):
+    module = Module(retries=1)
+    os.environ['FAKE_SLURM_NEEDS_MEM'] = '2G'
+    try:
+        first = submit(module, cwd)
+        second = submit(module, cwd, dependency='afterok:%s' % first, mem='2G')
+        retries = []
+        jobs = slurm.wait_for_jobs(module, [first, second], retries)
+    finally:
+        del os.environ['FAKE_SLURM_NEEDS_MEM']
+    assert [r['job_id'] for r in retries] == [first], retries
+    assert '--mem=2G' in retries[0]['cmd'], retries[0]['cmd']
+    new_first = retries[0]['new_job_id']
+    new_second = [k for k in jobs if k != new_first]
+    assert len(new_second) == 1, jobs
+    assert '--dependency=afterok:%s' % new_first in slurm.submitted[new_second[0]][0]
+    assert all(j['state'] == 'COMPLETED' for j in jobs.values()), jobs
+    old = slurm.job_states(module, [first, second])
+    assert old[first]['state'] == 'OUT_OF_MEMORY' and old[second]['state'] == 'CANCELLED', old
+
+
+def check_sacct_errors(cwd):
+    module = Module()
+    job_id = submit(module, cwd)
+    os.environ['FAKE_SLURM_SACCT_FAIL'] = '1'
+    try:
+        slurm.wait_for_jobs(module, [job_id])
+    except Failed as e:
+        assert 'sacct failed %d times' % slurm.MAX_SACCT_ERRORS in str(e) and job_id in str(e), e
+    else:
+        raise AssertionError('wait_for_jobs returned although sacct failed')
+    finally:
+        del os.environ['FAKE_SLURM_SACCT_FAIL']
+
+
+def check_deadline(cwd):
+    module = Module()
+    failed = submit(module, cwd, wrap='false')
+    # Waits on a failed job, so stays PENDING
+    pending = submit(module, cwd, dependency='afterok:%s' % failed)
+    factor = slurm.WAIT_FACTOR
+    slurm.WAIT_FACTOR = 0.005
+    try:
+        slurm.wait_for_jobs(module, [pending])
+    except Failed as e:
+        assert 'Gave up waiting for jobs %s' % pending in str(e), e
+    else:
+        raise AssertionError('wait_for_jobs returned for a job that never ran')
+    finally:
+        slurm.WAIT_FACTOR = factor
+
+
+def main():
+    work = tempfile.mkdtemp(prefix='fake_slurm_check_')
+    os.environ['FAKE_SLURM_DIR'] = os.path.join(work, 'state')
+    os.environ['PATH'] = '%s%s%s' % (here, os.pathsep, os.environ['PATH'])
+    # Poll without waiting
+    slurm._time.sleep = lambda seconds: None
+    failures = 0
+    try:
+        for check in (check_retry, check_sacct_errors, check_deadline):
+            try:
+                check(work)
+                print('ok    %s' % check.__name__)
+            except AssertionError as e:
+                failures += 1
+                print('FAIL  %s: %s' % (check.__name__, e))
+    finally:
+        shutil.rmtree(work)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+# Copyright: (c) 2019, Tanner Dowhy <tanner.dowhy@usask.ca>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt
+
+"""A local stand-in for sbatch, sacct, squeue and scancel, for trying the
+hpc code paths of the modules without a cluster. Put this directory first
+on PATH; the command run is taken from the name it was called by.
+
+sbatch runs the job (or each array task) right away and records it in
+$FAKE_SLURM_DIR/state.json (default /tmp/fake_slurm). A job whose afterok
+dependency did not complete stays PENDING with reason
+DependencyNeverSatisfied. Setting FAKE_SLURM_NEEDS_MEM (e.g. 4G) or
+FAKE_SLURM_NEEDS_TIME (minutes) makes jobs asking for less end in
+OUT_OF_MEMORY or TIMEOUT without running, to exercise retries. Setting
+FAKE_SLURM_SACCT_FAIL makes sacct fail.
+
+check_retries.py in this directory runs the retry and wait paths of
+utils/slurm.py against it.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+STATE_DIR = os.environ.get('FAKE_SLURM_DIR', '/tmp/fake_slurm')
+STATE = os.path.join(STATE_DIR, 'state.json')
+
+def load():
+    if os.path.isfile(STATE):
+        with open(STATE) as f:
+            return json.load(f)
+    return dict(next=1000, jobs={})
+
+def save(state):
+    if not os.path.isdir(STATE_DIR):
+        os.makedirs(STATE_DIR)
+    with open(STATE, 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+
+def parse_mem(mem):
+    units = {'K': 1.0 / 1024, 'M': 1, 'G': 1024, 'T': 1024 * 1024}
+    mem = mem.strip().upper()
+    if mem[-1] in units:
+        return float(mem[:-1]) * units[mem[-1]]
+    return float(mem)
+
+def parse_minutes(t):
+    days = 0
+    if '-' in t:
+        d, t = t.split('-', 1)
+        days = int(d)
+        parts = [int(p) for p in t.split(':')] + [0, 0]
+        return days * 1440 + parts[0] * 60 + parts[1]
+    parts = [int(p) for p in t.split(':')]
+    if len(parts) == 3:
+        return parts[0] * 60 + parts[1] + parts[2] / 60.0
+    return parts[0] + (parts[1] / 60.0 if len(parts) > 1 else 0)
+
+def format_elapsed(seconds):
+    seconds = int(seconds)
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+def array_indices(spec):
+    spec = spec.split('%')[0]
+    indices = []
+    for part in spec.split(','):
+        if '-' in part:
+            a, b = part.split('-')
+            indices.extend(range(int(a), int(b) + 1))
+        else:
+            indices.append(int(part))
+    return indices
+
+def run_task(cmd, opts, job_id, task, env):
+    """Run one job or array task and return its record."""
+    if 'mem' in opts and os.environ.get('FAKE_SLURM_NEEDS_MEM'):
+        if parse_mem(opts['mem']) < parse_mem(os.environ['FAKE_SLURM_NEEDS_MEM']):
+            return dict(state='OUT_OF_MEMORY', exit_code='0:125', elapsed=1, max_rss=parse_mem(opts['mem']) * 1024)
+    if 'time' in opts and os.environ.get('FAKE_SLURM_NEEDS_TIME'):
+        if parse_minutes(opts['time']) < float(os.environ['FAKE_SLURM_NEEDS_TIME']):
+            return dict(state='TIMEOUT', exit_code='0:0', elapsed=int(parse_minutes(opts['time']) * 60), max_rss=0)
+    output = opts.get('output', 'slurm-%j.out').replace('%j', job_id).replace('%A', job_id)
+    output = output.replace('%a', str(task) if task is not None else '')
+    env = dict(env, SLURM_JOB_ID=job_id)
+    if task is not None:
+        env['SLURM_ARRAY_JOB_ID'] = job_id
+        env['SLURM_ARRAY_TASK_ID'] = str(task)
+    start = time.time()
+    with open(output, 'w') as out:
+        proc = subprocess.Popen(cmd, stdout=out, stderr=subprocess.STDOUT, env=env)
+        pid, status, usage = os.wait4(proc.pid, 0)
+    code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1
+    return dict(state='COMPLETED' if code == 0 else 'FAILED', exit_code='%d:0' % code,
+        elapsed=time.time() - start, max_rss=usage.ru_maxrss, cpu=usage.ru_utime + usage.ru_stime)
+
+def sbatch(argv):
+    opts = {}
+    flags = set()
+    rest = []
+    for i, arg in enumerate(argv):
+        if not arg.startswith('--'):
+            rest = argv[i:]
+            break
+        if '=' in arg:
+            key, value = arg[2:].split('=', 1)
+            opts[key] = value
+        else:
+            flags.add(arg[2:])
+    if 'wrap' in opts:
+        cmd = ['bash', '-c', opts['wrap']]
+    else:
+        cmd = ['bash'] + rest
+    state = load()
+    job_id = str(state['next'])
+    state['next'] += 1
+    name = opts.get('job-name', os.path.basename(rest[0]) if rest else 'wrap')
+    deps = []
+    dependency = opts.get('dependency', '')
+    if dependency.startswith('afterok:'):
+        deps = dependency.split(':')[1:]
+    blocked = False
+    for dep in deps:
+        tasks = [j for k, j in state['jobs'].items() if k == dep or k.startswith('%s_' % dep)]
+        if not tasks or any(j['state'] != 'COMPLETED' for j in tasks):
+            blocked = True
+    save(state)
+    tasks = array_indices(opts['array']) if 'array' in opts else [None]
+    for task in tasks:
+        key = job_id if task is None else '%s_%d' % (job_id, task)
+        if blocked:
+            record = dict(state='PENDING', exit_code='0:0', elapsed=0, max_rss=0, reason='DependencyNeverSatisfied')
+        else:
+            record = run_task(cmd, opts, job_id, task, os.environ.copy())
+        record['name'] = name
+        state = load()
+        state['jobs'][key] = record
+        save(state)
+    if 'parsable' in flags:
+        print(job_id)
+    else:
+        print('Submitted batch job %s' % job_id)
+    return 0
+
+def option(argv, name):
+    for arg in argv:
+        if arg.startswith('--%s=' % name):
+            return arg.split('=', 1)[1]
+    return None
+
+def selected(state, argv):
+    ids = option(argv, 'jobs')
+    ids = ids.split(',') if ids else None
+    name = option(argv, 'name')
+    for key in sorted(state['jobs']):
+        job = state['jobs'][key]
+        if ids is not None and key not in ids and key.split('_')[0] not in ids:
+            continue
+        if name is not None and job['name'] != name:
+            continue
+        yield key, job
+
+def sacct(argv):
+    # Always JobID|State|ExitCode|Elapsed|MaxRSS|TotalCPU, as slurm.job_states asks.
+    if os.environ.get('FAKE_SLURM_SACCT_FAIL'):
+        sys.stderr.write('sacct: error: Problem talking to the database\n')
+        return 1
+    for key, job in selected(load(), argv):
+        elapsed = format_elapsed(job['elapsed'])
+        cpu = job.get('cpu', 0)
+        print('%s|%s|%s|%s||%02d:%06.3f' % (key, job['state'], job['exit_code'], elapsed, cpu // 60, cpu % 60))
+        print('%s.batch|%s|%s|%s|%dK|' % (key, job['state'], job['exit_code'], elapsed, job['max_rss']))
+    return 0
+
+def squeue(argv):
+    fmt = option(argv, 'format') or '%i'
+    for key, job in selected(load(), argv):
+        if job['state'] in ('PENDING', 'RUNNING'):
+            print(fmt.replace('%i', key.split('_')[0]).replace('%r', job.get('reason', 'None')))
+    return 0
+
+def scancel(argv):
+    state = load()
+    for key, job in state['jobs'].items():
+        if key.split('_')[0] in argv and job['state'] in ('PENDING', 'RUNNING'):
+            job['state'] = 'CANCELLED'
+    save(state)
+    return 0
+
+if __name__ == '__main__':
+    command = os.path.basename(sys.argv[0])
+    commands = dict(sbatch=sbatch, sacct=sacct, squeue=squeue, scancel=scancel)
+    if command not in commands:
+        sys.exit('Call as one of %s' % ', '.join(sorted(commands)))
+    sys.exit(commands[command](sys.argv[1:]))
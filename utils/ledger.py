@@ -0,0 +1,186 @@
+#!/usr/bin/python
+
+# Copyright: (c) 2019, Tanner Dowhy <tanner.dowhy@usask.ca>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt
+
+"""The run ledger, .biolighthouse/ledger.jsonl, with one JSON line per
+command the generated scripts run: step, sample, command, host, SLURM job,
+start and end time, wall and CPU seconds, peak RSS, bytes read and written,
+input size and exit code.
+
+With the modules' ledger option, they copy this file to
+.biolighthouse/ledger.py and write each command as
+    if [ -f ledger.py ] && BIOLIGHTHOUSE_PY=$(command -v python3 || command -v python); then
+    "$BIOLIGHTHOUSE_PY" ledger.py run [--bytes N] LEDGER RUN STEP SAMPLE <<'BIOLIGHTHOUSE_CMD'
+    <command>
+    BIOLIGHTHOUSE_CMD
+    else
+    <command>
+    fi
+so it is measured wherever the job runs, with the python found there. Where
+there is none, or ledger.py is not reachable, the command runs unmeasured. Bytes read and written are the
+block I/O the kernel accounts to the command and its children, so reads
+served from the page cache are not counted.
+
+Query it with
+    python ledger.py slowest [--by step|sample] [--run RUN] [-n N]
+    python ledger.py trends [--step STEP]
+"""
+
+import argparse
+import datetime
+import fcntl
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+
+DELIMITER = 'BIOLIGHTHOUSE_CMD'
+
+# One run ID per module invocation, so entries of one run can be grouped.
+RUN = datetime.datetime.now().strftime('%Y%m%dT%H%M%S')
+
+installed = set()
+
+def ledger_path(base_dir):
+    return '%s/.biolighthouse/ledger.jsonl' % base_dir
+
+def install(base_dir):
+    """Copy this file to .biolighthouse/ledger.py, where the generated
+    scripts run it, and return that path."""
+    path = '%s/.biolighthouse/ledger.py' % base_dir
+    src = os.path.abspath(__file__)
+    if src.endswith('.pyc'):
+        src = src[:-1]
+    if path not in installed and src != path:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        shutil.copyfile(src, path)
+        installed.add(path)
+    return path
+
+def line(module, step, sample, cmd, size=None):
+    """Return the shell command line cmd, run through the ledger when the
+    module's ledger option is set. The command goes in a quoted
+    here-document so its quoting and redirections are kept as they are.
+    The python of the node the script runs on is used, since the one
+    running the module may not exist there, and cmd runs on its own when
+    there is no python or ledger.py. size, the bytes the command reads, is
+    recorded for check-mode plans.
+    """
+    if not module.params.get('ledger'):
+        return cmd
+    base_dir = module.params['base_dir']
+    script = install(base_dir)
+    return ("if [ -f %s ] && BIOLIGHTHOUSE_PY=$(command -v python3 || command -v python); then\n"
+        "\"$BIOLIGHTHOUSE_PY\" %s run %s%s %s %s %s <<'%s'\n%s\n%s\nelse\n%s\nfi\n") % (script, script,
+        '' if size is None else '--bytes %d ' % size, ledger_path(base_dir), RUN, step, sample or '-', DELIMITER,
+        cmd, DELIMITER, cmd)
+
+def record(path, entry):
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write('%s\n' % json.dumps(entry, sort_keys=True))
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+def timestamp(t):
+    return datetime.datetime.fromtimestamp(t).isoformat()
+
+def run(path, run_id, step, sample, cmd, size=None):
+    """Run cmd with bash, append its measurements to the ledger and return
+    its exit code."""
+    start = time.time()
+    devnull = open(os.devnull)
+    proc = subprocess.Popen(['bash', '-c', cmd], stdin=devnull)
+    pid, status, usage = os.wait4(proc.pid, 0)
+    end = time.time()
+    devnull.close()
+    rc = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 128 + os.WTERMSIG(status)
+    proc.returncode = rc
+    record(path, dict(run=run_id, step=step, sample=None if sample == '-' else sample, cmd=cmd,
+        host=socket.gethostname(), job_id=os.environ.get('SLURM_JOB_ID'), start=timestamp(start),
+        end=timestamp(end), wall=round(end - start, 3), cpu_user=round(usage.ru_utime, 3),
+        cpu_sys=round(usage.ru_stime, 3), max_rss_mb=round(usage.ru_maxrss / 1024.0, 1),
+        read_bytes=usage.ru_inblock * 512, write_bytes=usage.ru_oublock * 512, input_bytes=size, rc=rc))
+    return rc
+
+def load(path):
+    entries = []
+    if not os.path.isfile(path):
+        return entries
+    with open(path) as f:
+        for l in f:
+            try:
+                entries.append(json.loads(l))
+            except ValueError:
+                continue
+    return entries
+
+def steps(entries):
+    """Combine the entries of each step of each run: the wall time from the
+    first start to the last end, summed CPU and I/O and the peak RSS."""
+    grouped = {}
+    for e in entries:
+        grouped.setdefault((e['run'], e['step']), []).append(e)
+    out = []
+    for (run_id, step), group in sorted(grouped.items()):
+        first = min(e['start'] for e in group)
+        last = max(e['end'] for e in group)
+        wall = max(e['wall'] for e in group)
+        try:
+            fmt = '%Y-%m-%dT%H:%M:%S.%f'
+            wall = (datetime.datetime.strptime(last, fmt) - datetime.datetime.strptime(first, fmt)).total_seconds()
+        except ValueError:
+            pass
+        out.append(dict(run=run_id, step=step, sample=None, samples=len(group), wall=round(wall, 3),
+            cpu=round(sum(e['cpu_user'] + e['cpu_sys'] for e in group), 3),
+            max_rss_mb=max(e['max_rss_mb'] for e in group), read_bytes=sum(e['read_bytes'] for e in group),
+            write_bytes=sum(e['write_bytes'] for e in group), failed=sum(1 for e in group if e['rc'] != 0)))
+    return out
+
+def print_table(rows, columns):
+    print('\t'.join(columns))
+    for r in rows:
+        print('\t'.join('' if r.get(c) is None else str(r.get(c)) for c in columns))
+
+def main():
+    parser = argparse.ArgumentParser(description='Record commands in and query the run ledger.')
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('run', help='run a command read from stdin and record it')
+    p.add_argument('--bytes', type=int, default=None, help='bytes of input the command reads')
+    for arg in ('ledger', 'run_id', 'step', 'sample'):
+        p.add_argument(arg)
+    p = sub.add_parser('slowest', help='list the slowest samples or steps')
+    p.add_argument('--ledger', default=ledger_path(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    p.add_argument('--by', choices=['sample', 'step'], default='sample')
+    p.add_argument('--run', help='only this run (default: all)')
+    p.add_argument('-n', type=int, default=10)
+    p = sub.add_parser('trends', help='show each step across runs')
+    p.add_argument('--ledger', default=ledger_path(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    p.add_argument('--step', help='only this step (default: all)')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        sys.exit(run(args.ledger, args.run_id, args.step, args.sample, sys.stdin.read(), args.bytes))
+    entries = load(args.ledger)
+    if args.command == 'slowest':
+        if args.run:
+            entries = [e for e in entries if e['run'] == args.run]
+        rows = steps(entries) if args.by == 'step' else entries
+        rows = sorted(rows, key=lambda r: r['wall'], reverse=True)[:args.n]
+        columns = ['run', 'step', 'sample', 'wall', 'max_rss_mb', 'read_bytes', 'write_bytes']
+        print_table(rows, columns + (['samples', 'cpu', 'failed'] if args.by == 'step' else ['cpu_user', 'cpu_sys', 'rc']))
+    elif args.command == 'trends':
+        rows = steps(entries)
+        if args.step:
+            rows = [r for r in rows if r['step'] == args.step]
+        rows = sorted(rows, key=lambda r: (r['step'], r['run']))
+        print_table(rows, ['step', 'run', 'samples', 'wall', 'cpu', 'max_rss_mb', 'read_bytes', 'write_bytes', 'failed'])
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
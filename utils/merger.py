@@ -0,0 +1,314 @@
+#!/usr/bin/python
+
+# Copyright: (c) 2019, Tanner Dowhy <tanner.dowhy@usask.ca>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt
+
+import os
+import re
+import subprocess
+from os.path import expanduser
+
+# Downstream steps (dada2_sample_inference) look for flash2's naming, so
+# every backend leaves its merged reads under this suffix.
+MERGED_SUFFIX = '.extendedFrags.fastq'
+
+def merge_arg_spec(slurm, **kwargs):
+    spec = dict(
+        input_files=dict(type='path', required=True),
+        base_dir=dict(type='path', default=expanduser('~')),
+        pilot=dict(type='bool', default=False),
+        hpc=dict(type='bool', default=False),
+        ledger=dict(type='bool', default=False),
+        wait=dict(type='bool', default=False),
+        cost_model=dict(type='path', default=None, required=False),
+        executable=dict(type='path', default=None, required=False),
+        parallel=dict(type='int', default=1),
+        slurm_spec=dict(type='dict', default=slurm.slurm_arg_spec(), required=False)
+    )
+    spec.update(kwargs)
+    return spec
+
+def flash2_arg_spec():
+    return dict(
+        quality_cutoff=dict(type='int', default=2),
+        percent_cutoff=dict(type='int', default=50),
+        no_discard=dict(type='bool', default=False),
+        compress=dict(type='bool', default=False),
+        min_overlap=dict(type='int', default=10),
+        max_overlap=dict(type='int', default=None),
+        min_overlap_outie=dict(type='int', default=35),
+        max_mismatch_density=dict(type='float', default=0.25),
+        allow_outies=dict(type='bool', default=False),
+        phred_offset=dict(type='int', default=33, choices=[33, 64]),
+        read_len=dict(type='int', default=100),
+        fragment_len=dict(type='int', default=180),
+        fragment_len_stddev=dict(type='int', default=18),
+        threads=dict(type='int', default=1)
+    )
+
+def flash2_common_spec(params, executable):
+    cmd = [executable]
+    if params['quality_cutoff'] != 2:
+        cmd.extend(['-Q', str(params['quality_cutoff'])])
+    if params['percent_cutoff'] != 50:
+        cmd.extend(['-C', str(params['percent_cutoff'])])
+    if params['no_discard']:
+        cmd.extend(['--no-discard'])
+    if params['min_overlap'] != 10:
+        cmd.extend(['-m', str(params['min_overlap'])])
+    if params['max_overlap'] is not None:
+        cmd.extend(['-M', str(params['max_overlap'])])
+    if params['min_overlap_outie'] != 35:
+        cmd.extend(['-e', str(params['min_overlap_outie'])])
+    if params['max_mismatch_density'] != 0.25:
+        cmd.extend(['-X', str(params['max_mismatch_density'])])
+    if params['allow_outies']:
+        cmd.extend(['--allow-outies'])
+    if params['phred_offset'] == 64:
+        cmd.extend(['-p 64'])
+    if params['compress'] == True:
+        cmd.extend(['-z'])
+    if params['phred_offset'] == 33:
+        cmd.extend(['-p 33'])
+    if params['read_len'] != 100:
+        cmd.extend(['-r', str(params['read_len'])])
+    if params['fragment_len'] != 180:
+        cmd.extend(['-f', str(params['fragment_len'])])
+    if params['fragment_len_stddev'] != 18:
+        cmd.extend(['-s', str(params['fragment_len_stddev'])])
+    # if params['threads'] != 1:
+    cmd.extend(['-t', str(params['threads'])])
+    return cmd
+
+def flash2_cmd(params, sample, executable, prefix, report):
+    cmd = flash2_common_spec(params, executable)
+    cmd.extend([sample['r1_in'], sample['r2_in'], '-o', prefix, '>', report])
+    return cmd
+
+def flash2_report(text):
+    """Return (pairs, merged) from a flash2 report, or (None, None)."""
+    pairs = re.search(r'Total pairs:\s+(\d+)', text)
+    merged = re.search(r'Combined pairs:\s+(\d+)', text)
+    if not pairs or not merged:
+        return None, None
+    return int(pairs.group(1)), int(merged.group(1))
+
+def pear_arg_spec():
+    return dict(
+        min_overlap=dict(type='int', default=10),
+        max_assembly_length=dict(type='int', default=0),
+        min_assembly_length=dict(type='int', default=50),
+        min_trim_length=dict(type='int', default=1),
+        quality_threshold=dict(type='int', default=0),
+        max_uncalled_base=dict(type='float', default=1.0),
+        p_value=dict(type='float', default=0.01, choices=[0.0001, 0.001, 0.01, 0.05, 1.0]),
+        test_method=dict(type='int', default=1, choices=[1, 2]),
+        score_method=dict(type='int', default=2, choices=[1, 2, 3]),
+        empirical_freqs=dict(type='bool', default=True),
+        phred_base=dict(type='int', default=33, choices=[33, 64]),
+        memory=dict(type='str', default=None),
+        threads=dict(type='int', default=1)
+    )
+
+def pear_common_spec(params, executable):
+    cmd = [executable]
+    if params['min_overlap'] != 10:
+        cmd.extend(['-v', str(params['min_overlap'])])
+    if params['max_assembly_length'] != 0:
+        cmd.extend(['-m', str(params['max_assembly_length'])])
+    if params['min_assembly_length'] != 50:
+        cmd.extend(['-n', str(params['min_assembly_length'])])
+    if params['min_trim_length'] != 1:
+        cmd.extend(['-t', str(params['min_trim_length'])])
+    if params['quality_threshold'] != 0:
+        cmd.extend(['-q', str(params['quality_threshold'])])
+    if params['max_uncalled_base'] != 1.0:
+        cmd.extend(['-u', str(params['max_uncalled_base'])])
+    if params['p_value'] != 0.01:
+        cmd.extend(['-p', str(params['p_value'])])
+    if params['test_method'] != 1:
+        cmd.extend(['-g', str(params['test_method'])])
+    if params['score_method'] != 2:
+        cmd.extend(['-s', str(params['score_method'])])
+    if not params['empirical_freqs']:
+        cmd.extend(['-e'])
+    if params['phred_base'] != 33:
+        cmd.extend(['-b', str(params['phred_base'])])
+    if params['memory'] is not None:
+        cmd.extend(['-y', params['memory']])
+    cmd.extend(['-j', str(params['threads'])])
+    return cmd
+
+def pear_cmd(params, sample, executable, prefix, report):
+    # PEAR only reads uncompressed FASTQ files, and with empirical_freqs
+    # it counts the bases in a pass of its own before assembling, which a
+    # <(zcat) pipe cannot be read for twice. Compressed or multi-lane input
+    # is therefore decompressed next to the output first and removed after.
+    # The assembled reads are renamed to flash2's naming for the DADA2 steps.
+    cmd = []
+    inputs = []
+    temp = []
+    for mate, paths in (('R1', sample['r1']), ('R2', sample['r2'])):
+        if len(paths) == 1 and not paths[0].endswith('.gz'):
+            inputs.append(paths[0])
+            continue
+        path = '%s.pear_%s.fastq' % (prefix, mate)
+        cmd.extend(['zcat', '-f'] + paths + ['>', path, '&&'])
+        inputs.append(path)
+        temp.append(path)
+    cmd.extend(pear_common_spec(params, executable))
+    cmd.extend(['-f', inputs[0], '-r', inputs[1], '-o', prefix, '>', report, '&&',
+        'mv', '%s.assembled.fastq' % prefix, '%s%s' % (prefix, MERGED_SUFFIX)])
+    if temp:
+        cmd.extend([';', 'pear_rc=$?;', 'rm', '-f'] + temp + [';', '[', '$pear_rc', '-eq', '0', ']'])
+    return cmd
+
+def pear_report(text):
+    """Return (pairs, merged) from a PEAR report, or (None, None)."""
+    m = re.search(r'Assembled reads[ .]*:\s*([\d,]+)\s*/\s*([\d,]+)', text)
+    if not m:
+        return None, None
+    return int(m.group(2).replace(',', '')), int(m.group(1).replace(',', ''))
+
+# The mergers by executable name: their options, command line and report
+# parser.
+MERGERS = dict(
+    flash2=dict(arg_spec=flash2_arg_spec, build_cmd=flash2_cmd, parse_report=flash2_report),
+    pear=dict(arg_spec=pear_arg_spec, build_cmd=pear_cmd, parse_report=pear_report)
+)
+
+def sample_paths(sample):
+    sub = '%s/' % sample['amplicon'] if sample['amplicon'] else ''
+    return 'output/%s%s' % (sub, sample['stem']), 'reports/%s%s.report' % (sub, sample['stem'])
+
+# Waits until fewer than $1 commands are running, reaping the finished
+# ones. Polled rather than wait -n, which bash 4.2 lacks.
+THROTTLE = '''pids=()
+throttle() {
+    while [ ${#pids[@]} -ge $1 ]; do
+        for i in "${!pids[@]}"; do
+            if ! kill -0 "${pids[$i]}" 2>/dev/null; then
+                wait "${pids[$i]}" || rc=1
+                unset "pids[$i]"
+            fi
+        done
+        [ ${#pids[@]} -ge $1 ] && sleep 1
+    done
+}
+'''
+
+def write_script(path, cmds, parallel):
+    """Write the per-sample commands to a script, running up to parallel
+    of them at a time; the next starts as soon as one finishes. The
+    script exits 1 if any command failed."""
+    with open(path, 'w') as f:
+        f.write('%s\n\n' % ('#!/bin/bash'))
+        f.write('rc=0\n')
+        if parallel > 1:
+            f.write(THROTTLE)
+        for cmd in cmds:
+            if parallel > 1:
+                f.write('throttle %d\n(%s) &\npids+=($!)\n' % (parallel, ' '.join(cmd)))
+            else:
+                f.write('%s\n[ $? -eq 0 ] || rc=1\n' % ' '.join(cmd))
+        if parallel > 1:
+            f.write('throttle 1\n')
+        f.write('exit $rc\n')
+        f.close()
+    subprocess.call(['chmod', '0777', path])
+
+def summarize(name, found, merge_path):
+    """Collect pairs and merged counts from every sample's report and
+    write them to reports/merge_summary.tsv."""
+    summary = []
+    for sample in found:
+        prefix, report = sample_paths(sample)
+        pairs = merged = None
+        if os.path.isfile('%s/%s' % (merge_path, report)):
+            with open('%s/%s' % (merge_path, report)) as f:
+                pairs, merged = MERGERS[name]['parse_report'](f.read())
+        rate = round(float(merged) / pairs, 4) if pairs else None
+        summary.append(dict(sample=sample['name'], amplicon=sample['amplicon'], pairs=pairs,
+            merged=merged, merge_rate=rate))
+    with open('%s/reports/merge_summary.tsv' % merge_path, 'w') as f:
+        f.write('sample\tamplicon\tpairs\tmerged\tmerge_rate\n')
+        for s in summary:
+            f.write('%s\t%s\t%s\t%s\t%s\n' % (s['sample'], s['amplicon'] or '', s['pairs'], s['merged'], s['merge_rate']))
+    return summary
+
+def find_samples(module, samples):
+    found = []
+    for amplicon, path in samples.amplicon_dirs(module.params['input_files']):
+        found.extend(samples.discover_samples(path, amplicon))
+    return found
+
+def plan_merge(module, name, executable, slurm, samples, plan, ledger, result):
+    """Return the check-mode plan: the merge command of every sample."""
+    found = find_samples(module, samples)
+    total = sum(s['bytes'] for s in found)
+    concurrency = module.params['parallel']
+    if module.params['hpc']:
+        result['slurm_auto'] = slurm.autosize(module, name, total, len(found), [s['bytes'] for s in found])
+        if slurm.packing_requested(module):
+            concurrency = len(slurm.pack_samples([(i, s['bytes']) for i, s in enumerate(found)],
+                module.params['slurm_spec'].get('num_jobs'), module.params['slurm_spec'].get('bytes_per_job')))
+    cmds = [' '.join(MERGERS[name]['build_cmd'](module.params, s, executable, *sample_paths(s))) for s in found]
+    return plan.build(module, slurm, ledger, name, [s['name'] for s in found], cmds, total, concurrency)
+
+def track(module, tracking, summary):
+    """Record the pairs and merged reads of each sample for the read tracking."""
+    if tracking is not None:
+        tracking.write(tracking.stage_path(module.params['base_dir'], 'merge'), [dict(sample=s['sample'],
+            amplicon=s['amplicon'], stage='merge', reads_in=s['pairs'], reads_out=s['merged']) for s in summary])
+
+def run_merge(module, name, executable, merge_path, slurm, samples, result, ledger=None, tracking=None):
+    """Discover the samples, write the merge script(s) of the merger name
+    and run or submit them. Shared by every merger module."""
+    found = find_samples(module, samples)
+    # Demultiplexed input has one directory per amplicon; mirror it.
+    for amplicon in set(s['amplicon'] for s in found if s['amplicon'] is not None):
+        for d in ('output', 'reports'):
+            if not os.path.isdir('%s/%s/%s' % (merge_path, d, amplicon)):
+                os.makedirs('%s/%s/%s' % (merge_path, d, amplicon))
+    if module.params['hpc']:
+        sizes = [s['bytes'] for s in found]
+        result['slurm_auto'] = slurm.autosize(module, name, sum(sizes), len(found), sizes)
+    cmds = []
+    for sample in found:
+        prefix, report = sample_paths(sample)
+        cmd = MERGERS[name]['build_cmd'](module.params, sample, executable, prefix, report)
+        if ledger is not None:
+            cmd = [ledger.line(module, name, sample['name'], ' '.join(cmd), sample['bytes'])]
+        cmds.append(cmd)
+    if module.params['hpc'] and slurm.packing_requested(module):
+        sizes = [(i, s['bytes']) for i, s in enumerate(found)]
+        bins = slurm.pack_samples(sizes, module.params['slurm_spec'].get('num_jobs'),
+            module.params['slurm_spec'].get('bytes_per_job'))
+        scripts = []
+        for n, b in enumerate(bins):
+            script = '%s/merge_%d.sh' % (merge_path, n)
+            write_script(script, [cmds[i] for i in b['samples']], module.params['parallel'])
+            scripts.append((script, [found[i]['bytes'] for i in b['samples']]))
+        rc, out, err, cmd_2, job_ids = slurm.submit_bins(module, scripts, merge_path)
+    else:
+        write_script('%s/merge.sh' % merge_path, cmds, module.params['parallel'])
+        if module.params['hpc']:
+            cmd_2 = slurm.build_slurm_cmd(module)
+            cmd_2.append('%s/merge.sh' % merge_path)
+            rc, out, err, job_id = slurm.submit(module, cmd_2, merge_path)
+            job_ids = [job_id] if rc == 0 else []
+        else:
+            cmd_2 = ['./merge.sh']
+            rc, out, err = module.run_command(cmd_2, cwd=merge_path)
+            result['samples'] = summarize(name, found, merge_path)
+            track(module, tracking, result['samples'])
+    result['rc'] = '%s' % (rc)
+    result['err'] += '%s' % (err)
+    result['changed'] = True
+    result['cmd'] = cmd_2
+    if module.params['hpc']:
+        slurm.wait_if_requested(module, job_ids, result)
+        if module.params['wait']:
+            result['samples'] = summarize(name, found, merge_path)
+            track(module, tracking, result['samples'])
+    return result
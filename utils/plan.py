@@ -0,0 +1,96 @@
+#!/usr/bin/python
+
+# Copyright: (c) 2019, Tanner Dowhy <tanner.dowhy@usask.ca>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt
+
+"""Check-mode plans. Run with --check, a module discovers its samples and
+builds its commands as usual and returns them as a plan, with the input
+size, the expected output size and estimated CPU-hours and wall time,
+instead of running anything.
+
+Estimates come from the first of these that knows the step: the run
+ledger (per-command times against input bytes), the SLURM history and a
+benchmarks/pipeline_benchmark.py report given as cost_model.
+"""
+
+import json
+import os
+
+# Output bytes per input byte until the ledger has measured a step: the
+# mergers write uncompressed FASTQ from gzipped input.
+OUTPUT_RATIO = dict(cutadapt_paired_end=0.95, flash2=2.5, pear=2.5, dada2_sample_inference=0.5,
+    dada2_taxonomy=0.05)
+
+def ledger_entries(module, ledger, step):
+    entries = ledger.load(ledger.ledger_path(module.params['base_dir']))
+    return [e for e in entries if e['step'] == step and e['rc'] == 0 and e.get('input_bytes')]
+
+def fit(slurm, points, total_bytes, commands):
+    """Predict the total over commands reading total_bytes from (bytes,
+    value) points of single commands: a line through the points once
+    there are three sizes, otherwise the mean value per byte."""
+    points = [(b, y) for b, y in points if y is not None]
+    if not points:
+        return None
+    if len(set(b for b, y in points)) >= 3:
+        coef = slurm.least_squares([[1.0, b] for b, y in points], [y for b, y in points])
+        if coef is not None:
+            value = coef[0] * commands + coef[1] * total_bytes
+            if value > 0:
+                return value
+    return sum(y for b, y in points) / float(sum(b for b, y in points)) * total_bytes
+
+def benchmark_rows(path, step):
+    """The rows of a pipeline_benchmark report for step, which the report
+    names after the module (flash2_merge for flash2)."""
+    if not path or not os.path.isfile(path):
+        return []
+    with open(path) as f:
+        report = json.load(f)
+    return [r for r in report.get('results', []) if not r.get('failed') and r.get('bytes')
+        and (r['step'] == step or r['step'].startswith('%s_' % step))]
+
+def estimate(module, slurm, ledger, step, total_bytes, samples, commands):
+    """Return (source, cpu seconds, serial wall seconds, output bytes) for
+    the step, the times None when nothing has measured it."""
+    entries = ledger_entries(module, ledger, step)
+    if entries:
+        cpu = fit(slurm, [(e['input_bytes'], e['cpu_user'] + e['cpu_sys']) for e in entries], total_bytes, commands)
+        wall = fit(slurm, [(e['input_bytes'], e['wall']) for e in entries], total_bytes, commands)
+        written = fit(slurm, [(e['input_bytes'], e['write_bytes']) for e in entries if e['write_bytes']],
+            total_bytes, commands)
+        return 'ledger', cpu, wall, written
+    runs = slurm.load_history(module, step)
+    if runs:
+        wall = slurm.predict(runs, 'elapsed', total_bytes, samples)
+        cpus = max([r['cpus'] for r in runs if r.get('cpus')] or [1])
+        return 'slurm_history', wall * cpus if wall is not None else None, wall, None
+    rows = benchmark_rows(module.params.get('cost_model'), step)
+    if rows:
+        # The largest run has the least start-up time per byte in it.
+        row = max(rows, key=lambda r: r['bytes'])
+        wall = row['seconds'] / float(row['bytes']) * total_bytes
+        return 'benchmark', wall, wall, None
+    return None, None, None, None
+
+def hours(seconds):
+    return round(seconds / 3600.0, 3) if seconds is not None else None
+
+def build(module, slurm, ledger, step, names, commands, total_bytes, concurrency=1):
+    """Return the plan of a step that would run commands (shell lines)
+    over the samples named, concurrency of them at a time."""
+    source, cpu, wall, written = estimate(module, slurm, ledger, step, total_bytes, len(names), len(commands))
+    if written is None and step in OUTPUT_RATIO:
+        written = OUTPUT_RATIO[step] * total_bytes
+    plan = dict(step=step, samples=names, commands=commands, input_bytes=total_bytes,
+        expected_output_bytes=int(written) if written is not None else None, cpu_hours=hours(cpu),
+        wall_hours=hours(wall / max(1, min(concurrency, len(commands) or 1)) if wall is not None else None),
+        estimate=source)
+    if module.params.get('hpc'):
+        plan['slurm_spec'] = dict((k, v) for k, v in (module.params['slurm_spec'] or {}).items() if v is not None)
+    return plan
+
+def exit_plan(module, result, plan):
+    result['plan'] = plan
+    result['changed'] = bool(plan['commands'])
+    module.exit_json(**result)
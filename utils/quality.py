@@ -0,0 +1,152 @@
+#!/usr/bin/python
+
+# Copyright: (c) 2019, Tanner Dowhy <tanner.dowhy@usask.ca>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt
+
+"""Quality profiles of merged reads and the filterAndTrim settings they
+support. A seeded uniform sample of the reads of each sample, drawn in one
+pass by the reservoir sampler of the pilot subsets, is read into a padded
+matrix of per-position qualities, and everything else is array arithmetic
+on it: expected errors are the cumulative sum of
+10^(-Q/10) along each read, so the reads kept by every truncation length
+under a maxEE are one comparison and a column sum.
+"""
+
+import glob
+import gzip
+import json
+import os
+import random
+
+import numpy as np
+
+QUANTILES = (10, 25, 50, 75, 90)
+# Phred scores above this are counted with it.
+MAX_Q = 63
+
+def open_reads(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def read_qualities(path, n, rng, pilot):
+    """Return the read lengths and a (reads, longest) uint8 matrix of the
+    Phred scores of n reads drawn uniformly from a FASTQ file by
+    pilot.reservoir, 0 past each read's end. Reads from the start of a
+    file alone are biased, e.g. towards the edge tiles of the flow cell."""
+    with open_reads(path) as f:
+        reads, drawn = pilot.reservoir([f], n, rng)
+    quals = [record[3].rstrip(b'\r\n') for i, record in drawn]
+    lengths = np.array([len(q) for q in quals], dtype=np.int64)
+    matrix = np.zeros((len(quals), lengths.max() if len(quals) else 0), dtype=np.uint8)
+    if len(quals):
+        # Row-major boolean assignment fills the reads one after another.
+        inside = np.arange(matrix.shape[1]) < lengths[:, None]
+        matrix[inside] = np.frombuffer(b''.join(quals), dtype=np.uint8) - 33
+    return lengths, matrix
+
+def kept_by_length(lengths, matrix, max_ees, trunc_q):
+    """Return an array with, for each maxEE, the reads filterAndTrim keeps
+    at every truncation length (column i is truncLen i + 1): reads are
+    first cut before their first base at or below trunc_q, then dropped if
+    shorter than the truncation length or over maxEE within it."""
+    inside = np.arange(matrix.shape[1]) < lengths[:, None]
+    low = (matrix <= trunc_q) & inside
+    usable = np.where(low.any(1), low.argmax(1), lengths)
+    ee = np.cumsum(np.where(inside, 10 ** (matrix / np.float32(-10)), 0), axis=1, dtype=np.float32)
+    covered = np.arange(matrix.shape[1]) < usable[:, None]
+    return np.array([((ee <= e) & covered).sum(0) for e in max_ees])
+
+def histogram(lengths, matrix):
+    """Return a (positions, MAX_Q + 1) array counting the reads with each
+    quality at each position."""
+    inside = np.arange(matrix.shape[1]) < lengths[:, None]
+    pos = np.nonzero(inside)[1]
+    q = np.minimum(matrix[inside], MAX_Q)
+    return np.bincount(pos * (MAX_Q + 1) + q,
+        minlength=matrix.shape[1] * (MAX_Q + 1)).reshape(matrix.shape[1], MAX_Q + 1)
+
+def pad_add(total, part):
+    """Add part to total, padding both with zeros to the longer of each
+    axis (positions are the last axis of kept counts and the first of
+    histograms)."""
+    if total is None:
+        return part
+    shape = tuple(max(a, b) for a, b in zip(total.shape, part.shape))
+    out = np.zeros(shape, dtype=np.result_type(total, part))
+    out[tuple(slice(0, n) for n in total.shape)] += total
+    out[tuple(slice(0, n) for n in part.shape)] += part
+    return out
+
+def quantiles(hist):
+    """Return the QUANTILES of quality at each position from a histogram."""
+    cum = np.cumsum(hist, axis=1)
+    depth = cum[:, -1:]
+    return dict((str(p), (cum * 100 < p * np.maximum(depth, 1)).sum(1).tolist()) for p in QUANTILES)
+
+def recommend(kept, reads, max_ees, target, min_len):
+    """Return (trunc_len, max_ee, retention) for a step keeping at least the
+    target fraction of reads. The truncation length is the longest meeting
+    the target; maxEE is the strictest of max_ees that does not force it
+    shorter than the most lenient one allows. None if nothing meets it."""
+    retention = kept / float(max(reads, 1))
+    best = []
+    for row in retention:
+        ok = np.nonzero(row >= target)[0] + 1
+        ok = ok[ok >= min_len]
+        best.append(int(ok.max()) if len(ok) else 0)
+    if not max(best):
+        return None
+    i = best.index(max(best))
+    return best[i], max_ees[i], round(float(retention[i][best[i] - 1]), 4)
+
+def sample_files(reads, extension):
+    files = sorted(glob.glob('%s/*%s*' % (reads, extension)))
+    return [(os.path.basename(f).split(extension)[0], f) for f in files]
+
+def profile(reads, extension, n, max_ees, target, trunc_q, min_len, pilot, seed=0):
+    """Profile the merged reads of one directory, n reads per sample drawn
+    with seed, and return the recommendation with the pooled quality
+    quantiles, the retention table and the retention of each sample at the
+    recommendation."""
+    max_ees = sorted(max_ees)
+    kept = None
+    hist = None
+    per_sample = []
+    total = 0
+    for name, path in sample_files(reads, extension):
+        lengths, matrix = read_qualities(path, n, random.Random('%d:%s' % (seed, name)), pilot)
+        if not len(lengths):
+            per_sample.append(dict(sample=name, reads=0))
+            continue
+        k = kept_by_length(lengths, matrix, max_ees, trunc_q)
+        kept = pad_add(kept, k)
+        hist = pad_add(hist, histogram(lengths, matrix))
+        total += len(lengths)
+        per_sample.append(dict(sample=name, reads=len(lengths), mean_len=round(float(lengths.mean()), 1), kept=k))
+    result = dict(reads=total, samples=per_sample, trunc_len=None, max_ee=None, retention=None)
+    if kept is None:
+        return result
+    best = recommend(kept, total, max_ees, target, min_len)
+    if best:
+        result['trunc_len'], result['max_ee'], result['retention'] = best
+    i = max_ees.index(result['max_ee']) if best else len(max_ees) - 1
+    for s in per_sample:
+        k = s.pop('kept', None)
+        if k is not None:
+            s['retention'] = round(float(k[i][result['trunc_len'] - 1]) / s['reads'], 4) if best and \
+                result['trunc_len'] <= k.shape[1] else 0.0
+    result['quantiles'] = quantiles(hist)
+    result['depth'] = hist.sum(1).tolist()
+    result['retention_by_max_ee'] = dict((str(e), np.round(row / float(total), 3).tolist())
+        for e, row in zip(max_ees, kept))
+    return result
+
+def profile_path(base_dir, output):
+    return '%s/.biolighthouse/quality/%s.json' % (base_dir, output)
+
+def save(path, profile):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        json.dump(profile, f, separators=(',', ':'), sort_keys=True)
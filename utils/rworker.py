@@ -0,0 +1,170 @@
+#!/usr/bin/python
+
+# Copyright: (c) 2019, Tanner Dowhy <tanner.dowhy@usask.ca>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt
+
+import binascii
+import errno
+import fcntl
+import os
+import signal
+import subprocess
+import time
+
+STARTUP_TIMEOUT = 300
+# How long a request waits for the worker to open its FIFO
+CONNECT_TIMEOUT = 60
+# Memory the worker keeps for the RDS files it has read
+CACHE_MB = 2048
+
+def worker_dir(base_dir):
+    return '%s/.biolighthouse/worker' % base_dir
+
+def worker_path(base_dir, name, suffix):
+    return '%s/%s%s' % (worker_dir(base_dir), name, suffix)
+
+def make_worker_dir(base_dir):
+    """The FIFO, logs and replies live in a directory only the owner can
+    enter, so no other user can send the worker requests."""
+    path = worker_dir(base_dir)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    os.chmod(path, 0o700)
+    return path
+
+def worker_pid(base_dir, name):
+    """The pid of the running worker, or None."""
+    try:
+        with open(worker_path(base_dir, name, '.pid')) as f:
+            pid = int(f.read().strip())
+        os.kill(pid, 0)
+    except (IOError, OSError, ValueError):
+        return None
+    return pid
+
+def start(module, executable, script, lib, name):
+    """Start worker.R in the background unless it is already running and
+    wait until it has loaded the libraries. Loading them happens here,
+    once, instead of in every step. The worker only runs the scripts in
+    the directory of worker.R.
+    """
+    base_dir = module.params['base_dir']
+    if worker_pid(base_dir, name):
+        return
+    path = make_worker_dir(base_dir)
+    fifo = worker_path(base_dir, name, '.fifo')
+    if os.path.exists(fifo):
+        os.remove(fifo)
+    os.mkfifo(fifo, 0o600)
+    pid_file = worker_path(base_dir, name, '.pid')
+    if os.path.exists(pid_file):
+        os.remove(pid_file)
+    log = open(worker_path(base_dir, name, '.log'), 'a')
+    script_dir = os.path.dirname(os.path.abspath(script))
+    proc = subprocess.Popen([executable, script, lib, path, name, script_dir, str(CACHE_MB)], cwd=path,
+        stdout=log, stderr=subprocess.STDOUT, close_fds=True, preexec_fn=os.setsid)
+    log.close()
+    waited = 0
+    while not worker_pid(base_dir, name):
+        if waited >= STARTUP_TIMEOUT or proc.poll() is not None:
+            module.fail_json(msg='R worker %s did not start; see %s' % (name, worker_path(base_dir, name, '.log')))
+        time.sleep(1)
+        waited += 1
+
+def send(module, name, lines):
+    """Write one request to the worker's FIFO. Opening it non-blocking
+    fails while the worker is busy with another request, so retry while
+    it is alive."""
+    base_dir = module.params['base_dir']
+    fifo = worker_path(base_dir, name, '.fifo')
+    waited = 0
+    while True:
+        try:
+            fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+            break
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                raise
+        if not worker_pid(base_dir, name) or waited >= CONNECT_TIMEOUT:
+            return False
+        time.sleep(0.1)
+        waited += 0.1
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+    with os.fdopen(fd, 'w') as f:
+        f.write(''.join('%s\n' % line for line in lines))
+    return True
+
+def unquote(arg):
+    # Commands are built for the shell, where "" is an empty argument.
+    return '' if arg == '""' else arg
+
+def run(module, cmd, name):
+    """Run an Rscript command (executable, script, args...) in the worker
+    and return (rc, out, err) like module.run_command.
+    """
+    base_dir = module.params['base_dir']
+    script = cmd[1]
+    token = binascii.hexlify(os.urandom(8)).decode()
+    reply = worker_path(base_dir, name, '_reply_%s' % token)
+    log = worker_path(base_dir, name, '_%s.log' % os.path.splitext(os.path.basename(script))[0])
+    lines = [os.path.basename(reply), os.path.basename(log), os.path.abspath(script)]
+    lines += [unquote(arg) for arg in cmd[2:]]
+    # One request at a time, held until the reply, so a second request is
+    # not written while the worker is still reading the first
+    with open(worker_path(base_dir, name, '.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not send(module, name, ['%d' % len(lines)] + lines):
+            return 1, '', 'R worker %s is not reading requests; see %s' % (name, worker_path(base_dir, name, '.log'))
+        while not os.path.exists(reply):
+            if not worker_pid(base_dir, name):
+                return 1, '', 'R worker %s exited; see %s' % (name, worker_path(base_dir, name, '.log'))
+            time.sleep(0.5)
+    with open(reply) as f:
+        answer = f.read().strip()
+    os.remove(reply)
+    out = ''
+    if os.path.isfile(log):
+        with open(log) as f:
+            out = f.read()
+    try:
+        rc = int(answer)
+    except ValueError:
+        return 1, out, 'Bad reply from R worker %s: %s' % (name, answer)
+    return rc, out, ''
+
+def run_all(module, executable, cmds, name):
+    """Start the worker if needed and run each command in turn, stopping at
+    the first failure. worker.R sits next to the scripts, and the library
+    path is their first argument."""
+    start(module, executable, '%s/worker.R' % os.path.dirname(cmds[0][1]), cmds[0][2], name)
+    rc, out_all, err_all = 0, '', ''
+    for cmd in cmds:
+        rc, out, err = run(module, cmd, name)
+        out_all += out
+        err_all += err
+        if rc != 0:
+            break
+    return rc, out_all, err_all
+
+def stop(module, name):
+    """Ask the worker to quit once its current request is done, then remove
+    its FIFO, lock and pid files. A worker that does not quit within
+    STARTUP_TIMEOUT is killed. Returns whether one was running."""
+    base_dir = module.params['base_dir']
+    pid = worker_pid(base_dir, name)
+    if pid:
+        with open(worker_path(base_dir, name, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            send(module, name, ['quit'])
+            waited = 0
+            while worker_pid(base_dir, name) and waited < STARTUP_TIMEOUT:
+                time.sleep(0.5)
+                waited += 0.5
+            if worker_pid(base_dir, name):
+                # start() made the worker a process group leader
+                os.killpg(pid, signal.SIGTERM)
+    for suffix in ('.fifo', '.lock', '.pid'):
+        path = worker_path(base_dir, name, suffix)
+        if os.path.exists(path):
+            os.remove(path)
+    return pid is not None
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+
+# Copyright: (c) 2019, Tanner Dowhy <tanner.dowhy@usask.ca>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt
+
+import glob
+import os
+import re
+
+def amplicon_dirs(path, pattern='*_R1*'):
+    """Return (amplicon, directory) pairs for the per-amplicon directories
+    that a demultiplexing cutadapt run writes under path. Reads that
+    matched no amplicon are left in 'unknown' and skipped. If path has
+    no such directories it is returned as a single unnamed amplicon.
+    """
+    dirs = []
+    for d in sorted(glob.glob('%s/*/' % path)):
+        d = d.rstrip('/')
+        name = os.path.basename(d)
+        if name != 'unknown' and glob.glob('%s/%s' % (d, pattern)):
+            dirs.append((name, d))
+    if not dirs:
+        return [(None, path)]
+    return dirs
+
+# <prefix>[_L001]_R1[_001].fastq[.gz], as written by bcl2fastq and bcl-convert.
+R1_RE = re.compile(r'^(?P<prefix>.+?)(?P<lane>_L\d{3})?_R1(?P<suffix>_\d{3})?(?P<ext>\.f(ast)?q(\.gz)?)$')
+
+def discover_samples(path, amplicon=None):
+    """Return the paired samples in path as dicts holding the sample name,
+    the output stem of its R1 file, the R1 and R2 files of every lane, the
+    shell words that read them and the total input bytes. Files of one
+    sample split across lanes (_L001 ... _L004) are grouped into a single
+    sample.
+    """
+    samples = {}
+    for r1 in sorted(glob.glob('%s/*_R1*' % path)):
+        base = os.path.basename(r1)
+        m = R1_RE.match(base)
+        if m:
+            stem = '%s_R1%s' % (m.group('prefix'), m.group('suffix') or '')
+            r2 = os.path.join(os.path.dirname(r1), '%s%s_R2%s%s' % (m.group('prefix'),
+                m.group('lane') or '', m.group('suffix') or '', m.group('ext')))
+        else:
+            stem = base.replace('.fastq.gz', '')
+            r2 = r1.replace('_R1', '_R2')
+        if stem not in samples:
+            samples[stem] = dict(name=stem.replace('_R1', ''), stem=stem, r1=[], r2=[],
+                amplicon=amplicon, bytes=0)
+        samples[stem]['r1'].append(r1)
+        samples[stem]['r2'].append(r2)
+        samples[stem]['bytes'] += os.path.getsize(r1) + (os.path.getsize(r2) if os.path.exists(r2) else 0)
+    for sample in samples.values():
+        sample['r1_in'] = stream(sample['r1'])
+        sample['r2_in'] = stream(sample['r2'])
+    return [samples[k] for k in sorted(samples)]
+
+def input_size(patterns):
+    """Return the total bytes and number of the files matching the glob
+    patterns, e.g. to size a step's resources from its input."""
+    files = set()
+    for pattern in patterns:
+        files.update(f for f in glob.glob(pattern) if os.path.isfile(f))
+    return sum(os.path.getsize(f) for f in files), len(files)
+
+def stream(files):
+    """Return a shell word that reads the lanes of one mate as a single
+    input. Several lanes are decompressed through a process substitution
+    rather than concatenated to a temporary file first.
+    """
+    if len(files) == 1:
+        return files[0]
+    return '<(zcat -f %s)' % ' '.join(files)
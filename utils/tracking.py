@@ -0,0 +1,109 @@
+#!/usr/bin/python
+
+# Copyright: (c) 2019, Tanner Dowhy <tanner.dowhy@usask.ca>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt
+
+"""Read counts of every sample through the pipeline. Each step writes the
+reads in and out of each sample to .biolighthouse/tracking/stages/ as it
+finishes, taken from what it already has (the preflight counts, the
+cutadapt and merger reports, the filterAndTrim return value, the denoised
+and chimera-free tables) rather than by counting files again. join() lines
+them up in one table.
+
+A stage file is a TSV of sample, amplicon, stage, reads_in and reads_out;
+amplicon is empty for counts of the whole sample, and reads_in may be
+empty. When a stage was run more than once, the newest file wins.
+"""
+
+import glob
+import os
+
+STAGES = ('input', 'cutadapt', 'merge', 'filter', 'denoise', 'nonchim')
+# Stages before a primer panel splits the reads by amplicon.
+SAMPLE_STAGES = ('input', 'cutadapt')
+COLUMNS = ('sample', 'amplicon', 'stage', 'reads_in', 'reads_out')
+
+def tracking_dir(base_dir):
+    return '%s/.biolighthouse/tracking' % base_dir
+
+def stage_path(base_dir, stage, name=None):
+    return '%s/stages/%s%s.tsv' % (tracking_dir(base_dir), stage, '_%s' % name if name else '')
+
+def sample_key(name):
+    # DADA2 names samples after the merged files, which keep the _R1 of
+    # the stem; discover_samples drops it.
+    return name.replace('_R1', '')
+
+def write(path, rows):
+    """Write rows (dicts with the COLUMNS) to a stage file."""
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write('%s\n' % '\t'.join(COLUMNS))
+        for r in rows:
+            f.write('%s\n' % '\t'.join('' if r.get(c) is None else str(r[c]) for c in COLUMNS))
+
+def count(value):
+    return int(float(value)) if value not in ('', 'NA', 'None') else None
+
+def load(base_dir):
+    """Return {(sample, amplicon): {stage: (reads_in, reads_out)}} from
+    every stage file, the newest file last."""
+    files = sorted(glob.glob('%s/stages/*.tsv' % tracking_dir(base_dir)), key=os.path.getmtime)
+    counts = {}
+    for path in files:
+        with open(path) as f:
+            header = f.readline().rstrip('\r\n').split('\t')
+            for line in f:
+                r = dict(zip(header, line.rstrip('\r\n').split('\t')))
+                if r.get('stage') not in STAGES:
+                    continue
+                key = (sample_key(r['sample']), r.get('amplicon') or '')
+                counts.setdefault(key, {})[r['stage']] = (count(r.get('reads_in', '')), count(r.get('reads_out', '')))
+    return counts
+
+def join(counts, min_fraction):
+    """Return one row per sample and amplicon with the reads left after
+    each stage, the fraction of the input left at the end and the stage
+    that lost the largest share. With a primer panel, the input and
+    cutadapt counts of the whole sample fill in every amplicon of it; the
+    chimera removal counts, which do not know the amplicon, are left out.
+    Rows keeping less than min_fraction are flagged."""
+    amplicons = {}
+    for sample, amplicon in counts:
+        amplicons.setdefault(sample, set())
+        if amplicon:
+            amplicons[sample].add(amplicon)
+    rows = []
+    for sample in sorted(amplicons):
+        for amplicon in sorted(amplicons[sample]) or ['']:
+            stages = dict(counts.get((sample, ''), {}))
+            if amplicon:
+                stages = dict((s, v) for s, v in stages.items() if s in SAMPLE_STAGES)
+            stages.update(counts.get((sample, amplicon), {}))
+            row = dict(sample=sample, amplicon=amplicon)
+            for stage in STAGES:
+                row[stage] = stages[stage][1] if stage in stages else None
+            if row['input'] is None:
+                # Without a preflight, what the first step read.
+                first = [stages[s][0] for s in STAGES if s in stages and stages[s][0] is not None]
+                row['input'] = first[0] if first else None
+            done = [s for s in STAGES if row[s] is not None]
+            last = row[done[-1]] if done else None
+            row['fraction'] = round(float(last) / row['input'], 4) if row['input'] else None
+            worst = None
+            for prev, stage in zip(done, done[1:]):
+                loss = 1 - float(row[stage]) / row[prev] if row[prev] else 0
+                if worst is None or loss > worst[1]:
+                    worst = (stage, loss)
+            row['worst_stage'] = worst[0] if worst and worst[1] > 0 else None
+            row['flagged'] = row['fraction'] is not None and row['fraction'] < min_fraction
+            rows.append(row)
+    return rows
+
+def write_table(path, rows):
+    with open(path, 'w') as f:
+        columns = ('sample', 'amplicon') + STAGES + ('fraction', 'worst_stage', 'flagged')
+        f.write('%s\n' % '\t'.join(columns))
+        for r in rows:
+            f.write('%s\n' % '\t'.join('' if r[c] is None else str(r[c]) for c in columns))